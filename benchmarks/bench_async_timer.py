@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark timing coroutines on a busy event loop.
+
+Usage::
+
+    $ python benchmarks/bench_async_timer.py
+
+This runs many tasks concurrently on one event loop. Each task runs a
+coroutine many times and each run awaits several times, so the event loop is
+busy switching between tasks. It compares plain coroutines with ones timed
+with ``timer_decorator`` and ``async with metrics.timer``, and async
+generators with timed async generators.
+
+This uses a backend that does nothing in ``emit`` so the numbers reflect the
+overhead of markus itself.
+
+"""
+
+import asyncio
+import time
+
+import markus
+from markus.backends import BackendBase
+
+
+TASKS = 1_000
+CALLS = 20
+AWAITS = 5
+REPEAT = 5
+
+
+class NullMetrics(BackendBase):
+    def emit(self, record):
+        pass
+
+
+metrics = markus.get_metrics("app")
+
+
+async def plain():
+    for _ in range(AWAITS):
+        await asyncio.sleep(0)
+
+
+@metrics.timer_decorator("plain")
+async def decorated():
+    for _ in range(AWAITS):
+        await asyncio.sleep(0)
+
+
+async def context_manager():
+    async with metrics.timer("plain"):
+        for _ in range(AWAITS):
+            await asyncio.sleep(0)
+
+
+async def plain_agen():
+    for i in range(AWAITS):
+        await asyncio.sleep(0)
+        yield i
+
+
+@metrics.timer_decorator("agen")
+async def decorated_agen():
+    for i in range(AWAITS):
+        await asyncio.sleep(0)
+        yield i
+
+
+def coroutine_runner(fun):
+    async def task():
+        for _ in range(CALLS):
+            await fun()
+
+    return task
+
+
+def agen_runner(fun):
+    async def task():
+        for _ in range(CALLS):
+            async for _ in fun():
+                pass
+
+    return task
+
+
+async def run_tasks(task):
+    await asyncio.gather(*[task() for _ in range(TASKS)])
+
+
+def bench(name, task):
+    best = None
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        asyncio.run(run_tasks(task))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    calls = TASKS * CALLS
+    print(
+        f"{name:<45} {best * 1000:8.1f} ms "
+        f"{best / calls * 1_000_000_000:8.1f} ns/call "
+        f"{best / (calls * AWAITS) * 1_000_000_000:8.1f} ns/await"
+    )
+
+
+def main():
+    print(f"{TASKS} tasks x {CALLS} calls x {AWAITS} awaits")
+    markus.configure([{"class": NullMetrics}])
+    bench("coroutine: plain", coroutine_runner(plain))
+    bench("coroutine: timer_decorator", coroutine_runner(decorated))
+    bench("coroutine: async with timer", coroutine_runner(context_manager))
+    bench("async generator: plain", agen_runner(plain_agen))
+    bench("async generator: timer_decorator", agen_runner(decorated_agen))
+
+    markus.configure([])
+    bench("coroutine: timer_decorator, no backends", coroutine_runner(decorated))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark DogStatsdMetrics against DatadogMetrics.
+
+Usage::
+
+    $ python benchmarks/bench_dogstatsd.py
+
+This sends metrics to a local UDP socket that a thread drains. It requires
+the datadog library to be installed.
+
+It also compares packets sent for distributions with and without
+``aggregate_values``.
+
+"""
+
+import socket
+import threading
+import timeit
+
+from markus.backends.datadog import DatadogMetrics
+from markus.backends.dogstatsd import DogStatsdMetrics
+from markus.main import MetricsRecord
+
+
+NUMBER = 100_000
+REPEAT = 5
+
+
+def start_sink():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    stats = {"packets": 0}
+
+    def drain():
+        while True:
+            sock.recv(65535)
+            stats["packets"] += 1
+
+    threading.Thread(target=drain, daemon=True).start()
+    return sock.getsockname()[1], stats
+
+
+def bench(name, stmt, stats, number=NUMBER, unit="record"):
+    stats["packets"] = 0
+    best = min(timeit.repeat(stmt, number=number, repeat=REPEAT))
+    print(
+        f"{name:<45} {best / number * 1_000_000_000:10.1f} ns/{unit} "
+        f"{stats['packets'] / (number * REPEAT):6.3f} packets/{unit}"
+    )
+
+
+def main():
+    port, stats = start_sink()
+    options = {"statsd_host": "127.0.0.1", "statsd_port": port}
+    record = MetricsRecord("timing", "app.request_time", 12.5, ["env:prod"])
+    batch = [record] * 50
+
+    datadog = DatadogMetrics(options=options)
+    dogstatsd = DogStatsdMetrics(options=options)
+    dogstatsd_buffered = DogStatsdMetrics(options={**options, "flush_interval": 1})
+
+    bench("emit: DatadogMetrics", lambda: datadog.emit(record), stats)
+    bench("emit: DogStatsdMetrics", lambda: dogstatsd.emit(record), stats)
+    bench(
+        "emit: DogStatsdMetrics (flush_interval=1)",
+        lambda: dogstatsd_buffered.emit(record),
+        stats,
+    )
+
+    number = NUMBER // len(batch)
+    bench(
+        f"emit_batch of {len(batch)}: DatadogMetrics",
+        lambda: datadog.emit_batch(batch),
+        stats,
+        number=number,
+        unit="batch",
+    )
+    bench(
+        f"emit_batch of {len(batch)}: DogStatsdMetrics",
+        lambda: dogstatsd.emit_batch(batch),
+        stats,
+        number=number,
+        unit="batch",
+    )
+
+    dogstatsd_buffered.close()
+
+    # Distributions for 10 keys with 1,000 values each, flushed once
+    records = [
+        MetricsRecord("distribution", f"app.request_size_{i % 10}", i % 997, [])
+        for i in range(10_000)
+    ]
+    for aggregate_values in [False, True]:
+        backend = DogStatsdMetrics(
+            options={
+                **options,
+                "flush_interval": 1000,
+                "aggregate_values": aggregate_values,
+            }
+        )
+        name = f"distribution: aggregate_values={aggregate_values}"
+
+        def emit_all(backend=backend):
+            for record in records:
+                backend.emit(record)
+            backend.flush()
+
+        best = min(timeit.repeat(emit_all, number=1, repeat=REPEAT))
+        print(
+            f"{name:<45} {best / len(records) * 1_000_000_000:10.1f} ns/record "
+            f"{backend.packets_sent / REPEAT:8.0f} packets/flush"
+        )
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark PrometheusMetrics with a large number of series.
+
+Usage::
+
+    $ python benchmarks/bench_prometheus.py
+
+This creates 100,000 series and measures emitting, rendering when nothing
+changed, rendering when some series changed, and how long emitting takes
+while a scrape is rendering everything.
+
+"""
+
+import threading
+import time
+import timeit
+
+from markus.backends.prometheus import PrometheusMetrics
+from markus.main import MetricsRecord
+
+
+SERIES = 100_000
+NUMBER = 100_000
+REPEAT = 5
+
+
+def bench(name, stmt, number=NUMBER, unit="call"):
+    best = min(timeit.repeat(stmt, number=number, repeat=REPEAT))
+    print(f"{name:<45} {best / number * 1_000_000_000:12.1f} ns/{unit}")
+
+
+def make_records():
+    # 10 metrics of each type with 2,500 label combinations each
+    records = []
+    per_metric = SERIES // 40
+    for stat_type in ["incr", "gauge", "timing", "histogram"]:
+        for i in range(10):
+            for j in range(per_metric):
+                records.append(
+                    MetricsRecord(
+                        stat_type,
+                        f"app.{stat_type}{i}",
+                        j % 1000,
+                        [f"host:web{j % 50}", f"path:/p{j // 50}"],
+                    )
+                )
+    return records
+
+
+def main():
+    records = make_records()
+    pm = PrometheusMetrics(options={"start_server": False})
+
+    start = time.perf_counter()
+    for record in records:
+        pm.emit(record)
+    print(
+        f"{'create ' + str(len(records)) + ' series':<45} "
+        f"{(time.perf_counter() - start) * 1000:12.1f} ms"
+    )
+
+    start = time.perf_counter()
+    body = pm.render()
+    print(
+        f"{'first render (' + str(len(body)) + ' bytes)':<45} "
+        f"{(time.perf_counter() - start) * 1000:12.1f} ms"
+    )
+
+    incr = records[0]
+    timing = records[SERIES // 2]
+    bench("emit: incr", lambda: pm.emit(incr))
+    bench("emit: timing", lambda: pm.emit(timing))
+
+    bench("render: nothing changed", pm.render, number=100, unit="scrape")
+
+    changed = records[:: len(records) // 1000]
+
+    def render_changed():
+        for record in changed:
+            pm.emit(record)
+        pm.render()
+
+    bench("render: 1% of series changed", render_changed, number=10, unit="scrape")
+
+    def render_all():
+        for record in records:
+            pm.emit(record)
+        pm.render()
+
+    # Emit latency while another thread is rendering everything
+    stop = threading.Event()
+
+    def scrape():
+        while not stop.is_set():
+            render_all()
+
+    thread = threading.Thread(target=scrape)
+    thread.start()
+    try:
+        bench("emit: incr during full renders", lambda: pm.emit(incr))
+    finally:
+        stop.set()
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()
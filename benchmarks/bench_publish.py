@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Benchmark the cost of publishing metrics through MetricsInterface.
+
+Usage::
+
+    $ python benchmarks/bench_publish.py
+
+This uses backends that do nothing in ``emit`` so the numbers reflect the
+overhead of markus itself.
+
+"""
+
+import timeit
+
+import markus
+from markus.backends import BackendBase
+from markus.filters import AddTagFilter, RegisteredMetricsFilter
+
+
+NUMBER = 200_000
+REPEAT = 5
+
+
+class NullMetrics(BackendBase):
+    def emit(self, record):
+        pass
+
+
+def bench(name, stmt):
+    best = min(timeit.repeat(stmt, number=NUMBER, repeat=REPEAT))
+    print(f"{name:<45} {best / NUMBER * 1_000_000_000:8.1f} ns/call")
+
+
+def scenarios():
+    registered = RegisteredMetricsFilter(
+        {"app.foo": {"type": "incr", "description": "foo"}}
+    )
+
+    yield "3 backends, no filters", [{"class": NullMetrics}] * 3
+    yield (
+        "3 backends, non-mutating filter",
+        [{"class": NullMetrics, "filters": [registered]}] * 3,
+    )
+    yield (
+        "3 backends, mutating filter",
+        [{"class": NullMetrics, "filters": [AddTagFilter("color:blue")]}] * 3,
+    )
+
+
+def main():
+    metrics = markus.get_metrics("app")
+    for name, backends in scenarios():
+        markus.configure(backends)
+        bench(f"incr: {name}", lambda: metrics.incr("foo", tags=["env:prod"]))
+
+    counter = metrics.counter("foo", tags=["env:prod"])
+    markus.configure([{"class": NullMetrics}] * 3)
+    bench("counter handle: 3 backends, no filters", counter.incr)
+
+    markus.configure([])
+    bench("incr: no backends", lambda: metrics.incr("foo", tags=["env:prod"]))
+
+    def use_timer():
+        with metrics.timer("foo"):
+            pass
+
+    bench("timer: no backends", use_timer)
+
+    @metrics.timer_decorator("foo")
+    def decorated():
+        pass
+
+    bench("timer_decorator: no backends", decorated)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,7 @@ from importlib.metadata import (
     PackageNotFoundError,
 )
 
-from markus.main import configure, get_metrics  # noqa
+from markus.main import configure, flush, get_metrics  # noqa
 
 try:
     __version__ = importlib_version("markus")
@@ -19,5 +19,15 @@ INCR = "incr"
 GAUGE = "gauge"
 TIMING = "timing"
 HISTOGRAM = "histogram"
+DISTRIBUTION = "distribution"
 
-__all__ = ["configure", "get_metrics", "INCR", "GAUGE", "TIMING", "HISTOGRAM"]
+__all__ = [
+    "configure",
+    "flush",
+    "get_metrics",
+    "INCR",
+    "GAUGE",
+    "TIMING",
+    "HISTOGRAM",
+    "DISTRIBUTION",
+]
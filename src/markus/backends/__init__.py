@@ -3,6 +3,15 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+# Default maximum number of entries in a backend's cache of serialized keys
+# and tags
+WIRE_CACHE_SIZE = 1000
+
+# Default histogram bucket upper bounds for backends that count values in
+# buckets; markus timings are in milliseconds
+DEFAULT_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
 class BackendBase:
     """Markus Backend superclass that defines API backends should follow."""
 
@@ -33,12 +42,88 @@ class BackendBase:
         if record is not None:
             self.emit(record)
 
+    def emit_batch_to_backend(self, records):
+        """Emit a batch of records for backend handling.
+
+        :arg list records: the list of MetricsRecord instances to be emitted
+
+        """
+        batch = []
+        for record in records:
+            record = self._filter(record)
+            if record is not None:
+                batch.append(record)
+        if batch:
+            self.emit_batch(batch)
+
     def emit(self, record):
         """Emit record to backend.
 
         Implement this in your backend.
 
+        The record may be shared with other backends, so don't modify it here.
+        If you need to adjust records, do that in a filter.
+
         :arg MetricsRecord record: the record to be published
 
         """
         raise NotImplementedError
+
+    def emit_batch(self, records):
+        """Emit a batch of records to backend.
+
+        By default, this calls ``emit`` for each record. Implement this in your
+        backend if it can send a batch of records more efficiently than one
+        record at a time.
+
+        The records may be shared with other backends, so don't modify them
+        here.
+
+        :arg list records: the list of MetricsRecord instances to be published
+
+        """
+        for record in records:
+            self.emit(record)
+
+    def flush(self):
+        """Send buffered records.
+
+        Implement this in your backend if it buffers records. By default, this
+        does nothing.
+
+        This gets called by :py:func:`markus.flush`.
+
+        """
+
+    def before_fork(self):
+        """Get ready for the process to fork.
+
+        This gets called in the parent process right before it forks. By
+        default, this calls ``flush()`` so buffered records are sent once by
+        the parent rather than by both processes.
+
+        """
+        self.flush()
+
+    def after_fork_child(self):
+        """Reset state the child process shouldn't share with the parent.
+
+        This gets called in the child process right after a fork. Implement
+        this in your backend if it has sockets, threads, locks, buffers, or
+        aggregated data. Threads don't survive a fork, locks may have been held
+        by threads in the parent, sockets are shared with the parent, and
+        buffered and aggregated data would get sent by both processes. By
+        default, this does nothing.
+
+        """
+
+    def close(self):
+        """Send buffered records and release resources.
+
+        This gets called when the backend is no longer configured, for example
+        when :py:func:`markus.configure` is called again. Implement this in
+        your backend if it has sockets, threads, or servers. By default, this
+        calls ``flush()``.
+
+        """
+        self.flush()
@@ -0,0 +1,250 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+import itertools
+import logging
+import threading
+
+from markus.backends import BackendBase
+from markus.main import MetricsRecord, _build_backend, _filters_mutate
+
+
+logger = logging.getLogger(__name__)
+
+
+class _ThreadBuffer:
+    """Aggregated counters and gauges for a single thread."""
+
+    __slots__ = ("lock", "counters", "gauges")
+
+    def __init__(self):
+        # NOTE: only the owning thread and the flusher use this lock,
+        # so it's only contended while flushing
+        self.lock = threading.Lock()
+        # (key, tags) -> sum
+        self.counters = {}
+        # (key, tags) -> [sequence, last, min, max]
+        self.gauges = {}
+
+    def swap(self):
+        """Return aggregated data and reset the buffer."""
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            gauges, self.gauges = self.gauges, {}
+        return counters, gauges
+
+
+class AggregatingMetrics(BackendBase):
+    """Wraps a backend and aggregates counters and gauges before emitting.
+
+    Each thread aggregates ``incr`` and ``gauge`` records into its own buffer.
+    Every ``flush_interval`` seconds, a flusher thread merges the buffers and
+    emits one record per key and tags combination to the wrapped backend:
+
+    * ``incr``: the sum of all values
+    * ``gauge``: the last value
+
+    This means the number of records emitted to the wrapped backend depends on
+    the number of distinct keys rather than the number of calls.
+
+    ``timing``, ``histogram``, and ``distribution`` records are emitted to the
+    wrapped backend immediately.
+
+    To use, add this to your backends list::
+
+        {
+            "class": "markus.backends.aggregating.AggregatingMetrics",
+            "options": {
+                "backend": {
+                    "class": "markus.backends.statsd.StatsdMetrics",
+                    "options": {
+                        "statsd_host": "statsd.example.com",
+                    },
+                },
+                "flush_interval": 10,
+            }
+        }
+
+    Options:
+
+    * ``backend``: the configuration for the backend to wrap
+
+      This is a dict just like the ones passed to :py:func:`markus.configure`.
+      It's required.
+
+    * ``flush_interval``: number of seconds between flushes
+
+      Defaults to ``10``.
+
+    * ``gauge_min_max``: whether to also emit the minimum and maximum values
+      of gauges over the interval as ``KEY.min`` and ``KEY.max`` gauges
+
+      Defaults to ``False``.
+
+    Counters that were sampled are scaled by their sample rate when they're
+    aggregated.
+
+    Aggregated data is flushed when the process exits. You can also call
+    ``flush()`` to flush it yourself.
+
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        if "backend" not in options:
+            raise ValueError("AggregatingMetrics requires a backend option")
+
+        self.flush_interval = options.get("flush_interval", 10)
+        self.gauge_min_max = options.get("gauge_min_max", False)
+
+        self.backend = _build_backend(options["backend"])
+        self._copy = _filters_mutate(getattr(self.backend, "filters", None))
+
+        self._local = threading.local()
+        # List of (thread, buffer) tuples
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        # Orders gauge values across threads so we know which is the last one
+        self._sequence = itertools.count()
+
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return f"<AggregatingMetrics {self.backend!r}>"
+
+    def _get_buffer(self):
+        try:
+            return self._local.buffer
+        except AttributeError:
+            pass
+
+        buffer = self._local.buffer = _ThreadBuffer()
+        with self._buffers_lock:
+            self._buffers.append((threading.current_thread(), buffer))
+            if self._thread is None and not self._stop.is_set():
+                self._thread = threading.Thread(
+                    target=self._run, name="markus-aggregating", daemon=True
+                )
+                self._thread.start()
+        return buffer
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Exception thrown while flushing")
+
+    def emit(self, record):
+        stat_type = record.stat_type
+        if stat_type == "incr":
+            value = record.value
+            if record.sample_rate < 1:
+                value = value / record.sample_rate
+            key = (record.key, record.tags_tuple)
+
+            buffer = self._get_buffer()
+            with buffer.lock:
+                counters = buffer.counters
+                counters[key] = counters.get(key, 0) + value
+
+        elif stat_type == "gauge":
+            value = record.value
+            key = (record.key, record.tags_tuple)
+            sequence = next(self._sequence)
+
+            buffer = self._get_buffer()
+            with buffer.lock:
+                gauge = buffer.gauges.get(key)
+                if gauge is None:
+                    buffer.gauges[key] = [sequence, value, value, value]
+                else:
+                    gauge[0] = sequence
+                    gauge[1] = value
+                    if value < gauge[2]:
+                        gauge[2] = value
+                    if value > gauge[3]:
+                        gauge[3] = value
+
+        else:
+            self.backend.emit_to_backend(record.__copy__() if self._copy else record)
+
+    def flush(self):
+        """Merge thread buffers, emit aggregated records, and flush the backend."""
+        with self._buffers_lock:
+            buffers = list(self._buffers)
+            # Drop buffers for threads that have ended; they get flushed below
+            # for the last time
+            self._buffers = [item for item in buffers if item[0].is_alive()]
+
+        counters = {}
+        gauges = {}
+        with self._flush_lock:
+            for _, buffer in buffers:
+                buffer_counters, buffer_gauges = buffer.swap()
+                for key, value in buffer_counters.items():
+                    counters[key] = counters.get(key, 0) + value
+                for key, gauge in buffer_gauges.items():
+                    merged = gauges.get(key)
+                    if merged is None:
+                        gauges[key] = gauge
+                    else:
+                        if gauge[0] > merged[0]:
+                            merged[0] = gauge[0]
+                            merged[1] = gauge[1]
+                        merged[2] = min(merged[2], gauge[2])
+                        merged[3] = max(merged[3], gauge[3])
+
+            records = []
+            for (key, tags), value in counters.items():
+                records.append(MetricsRecord("incr", key, value, tags))
+            for (key, tags), (_, last, min_value, max_value) in gauges.items():
+                records.append(MetricsRecord("gauge", key, last, tags))
+                if self.gauge_min_max:
+                    records.append(
+                        MetricsRecord("gauge", key + ".min", min_value, tags)
+                    )
+                    records.append(
+                        MetricsRecord("gauge", key + ".max", max_value, tags)
+                    )
+
+            if records:
+                self.backend.emit_batch_to_backend(records)
+
+        self.backend.flush()
+
+    def before_fork(self):
+        self.flush()
+        self.backend.before_fork()
+
+    def after_fork_child(self):
+        # NOTE: the parent flushes what's aggregated, so the child
+        # starts with empty buffers and starts its own flusher thread when it
+        # needs one
+        self._local = threading.local()
+        self._buffers = []
+        self._buffers_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if not self._stop.is_set():
+            self._stop = threading.Event()
+        self._thread = None
+        self.backend.after_fork_child()
+
+    def close(self):
+        """Stop the flusher thread, flush aggregated data, and close the backend."""
+        self._stop.set()
+        with self._buffers_lock:
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+        self.backend.close()
+        atexit.unregister(self.close)
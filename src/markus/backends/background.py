@@ -0,0 +1,273 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+from collections import deque
+import logging
+import threading
+
+from markus.backends import BackendBase
+from markus.main import _build_backend, _filters_mutate
+
+
+logger = logging.getLogger(__name__)
+
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+BLOCK = "block"
+
+QUEUE_FULL_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class BackgroundMetrics(BackendBase):
+    """Wraps a backend and emits records to it in a background thread.
+
+    Records are added to a bounded queue. A worker thread takes records off the
+    queue and emits them to the wrapped backend in batches using
+    ``emit_batch``. This keeps slow backends from adding latency to the code
+    generating metrics.
+
+    To use, add this to your backends list::
+
+        {
+            "class": "markus.backends.background.BackgroundMetrics",
+            "options": {
+                "backend": {
+                    "class": "markus.backends.statsd.StatsdMetrics",
+                    "options": {
+                        "statsd_host": "statsd.example.com",
+                    },
+                },
+                "max_queue_size": 10000,
+                "queue_full_policy": "drop_oldest",
+            }
+        }
+
+    Options:
+
+    * ``backend``: the configuration for the backend to wrap
+
+      This is a dict just like the ones passed to :py:func:`markus.configure`.
+      It's required.
+
+    * ``max_queue_size``: the maximum number of records to queue
+
+      Defaults to ``10000``.
+
+    * ``queue_full_policy``: what to do when the queue is full
+
+      * ``"drop_oldest"``: drop the oldest record in the queue
+      * ``"drop_newest"``: drop the record being emitted
+      * ``"block"``: wait until there's room in the queue
+
+      Defaults to ``"drop_oldest"``.
+
+    * ``batch_size``: the maximum number of records to emit to the wrapped
+      backend at a time
+
+      Defaults to ``100``.
+
+    * ``flush_timeout``: the number of seconds to wait for queued records to
+      be emitted when closing
+
+      Defaults to ``5``.
+
+    The number of dropped records is in the ``dropped`` attribute.
+
+    Queued records are flushed when the process exits. You can also call
+    ``flush()`` or :py:func:`markus.flush` to emit queued records and flush
+    the wrapped backend, or ``close()`` to emit them and stop the worker
+    thread.
+
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        if "backend" not in options:
+            raise ValueError("BackgroundMetrics requires a backend option")
+
+        self.max_queue_size = options.get("max_queue_size", 10000)
+        self.queue_full_policy = options.get("queue_full_policy", DROP_OLDEST)
+        self.batch_size = options.get("batch_size", 100)
+        self.flush_timeout = options.get("flush_timeout", 5)
+
+        if self.queue_full_policy not in QUEUE_FULL_POLICIES:
+            raise ValueError(
+                f"queue_full_policy {self.queue_full_policy!r} is not one of "
+                + ", ".join(QUEUE_FULL_POLICIES)
+            )
+
+        self.backend = _build_backend(options["backend"])
+        # Records may be shared with other backends, so if the wrapped
+        # backend's filters change records, it needs its own copies
+        self._copy = _filters_mutate(getattr(self.backend, "filters", None))
+
+        self.dropped = 0
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        # Number of batches the worker thread has taken off the queue and not
+        # finished emitting
+        self._in_flight = 0
+        self._idle = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = None
+
+        atexit.register(self.close)
+
+    def __repr__(self):
+        return f"<BackgroundMetrics {self.backend!r}>"
+
+    def _start_thread(self):
+        self._thread = threading.Thread(
+            target=self._run, name="markus-background", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._closed:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return
+                batch = self._take_batch()
+                self._in_flight += 1
+
+            try:
+                self.backend.emit_batch_to_backend(batch)
+            except Exception:
+                logger.exception("Exception thrown while emitting records")
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._idle.notify_all()
+
+    def _take_batch(self):
+        """Take a batch of records off the queue.
+
+        This needs to be called with the lock held.
+
+        """
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popleft())
+        self._not_full.notify_all()
+        return batch
+
+    def _enqueue(self, records):
+        # Records that need to be emitted directly because the worker thread
+        # is gone
+        direct = []
+
+        with self._lock:
+            if self._thread is None and not self._closed:
+                self._start_thread()
+
+            for record in records:
+                if self._copy:
+                    record = record.__copy__()
+
+                if self._closed:
+                    direct.append(record)
+                    continue
+
+                if len(self._queue) >= self.max_queue_size:
+                    if self.queue_full_policy == DROP_NEWEST:
+                        self.dropped += 1
+                        continue
+                    elif self.queue_full_policy == DROP_OLDEST:
+                        self._queue.popleft()
+                        self.dropped += 1
+                    else:
+                        # Wake the worker up so it can make room
+                        self._not_empty.notify()
+                        while (
+                            len(self._queue) >= self.max_queue_size and not self._closed
+                        ):
+                            self._not_full.wait()
+                        if self._closed:
+                            direct.append(record)
+                            continue
+
+                self._queue.append(record)
+
+            self._not_empty.notify()
+
+        if direct:
+            self.backend.emit_batch_to_backend(direct)
+
+    def emit(self, record):
+        self._enqueue((record,))
+
+    def emit_batch(self, records):
+        self._enqueue(records)
+
+    def flush(self):
+        """Emit queued records and flush the wrapped backend.
+
+        Queued records are emitted in the calling thread. If the worker thread
+        is in the middle of emitting a batch, this waits up to
+        ``flush_timeout`` seconds for it to finish before flushing the wrapped
+        backend.
+
+        """
+        while True:
+            with self._lock:
+                batch = self._take_batch()
+            if not batch:
+                break
+            try:
+                self.backend.emit_batch_to_backend(batch)
+            except Exception:
+                logger.exception("Exception thrown while emitting records")
+
+        with self._lock:
+            if not self._idle.wait_for(lambda: not self._in_flight, self.flush_timeout):
+                logger.warning("BackgroundMetrics timed out waiting for worker")
+
+        self.backend.flush()
+
+    def before_fork(self):
+        self.backend.before_fork()
+
+    def after_fork_child(self):
+        # NOTE: the parent's worker thread emits what's in the queue,
+        # so the child starts with an empty queue and starts its own worker
+        # thread when it needs one
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._idle = threading.Condition(self._lock)
+        self._thread = None
+        self.dropped = 0
+        self.backend.after_fork_child()
+
+    def close(self):
+        """Emit queued records, stop the worker thread, and close the backend."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+            thread = self._thread
+
+        if thread is not None:
+            thread.join(self.flush_timeout)
+            if thread.is_alive():
+                logger.warning(
+                    "BackgroundMetrics timed out emitting %d queued records",
+                    len(self._queue),
+                )
+
+        self.backend.close()
+        atexit.unregister(self.close)
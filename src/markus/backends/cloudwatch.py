@@ -2,9 +2,37 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import atexit
+from functools import lru_cache
+import json
+import sys
+import threading
 import time
 
-from markus.backends import BackendBase
+from markus.backends import WIRE_CACHE_SIZE, BackendBase
+
+
+STAT_TYPE_TO_KIND = {
+    "incr": "count",
+    "gauge": "gauge",
+    "timing": "histogram",
+    "histogram": "histogram",
+    "distribution": "histogram",
+}
+
+
+STAT_TYPE_TO_EMF_UNIT = {
+    "incr": "Count",
+    "gauge": "None",
+    "timing": "Milliseconds",
+    "histogram": "None",
+    "distribution": "None",
+}
+
+# Embedded Metric Format limits on the number of metrics in a document and the
+# number of values for a metric
+EMF_MAX_METRICS = 100
+EMF_MAX_VALUES = 100
 
 
 class CloudwatchMetrics(BackendBase):
@@ -26,13 +54,60 @@ class CloudwatchMetrics(BackendBase):
             "class": "markus.backends.cloudwatch.CloudwatchMetrics",
         }
 
-    This backend doesn"t take any options.
+    Options:
+
+    * ``format``: the format to write metrics in
+
+      * ``"log"``: one line per metric in the format above
+      * ``"emf"``: CloudWatch Embedded Metric Format JSON documents
+
+      Defaults to ``"log"``.
+
+    * ``buffered``: whether to buffer metrics and write them all at once when
+      flushed rather than one at a time
+
+      Defaults to ``False``.
+
+    * ``max_buffer_size``: when buffering, the number of metrics that triggers
+      a flush
+
+      Defaults to ``1000``.
+
+    * ``emf_namespace``: the CloudWatch namespace for metrics in Embedded
+      Metric Format documents
+
+      Defaults to ``"markus"``.
+
+    * ``wire_cache_size``: the maximum number of formatted key and tags
+      combinations to cache
+
+      Defaults to ``1000``.
+
+    When buffering, metrics are written with a single write to stdout when the
+    buffer is full, when :py:func:`markus.flush` is called, and when the
+    process exits. In an AWS Lambda function, call :py:func:`markus.flush` at
+    the end of each invocation.
+
+    In ``"emf"`` format, metrics are always buffered. When flushed, metrics
+    with the same tags are written as one JSON document. Tags become dimensions;
+    ``"key:value"`` tags become a ``key`` dimension with value ``value`` and
+    tags without a value get the value ``"true"``. ``incr`` values are summed.
+    Other values are collected into a list. A document has at most 100 metrics
+    and 100 values per metric; metrics beyond that go in additional documents.
+
+    Neither format has a place for sample rates, so in both formats, values for
+    sampled ``incr`` metrics are divided by the sample rate. Values for other
+    sampled metrics are written as is.
+
+    The metric type, key, and tags for a record are formatted once and cached,
+    so emitting a record only has to format the timestamp and value. Use
+    ``wire_cache_info()`` to see whether the cache is big enough.
 
     .. Note::
 
        Datadog's Cloudwatch through Lambda logs supports four metrics types:
-       count, gauge, histogram, and check. Thus all timing metrics are treated
-       as histogram metrics.
+       count, gauge, histogram, and check. Thus all timing and distribution
+       metrics are treated as histogram metrics.
 
     .. seealso::
 
@@ -40,22 +115,187 @@ class CloudwatchMetrics(BackendBase):
 
        https://docs.datadoghq.com/developers/metrics/#metric-names
 
+       https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
     """
 
-    def emit(self, record):
-        stat_type_to_kind = {
-            "incr": "count",
-            "gauge": "gauge",
-            "timing": "histogram",
-            "histogram": "histogram",
-        }
-        print(
-            "MONITORING|%(timestamp)s|%(value)s|%(kind)s|%(stat)s|%(tags)s"
-            % {
-                "timestamp": int(time.time()),
-                "kind": stat_type_to_kind[record.stat_type],
-                "stat": record.key,
-                "value": record.value,
-                "tags": ("#%s" % ",".join(record.tags)) if record.tags else "",
-            }
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        self.format = options.get("format", "log")
+        self.buffered = options.get("buffered", False) or self.format == "emf"
+        self.max_buffer_size = options.get("max_buffer_size", 1000)
+        self.emf_namespace = options.get("emf_namespace", "markus")
+        self.wire_cache_size = options.get("wire_cache_size", WIRE_CACHE_SIZE)
+
+        if self.format not in ("log", "emf"):
+            raise ValueError(f"format {self.format!r} is not one of log, emf")
+
+        # Cache of (stat_type, key, tags) -> line format string
+        self._wire_format = lru_cache(maxsize=self.wire_cache_size)(
+            self._build_wire_format
         )
+
+        self._lock = threading.Lock()
+        # Number of buffered metrics
+        self._buffer_size = 0
+        # Buffered lines for "log" format
+        self._lines = []
+        # Buffered values for "emf" format: tags -> key -> [stat_type, values]
+        self._emf = {}
+
+        if self.buffered:
+            atexit.register(self.flush)
+
+    def _build_wire_format(self, stat_type, key, tags):
+        # NOTE: this builds a format string for the line with a %s for
+        # the timestamp and the value, so everything else gets escaped
+        return "MONITORING|%%s|%%s|%s|%s|%s" % (
+            STAT_TYPE_TO_KIND[stat_type],
+            key.replace("%", "%%"),
+            ("#%s" % ",".join(tags).replace("%", "%%")) if tags else "",
+        )
+
+    def wire_cache_info(self):
+        """Return hits and misses for the formatted key and tags cache.
+
+        If the number of misses keeps going up, there are more key and tags
+        combinations than fit in the cache. Either increase
+        ``wire_cache_size`` or look for tags with unbounded values.
+
+        :returns: a ``CacheInfo`` named tuple with ``hits``, ``misses``,
+            ``maxsize``, and ``currsize``
+
+        """
+        return self._wire_format.cache_info()
+
+    def _format(self, record, timestamp):
+        line = self._wire_format(record.stat_type, record.key, record.tags_tuple)
+        value = record.value
+        if record.sample_rate < 1 and record.stat_type == "incr":
+            value = value / record.sample_rate
+        return line % (timestamp, value)
+
+    def _add_emf(self, record):
+        """Add a record to the Embedded Metric Format buffer.
+
+        This needs to be called with the lock held.
+
+        """
+        metrics = self._emf.get(record.tags_tuple)
+        if metrics is None:
+            metrics = self._emf[record.tags_tuple] = {}
+
+        value = record.value
+        entry = metrics.get(record.key)
+        if record.stat_type == "incr":
+            if record.sample_rate < 1:
+                value = value / record.sample_rate
+            if entry is None:
+                metrics[record.key] = ["incr", [value]]
+            else:
+                entry[1][0] += value
+        elif entry is None:
+            metrics[record.key] = [record.stat_type, [value]]
+        else:
+            entry[1].append(value)
+
+    def _build_emf_documents(self, emf, timestamp):
+        documents = []
+        for tags, metrics in emf.items():
+            dimensions = {}
+            for tag in tags:
+                name, _, value = tag.partition(":")
+                dimensions[name] = value or "true"
+
+            keys = list(metrics)
+            for start in range(0, len(keys), EMF_MAX_METRICS):
+                chunk = keys[start : start + EMF_MAX_METRICS]
+                longest = max(len(metrics[key][1]) for key in chunk)
+                for offset in range(0, longest, EMF_MAX_VALUES):
+                    document = dict(dimensions)
+                    definitions = []
+                    for key in chunk:
+                        stat_type, values = metrics[key]
+                        values = values[offset : offset + EMF_MAX_VALUES]
+                        if not values:
+                            continue
+                        definitions.append(
+                            {"Name": key, "Unit": STAT_TYPE_TO_EMF_UNIT[stat_type]}
+                        )
+                        document[key] = values[0] if len(values) == 1 else values
+                    document["_aws"] = {
+                        "Timestamp": timestamp,
+                        "CloudWatchMetrics": [
+                            {
+                                "Namespace": self.emf_namespace,
+                                "Dimensions": [list(dimensions)],
+                                "Metrics": definitions,
+                            }
+                        ],
+                    }
+                    documents.append(json.dumps(document, separators=(",", ":")))
+        return documents
+
+    def _write(self, lines):
+        out = sys.stdout
+        out.write("\n".join(lines) + "\n")
+        out.flush()
+
+    def emit(self, record):
+        if not self.buffered:
+            print(self._format(record, int(time.time())))
+            return
+
+        self.emit_batch((record,))
+
+    def emit_batch(self, records):
+        if not self.buffered:
+            timestamp = int(time.time())
+            self._write([self._format(record, timestamp) for record in records])
+            return
+
+        with self._lock:
+            if self.format == "emf":
+                for record in records:
+                    self._add_emf(record)
+            else:
+                timestamp = int(time.time())
+                self._lines.extend(
+                    [self._format(record, timestamp) for record in records]
+                )
+            self._buffer_size += len(records)
+            full = self._buffer_size >= self.max_buffer_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Write buffered metrics to stdout."""
+        with self._lock:
+            if not self._buffer_size:
+                return
+            lines, self._lines = self._lines, []
+            emf, self._emf = self._emf, {}
+            self._buffer_size = 0
+
+            if emf:
+                lines = self._build_emf_documents(emf, int(time.time() * 1000))
+            # NOTE: this writes with the lock held so flushes from
+            # different threads don't interleave
+            self._write(lines)
+
+    def close(self):
+        """Write buffered metrics to stdout."""
+        self.flush()
+        if self.buffered:
+            atexit.unregister(self.flush)
+
+    def after_fork_child(self):
+        # NOTE: the parent writes what's buffered, so the child starts
+        # with an empty buffer
+        self._lock = threading.Lock()
+        self._buffer_size = 0
+        self._lines = []
+        self._emf = {}
@@ -52,6 +52,27 @@ class DatadogMetrics(BackendBase):
 
       Defaults to ``False``.
 
+    * statsd_socket_path: the path to a Unix domain socket for the DogStatsD
+      agent; if this is set, ``statsd_host`` and ``statsd_port`` are ignored
+
+      Defaults to ``None``.
+
+    * statsd_socket_type: the type of Unix domain socket, either ``"dgram"``
+      or ``"stream"``
+
+      Defaults to ``"dgram"``.
+
+    The DogStatsd client reconnects to the socket if sending fails.
+
+    .. Note::
+
+       The DogStatsd client samples metrics again if it's given a sample rate,
+       so sample rates aren't sent. Instead, values for sampled ``incr``
+       metrics are divided by the sample rate. Values for other sampled
+       metrics are sent as is. Use
+       :py:class:`markus.backends.dogstatsd.DogStatsdMetrics` to send sample
+       rates to the agent.
+
     .. seealso::
 
        https://docs.datadoghq.com/developers/metrics/
@@ -66,13 +87,15 @@ class DatadogMetrics(BackendBase):
         self.port = options.get("statsd_port", 8125)
         self.namespace = options.get("statsd_namespace", "")
         self.origin_detection_enabled = options.get("origin_detection_enabled", False)
+        self.socket_path = options.get("statsd_socket_path")
+        self.socket_type = options.get("statsd_socket_type", "dgram")
 
-        self.client = self._get_client(
-            host=self.host,
-            port=self.port,
-            namespace=self.namespace,
-            origin_detection_enabled=self.origin_detection_enabled,
-        )
+        if self.socket_type not in ("dgram", "stream"):
+            raise ValueError(
+                f"statsd_socket_type {self.socket_type!r} is not one of dgram, stream"
+            )
+
+        self.client = self._build_client()
         logger.debug(
             "%s configured: %s:%s %s %s",
             self.__class__.__name__,
@@ -82,20 +105,65 @@ class DatadogMetrics(BackendBase):
             self.origin_detection_enabled,
         )
 
-    def _get_client(self, host, port, namespace, origin_detection_enabled):
+    def _build_client(self):
+        client_kwargs = {}
+        if self.socket_path:
+            # NOTE: the scheme tells the client which kind of socket to
+            # use rather than having it try both
+            scheme = "unixstream" if self.socket_type == "stream" else "unixgram"
+            client_kwargs["socket_path"] = f"{scheme}://{self.socket_path}"
+
+        return self._get_client(
+            host=self.host,
+            port=self.port,
+            namespace=self.namespace,
+            origin_detection_enabled=self.origin_detection_enabled,
+            **client_kwargs,
+        )
+
+    def _get_client(self, host, port, namespace, origin_detection_enabled, **kwargs):
         return DogStatsd(
             host=host,
             port=port,
             namespace=namespace,
             origin_detection_enabled=origin_detection_enabled,
+            **kwargs,
         )
 
     def emit(self, record):
+        value = record.value
+        if record.sample_rate < 1 and record.stat_type == "incr":
+            # NOTE: the client samples again if it's given a sample rate, so
+            # this scales the count instead
+            value = value / record.sample_rate
+
         stat_type_to_fun = {
             "incr": self.client.increment,
             "gauge": self.client.gauge,
             "timing": self.client.timing,
             "histogram": self.client.histogram,
+            "distribution": self.client.distribution,
         }
         metrics_fun = stat_type_to_fun[record.stat_type]
-        metrics_fun(metric=record.key, value=record.value, tags=record.tags)
+        metrics_fun(metric=record.key, value=value, tags=record.tags)
+
+    def emit_batch(self, records):
+        # NOTE: using the client as a context manager buffers stats and
+        # sends them in as few packets as possible when it exits
+        with self.client:
+            for record in records:
+                self.emit(record)
+
+    def after_fork_child(self):
+        # NOTE: the client's socket belongs to the parent, so the child
+        # gets its own client
+        if hasattr(self.client, "close_socket"):
+            self.client.close_socket()
+        self.client = self._build_client()
+
+    def close(self):
+        """Stop the client and close its socket."""
+        if hasattr(self.client, "stop"):
+            self.client.stop()
+        elif hasattr(self.client, "close_socket"):
+            self.client.close_socket()
@@ -0,0 +1,763 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import atexit
+from collections import deque
+from functools import lru_cache
+import logging
+import socket
+import threading
+
+from markus.backends import WIRE_CACHE_SIZE, BackendBase
+
+
+logger = logging.getLogger(__name__)
+
+
+# Map of markus stat type -> DogStatsD metric type
+STAT_TYPE_TO_METRIC_TYPE = {
+    "incr": "c",
+    "gauge": "g",
+    "timing": "ms",
+    "histogram": "h",
+    "distribution": "d",
+}
+
+# Stat types whose values can be collected and sent as one line with multiple
+# values
+AGGREGATED_STAT_TYPES = {"timing", "histogram", "distribution"}
+
+
+class DogStatsdMetrics(BackendBase):
+    """Send metrics to a DogStatsD agent without needing the datadog library.
+
+    This serializes metrics in the DogStatsD format and packs as many as will
+    fit into each UDP packet. Packets are sent on a non-blocking socket. If the
+    socket buffer is full, the packet is dropped and counted rather than
+    holding up the code generating metrics.
+
+    To use, add this to your backends list::
+
+        {
+            "class": "markus.backends.dogstatsd.DogStatsdMetrics",
+            "options": {
+                "statsd_host": "localhost",
+                "statsd_port": 8125,
+                "statsd_namespace": "",
+            }
+        }
+
+    Options:
+
+    * ``statsd_host``: the hostname for the DogStatsD agent to send to
+
+      Defaults to ``"localhost"``.
+
+    * ``statsd_port``: the port for the DogStatsD agent to send to
+
+      Defaults to ``8125``.
+
+    * ``statsd_namespace``: the namespace to prefix all keys with
+
+      Defaults to ``""``.
+
+    * ``statsd_socket_path``: the path to a Unix domain socket to send to
+      instead of a host and port
+
+      Defaults to ``None``.
+
+    * ``statsd_socket_type``: the type of Unix domain socket
+
+      * ``"dgram"``: datagram socket; each packet is sent as a datagram
+      * ``"stream"``: stream socket; each packet is prefixed with its length
+        as a 32-bit little-endian integer
+
+      Defaults to ``"dgram"``.
+
+    * ``statsd_socket_timeout``: the number of seconds to wait when sending to
+      a stream socket before giving up and dropping the packet
+
+      Defaults to ``0.1``.
+
+    * ``max_packet_size``: the maximum size of a packet in bytes
+
+      Defaults to ``1432`` which fits in an Ethernet frame or ``8192`` when
+      using a Unix domain socket.
+
+    * ``flush_interval``: the number of seconds to buffer metrics before
+      sending them
+
+      If this is ``0``, metrics are sent when they're emitted; batches emitted
+      with ``emit_batch`` are still packed into as few packets as possible.
+
+      If this is more than ``0``, metrics are buffered and sent when the
+      packet is full or every ``flush_interval`` seconds, whichever comes
+      first.
+
+      Defaults to ``0``.
+
+    * ``wire_cache_size``: the maximum number of serialized key and tags
+      combinations to cache
+
+      Defaults to ``1000``.
+
+    * ``aggregate_values``: whether to collect ``timing``, ``histogram``, and
+      ``distribution`` values and send them as one line with multiple values
+
+      If this is ``True``, values for each combination of key and tags are
+      collected until metrics are flushed and then sent together, like
+      ``request_time:12.5:8.1:30.2|d|#env:prod``. Every value is still sent,
+      so percentiles computed by the agent are just as accurate, but it takes
+      a lot fewer packets. Sampled records are sent individually.
+
+      This works best with ``flush_interval`` more than ``0``. Otherwise,
+      values are only combined within batches emitted with ``emit_batch``.
+
+      This requires a Datadog Agent that supports DogStatsD protocol v1.1
+      (6.25.0/7.25.0 and later).
+
+      Defaults to ``False``.
+
+    * ``max_values``: the maximum number of values to collect for a
+      combination of key and tags before sending them
+
+      Defaults to ``1000``.
+
+    The key, metric type, and tags for a record are serialized once and cached,
+    so emitting a record only has to format the value. Use
+    ``wire_cache_info()`` to see whether the cache is big enough.
+
+    The number of packets sent and dropped are in the ``packets_sent`` and
+    ``packets_dropped`` attributes.
+
+    If sending fails because of a socket error, the packet is dropped and the
+    socket is reconnected for the next packet.
+
+    .. seealso::
+
+       https://docs.datadoghq.com/developers/dogstatsd/datagram_shell/
+
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        self.host = options.get("statsd_host", "localhost")
+        self.port = options.get("statsd_port", 8125)
+        self.namespace = options.get("statsd_namespace", "")
+        self.socket_path = options.get("statsd_socket_path")
+        self.socket_type = options.get("statsd_socket_type", "dgram")
+        self.socket_timeout = options.get("statsd_socket_timeout", 0.1)
+        self.max_packet_size = options.get(
+            "max_packet_size", 8192 if self.socket_path else 1432
+        )
+        self.flush_interval = options.get("flush_interval", 0)
+        self.wire_cache_size = options.get("wire_cache_size", WIRE_CACHE_SIZE)
+        self.aggregate_values = options.get("aggregate_values", False)
+        self.max_values = options.get("max_values", 1000)
+
+        if self.socket_type not in ("dgram", "stream"):
+            raise ValueError(
+                f"statsd_socket_type {self.socket_type!r} is not one of dgram, stream"
+            )
+
+        self._prefix = f"{self.namespace}." if self.namespace else ""
+        # Cache of (stat_type, key, tags) -> line format string
+        self._wire_format = lru_cache(maxsize=self.wire_cache_size)(
+            self._build_wire_format
+        )
+
+        self.packets_sent = 0
+        self.packets_dropped = 0
+
+        self._sock = None
+        self._lock = threading.Lock()
+        self._buffer = bytearray(self.max_packet_size)
+        self._view = memoryview(self._buffer)
+        self._buffer_len = 0
+        # Map of (stat_type, key, tags) -> values waiting to be sent
+        self._values = {}
+
+        self._stop = threading.Event()
+        self._thread = None
+        if self.flush_interval > 0:
+            self._start_thread()
+            atexit.register(self.close)
+
+        logger.debug(
+            "%s configured: %s %s",
+            self.__class__.__name__,
+            self._address(),
+            self.namespace,
+        )
+
+    def __repr__(self):
+        return f"<DogStatsdMetrics {self._address()}>"
+
+    def _start_thread(self):
+        self._thread = threading.Thread(
+            target=self._run, name="markus-dogstatsd", daemon=True
+        )
+        self._thread.start()
+
+    def _address(self):
+        if self.socket_path:
+            return f"unix{self.socket_type}://{self.socket_path}"
+        return f"{self.host}:{self.port}"
+
+    def _get_socket(self):
+        if self._sock is None:
+            if self.socket_path:
+                if self.socket_type == "stream":
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    sock.settimeout(self.socket_timeout)
+                else:
+                    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                    sock.setblocking(False)
+                address = self.socket_path
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                sock.setblocking(False)
+                address = (self.host, self.port)
+
+            try:
+                sock.connect(address)
+            except OSError:
+                sock.close()
+                raise
+            self._sock = sock
+        return self._sock
+
+    def _send(self, data):
+        """Send a single packet.
+
+        This needs to be called with the lock held.
+
+        """
+        try:
+            sock = self._get_socket()
+            if self.socket_type == "stream" and self.socket_path:
+                sock.sendall(len(data).to_bytes(4, "little") + data)
+            else:
+                sock.send(data)
+            self.packets_sent += 1
+        except BlockingIOError:
+            # The socket buffer is full, so we drop the packet
+            self.packets_dropped += 1
+        except OSError:
+            logger.debug("Exception thrown while sending packet", exc_info=True)
+            self.packets_dropped += 1
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+
+    def _flush(self):
+        """Send buffered lines.
+
+        This needs to be called with the lock held.
+
+        """
+        if self._buffer_len:
+            self._send(self._view[: self._buffer_len])
+            self._buffer_len = 0
+
+    def _write(self, line):
+        """Add a line to the packet buffer; send the packet if it's full.
+
+        This needs to be called with the lock held.
+
+        """
+        size = len(line)
+        length = self._buffer_len
+        if length:
+            if length + 1 + size > self.max_packet_size:
+                self._flush()
+                length = 0
+            else:
+                self._buffer[length] = 10  # b"\n"
+                length += 1
+
+        if size > self.max_packet_size:
+            # This line doesn't fit in a packet, so send it on its own and
+            # let the network stack sort it out
+            self._send(line)
+            return
+
+        self._buffer[length : length + size] = line
+        self._buffer_len = length + size
+
+    def _build_wire_format(self, stat_type, key, tags):
+        # NOTE: this builds a format string for the line with a %s for
+        # the value, so everything else gets escaped
+        line = "%s%s:%%s|%s" % (
+            self._prefix.replace("%", "%%"),
+            key.replace("%", "%%"),
+            STAT_TYPE_TO_METRIC_TYPE[stat_type],
+        )
+        if tags:
+            line = "%s|#%s" % (line, ",".join(tags).replace("%", "%%"))
+        return line
+
+    def wire_cache_info(self):
+        """Return hits and misses for the serialized key and tags cache.
+
+        If the number of misses keeps going up, there are more key and tags
+        combinations than fit in the cache. Either increase
+        ``wire_cache_size`` or look for tags with unbounded values.
+
+        :returns: a ``CacheInfo`` named tuple with ``hits``, ``misses``,
+            ``maxsize``, and ``currsize``
+
+        """
+        return self._wire_format.cache_info()
+
+    def _serialize(self, record):
+        if record.sample_rate >= 1:
+            line = self._wire_format(record.stat_type, record.key, record.tags_tuple)
+            return (line % (record.value,)).encode("utf-8")
+
+        # NOTE: the sample rate goes between the type and the tags and
+        # sampled records are rare, so they skip the cache
+        line = "%s%s:%s|%s|@%s" % (
+            self._prefix,
+            record.key,
+            record.value,
+            STAT_TYPE_TO_METRIC_TYPE[record.stat_type],
+            record.sample_rate,
+        )
+        tags = record.tags_tuple
+        if tags:
+            line = "%s|#%s" % (line, ",".join(tags))
+        return line.encode("utf-8")
+
+    def _is_aggregated(self, record):
+        return (
+            self.aggregate_values
+            and record.stat_type in AGGREGATED_STAT_TYPES
+            and record.sample_rate >= 1
+        )
+
+    def _value_lines(self, key, values):
+        """Return serialized lines with as many values as fit in a packet."""
+        line_format = self._wire_format(*key)
+        overhead = len((line_format % ("",)).encode("utf-8"))
+        lines = []
+        parts = []
+        size = overhead
+        for value in values:
+            part = str(value)
+            if parts and size + 1 + len(part) > self.max_packet_size:
+                lines.append((line_format % (":".join(parts),)).encode("utf-8"))
+                parts = []
+                size = overhead
+            size += len(part) + (1 if parts else 0)
+            parts.append(part)
+        lines.append((line_format % (":".join(parts),)).encode("utf-8"))
+        return lines
+
+    def _add_value(self, record):
+        """Collect a record's value.
+
+        This needs to be called with the lock held.
+
+        :returns: serialized lines to send if the key and tags have
+            ``max_values`` values; otherwise ``None``
+
+        """
+        key = (record.stat_type, record.key, record.tags_tuple)
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = []
+        values.append(record.value)
+        if len(values) >= self.max_values:
+            del self._values[key]
+            return self._value_lines(key, values)
+        return None
+
+    def _flush_values(self):
+        """Add collected values to the packet buffer.
+
+        This needs to be called with the lock held.
+
+        """
+        values, self._values = self._values, {}
+        for key, key_values in values.items():
+            for line in self._value_lines(key, key_values):
+                self._write(line)
+
+    def emit(self, record):
+        if self._is_aggregated(record):
+            with self._lock:
+                lines = self._add_value(record)
+                if lines:
+                    for line in lines:
+                        self._write(line)
+                if self._thread is None:
+                    self._flush_values()
+                    self._flush()
+            return
+
+        line = self._serialize(record)
+        with self._lock:
+            self._write(line)
+            if self._thread is None:
+                self._flush()
+
+    def emit_batch(self, records):
+        lines = []
+        aggregated = []
+        for record in records:
+            if self._is_aggregated(record):
+                aggregated.append(record)
+            else:
+                lines.append(self._serialize(record))
+        with self._lock:
+            for record in aggregated:
+                lines.extend(self._add_value(record) or ())
+            for line in lines:
+                self._write(line)
+            if self._thread is None:
+                self._flush_values()
+                self._flush()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            with self._lock:
+                self._flush_values()
+                self._flush()
+
+    def flush(self):
+        """Send any buffered metrics."""
+        with self._lock:
+            self._flush_values()
+            self._flush()
+
+    def after_fork_child(self):
+        # NOTE: the parent sends what's in the buffer and owns the
+        # socket, so the child starts fresh
+        self._lock = threading.Lock()
+        self._buffer_len = 0
+        self._values = {}
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        if self._thread is not None and not self._stop.is_set():
+            self._stop = threading.Event()
+            self._start_thread()
+
+    def close(self):
+        """Send any buffered metrics and close the socket."""
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._lock:
+            self._flush_values()
+            self._flush()
+            if self._sock is not None:
+                self._sock.close()
+                self._sock = None
+        atexit.unregister(self.close)
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    """Protocol that tracks whether the transport's buffer is full."""
+
+    def __init__(self):
+        self.paused = False
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+
+class AsyncioDogStatsdMetrics(DogStatsdMetrics):
+    """Send metrics to a DogStatsD agent from an asyncio event loop.
+
+    This is like :py:class:`markus.backends.dogstatsd.DogStatsdMetrics`, but
+    it sends packets with an asyncio datagram transport, so sending never
+    blocks the event loop.
+
+    Records emitted while the event loop is running are buffered and sent
+    together in as few packets as possible on the next pass through the event
+    loop. Records emitted from other threads are queued and handed to the
+    event loop to send.
+
+    To use, add this to your backends list::
+
+        {
+            "class": "markus.backends.dogstatsd.AsyncioDogStatsdMetrics",
+            "options": {
+                "statsd_host": "localhost",
+                "statsd_port": 8125,
+                "statsd_namespace": "",
+            }
+        }
+
+    Options:
+
+    * ``statsd_host``, ``statsd_port``, ``statsd_namespace``,
+      ``statsd_socket_path``, ``max_packet_size``, ``wire_cache_size``,
+      ``aggregate_values``, and ``max_values``: same as
+      :py:class:`markus.backends.dogstatsd.DogStatsdMetrics`
+
+      Unix domain sockets have to be datagram sockets.
+
+    * ``flush_interval``: the number of seconds to buffer metrics before
+      sending them
+
+      If this is ``0``, metrics are sent on the next pass through the event
+      loop.
+
+      Defaults to ``0``.
+
+    * ``max_queue_size``: the maximum number of records to hold while waiting
+      for the event loop to send them
+
+      Records emitted after that are dropped and counted in the
+      ``records_dropped`` attribute.
+
+      Defaults to ``10000``.
+
+    The backend uses the event loop running in the thread that emits the
+    first record. Records emitted before then are queued. If that event loop
+    is closed, the backend switches to the next running event loop that emits
+    a record.
+
+    If the transport's buffer is full, packets are dropped and counted in the
+    ``packets_dropped`` attribute rather than buffering more.
+
+    Call ``close()`` on the event loop before closing the event loop so the
+    transport gets closed.
+
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = dict(options or {})
+        flush_interval = options.pop("flush_interval", 0)
+        self.max_queue_size = options.pop("max_queue_size", 10000)
+        super().__init__(options=options, filters=filters)
+        self.flush_interval = flush_interval
+
+        if self.socket_path and self.socket_type != "dgram":
+            raise ValueError("statsd_socket_type must be dgram")
+
+        self._reset()
+
+    def __repr__(self):
+        return f"<AsyncioDogStatsdMetrics {self._address()}>"
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._buffer_len = 0
+        self._values = {}
+        # Serialized lines waiting for the event loop to send them
+        self._pending = deque()
+        self._scheduled = False
+        self._loop = None
+        self._transport = None
+        self._protocol = None
+        self._connect_task = None
+        self.packets_sent = 0
+        self.packets_dropped = 0
+        self.records_dropped = 0
+
+    def _bind(self, loop):
+        """Start using loop; this needs to be called with the lock held."""
+        if self._transport is not None:
+            try:
+                self._transport.close()
+            except RuntimeError:
+                # NOTE: the old loop is closed, so the transport can't
+                # finish closing
+                logger.debug("Transport's event loop is closed", exc_info=True)
+        self._loop = loop
+        self._transport = None
+        self._connect_task = loop.create_task(self._connect())
+        self._scheduled = False
+
+    async def _connect(self):
+        loop = self._loop
+        try:
+            if self.socket_path:
+                transport, protocol = await loop.create_datagram_endpoint(
+                    _DatagramProtocol,
+                    remote_addr=self.socket_path,
+                    family=socket.AF_UNIX,
+                )
+            else:
+                transport, protocol = await loop.create_datagram_endpoint(
+                    _DatagramProtocol, remote_addr=(self.host, self.port)
+                )
+        except OSError:
+            logger.debug("Exception thrown while connecting", exc_info=True)
+            with self._lock:
+                self._connect_task = None
+                self.records_dropped += len(self._pending) + sum(
+                    len(values) for values in self._values.values()
+                )
+                self._pending.clear()
+                self._values = {}
+            return
+
+        with self._lock:
+            if loop is not self._loop:
+                transport.close()
+                return
+            self._transport = transport
+            self._protocol = protocol
+            self._connect_task = None
+            if not (self._pending or self._values) or self._scheduled:
+                return
+            self._scheduled = True
+        self._schedule()
+
+    def _send(self, data):
+        """Send a single packet.
+
+        This needs to be called on the event loop with the lock held.
+
+        """
+        if self._protocol.paused:
+            self.packets_dropped += 1
+            return
+        self._transport.sendto(bytes(data))
+        self.packets_sent += 1
+
+    def _send_pending(self):
+        """Send queued lines; this needs to be called on the event loop."""
+        with self._lock:
+            self._scheduled = False
+            transport = self._transport
+            if transport is None or transport.is_closing():
+                self._transport = None
+                if self._connect_task is None and (self._pending or self._values):
+                    self._connect_task = self._loop.create_task(self._connect())
+                return
+
+            pending = self._pending
+            while pending:
+                self._write(pending.popleft())
+            self._flush_values()
+            self._flush()
+
+    def _schedule(self):
+        """Schedule sending queued lines; this needs to be called on the loop."""
+        if self.flush_interval > 0:
+            self._loop.call_later(self.flush_interval, self._send_pending)
+        else:
+            self._loop.call_soon(self._send_pending)
+
+    def _enqueue(self, lines, aggregated=()):
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        with self._lock:
+            loop = self._loop
+            if running is not None and (loop is None or loop.is_closed()):
+                self._bind(running)
+                loop = running
+
+            for record in aggregated:
+                lines.extend(self._add_value(record) or ())
+            if len(self._pending) + len(lines) > self.max_queue_size:
+                self.records_dropped += len(lines)
+                return
+            self._pending.extend(lines)
+
+            if loop is None or self._scheduled:
+                return
+            self._scheduled = True
+
+        if loop is running:
+            self._schedule()
+            return
+
+        try:
+            loop.call_soon_threadsafe(self._schedule)
+        except RuntimeError:
+            # The loop was closed; the lines wait for the next running loop
+            with self._lock:
+                self._scheduled = False
+
+    def emit(self, record):
+        if self._is_aggregated(record):
+            self._enqueue([], [record])
+        else:
+            self._enqueue([self._serialize(record)])
+
+    def emit_batch(self, records):
+        lines = []
+        aggregated = []
+        for record in records:
+            if self._is_aggregated(record):
+                aggregated.append(record)
+            else:
+                lines.append(self._serialize(record))
+        self._enqueue(lines, aggregated)
+
+    def flush(self):
+        """Send any queued metrics.
+
+        If this is called on the event loop, they're sent now. Otherwise, the
+        event loop is asked to send them.
+
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if loop is running:
+            self._send_pending()
+        else:
+            try:
+                loop.call_soon_threadsafe(self._send_pending)
+            except RuntimeError:
+                pass
+
+    def after_fork_child(self):
+        # NOTE: the event loop and transport belong to the parent, so
+        # the child starts fresh with the next running event loop
+        self._reset()
+
+    def close(self):
+        """Send any queued metrics and close the transport.
+
+        If this isn't called on the event loop, the event loop is asked to do
+        it.
+
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if loop is running:
+            self._close()
+        else:
+            try:
+                loop.call_soon_threadsafe(self._close)
+            except RuntimeError:
+                pass
+
+    def _close(self):
+        self._send_pending()
+        with self._lock:
+            if self._transport is not None:
+                self._transport.close()
+                self._transport = None
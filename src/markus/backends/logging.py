@@ -3,17 +3,36 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import atexit
 import datetime
+from functools import lru_cache
 import logging
-import statistics
+import queue
+import threading
 import time
 
-from markus.backends import BackendBase
+from markus.backends import WIRE_CACHE_SIZE, BackendBase
+from markus.sketch import DDSketch
+
+
+logger = logging.getLogger(__name__)
 
 
 UTC = datetime.timezone.utc
 
 
+def _utc_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, tz=UTC).isoformat()
+
+
+def _local_timestamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat()
+
+
+# Sentinel that tells the LoggingMetrics worker thread to stop
+_STOP = object()
+
+
 class LoggingMetrics(BackendBase):
     """Metrics backend that publishes to Python logging.
 
@@ -46,6 +65,9 @@ class LoggingMetrics(BackendBase):
 
         METRICS|2017-03-06T11:30:00|histogram|foo|4321|#key1:val
 
+    Values for sampled ``incr`` metrics are divided by the sample rate, so
+    summing them gives the count for all calls.
+
     This will log at the ``logging.INFO`` level.
 
     Options:
@@ -69,6 +91,20 @@ class LoggingMetrics(BackendBase):
 
       Defaults to no timestamp.
 
+    * ``background``: whether to format and log metrics in a background
+      thread
+
+      If this is ``True``, emitting a metric adds it to a queue and a
+      background thread formats and logs it. Timestamps are still the time
+      the metric was emitted. This is like using a
+      :py:class:`logging.handlers.QueueHandler`, but the formatting happens in
+      the background thread, too.
+
+      Defaults to ``False``.
+
+    If the logger isn't enabled for ``logging.INFO``, emitting metrics does no
+    work.
+
     """
 
     def __init__(self, options=None, filters=None):
@@ -78,35 +114,131 @@ class LoggingMetrics(BackendBase):
         self.logger = logging.getLogger(self.logger_name)
         self.leader = options.get("leader", "METRICS")
         self.timestamp_mode = options.get("timestamp_mode", None)
+        self.background = options.get("background", False)
 
-        tmpl = [
-            "%(leader)s",
-            "%(kind)s",
-            "%(stat)s",
-            "%(value)s",
-            "%(tags)s",
-        ]
+        # NOTE: the template and the timestamp function are figured out
+        # once here so formatting a record doesn't do work it doesn't need
+        leader = self.leader.replace("%", "%%")
         if self.timestamp_mode == "utc":
-            tmpl.insert(1, "%(utc_timestamp)s")
+            self._timestamp = _utc_timestamp
         elif self.timestamp_mode == "local":
-            tmpl.insert(1, "%(local_timestamp)s")
-
-        self.tmpl = "|".join(tmpl)
+            self._timestamp = _local_timestamp
+        else:
+            self._timestamp = None
+
+        if self._timestamp is not None:
+            self._template = leader + "|%s|%s|%s|%s|%s"
+        else:
+            self._template = leader + "|%s|%s|%s|%s"
+
+        self._queue = None
+        self._thread = None
+        if self.background:
+            self._start_thread()
+            atexit.register(self.close)
+
+    def _start_thread(self):
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._queue,), name="markus-logging", daemon=True
+        )
+        self._thread.start()
+
+    def _format(self, record, timestamp):
+        tags = record.tags_tuple
+        tags = ("#%s" % ",".join(tags)) if tags else ""
+        value = record.value
+        if record.sample_rate < 1 and record.stat_type == "incr":
+            value = value / record.sample_rate
+        if self._timestamp is not None:
+            return self._template % (
+                self._timestamp(timestamp),
+                record.stat_type,
+                record.key,
+                value,
+                tags,
+            )
+        return self._template % (record.stat_type, record.key, value, tags)
 
-    def emit(self, record):
+    def _log(self, records, timestamp):
         self.logger.info(
-            self.tmpl
-            % {
-                "leader": self.leader,
-                "local_timestamp": datetime.datetime.now().isoformat(),
-                "utc_timestamp": datetime.datetime.now(tz=UTC).isoformat(),
-                "kind": record.stat_type,
-                "stat": record.key,
-                "value": record.value,
-                "tags": ("#%s" % ",".join(record.tags)) if record.tags else "",
-            }
+            "\n".join([self._format(record, timestamp) for record in records])
         )
 
+    def _run(self, work_queue):
+        while True:
+            item = work_queue.get()
+            if item is _STOP:
+                return
+            try:
+                self._log(*item)
+            except Exception:
+                logger.exception("Exception thrown while logging metrics")
+
+    def emit(self, record):
+        self.emit_batch((record,))
+
+    def emit_batch(self, records):
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+
+        timestamp = time.time() if self._timestamp is not None else None
+        work_queue = self._queue
+        if work_queue is not None:
+            work_queue.put((records, timestamp))
+        else:
+            self._log(records, timestamp)
+
+    def after_fork_child(self):
+        # NOTE: the parent's thread logs what's in the queue, so the
+        # child gets an empty queue and its own thread
+        if self._thread is not None:
+            self._start_thread()
+
+    def close(self):
+        """Stop the background thread after logging queued metrics.
+
+        Metrics emitted after this are logged in the thread emitting them.
+
+        """
+        if self._thread is None:
+            return
+        work_queue, self._queue = self._queue, None
+        work_queue.put(_STOP)
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        atexit.unregister(self.close)
+
+        # NOTE: log anything that was put on the queue after the thread
+        # stopped
+        while True:
+            try:
+                item = work_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                self._log(*item)
+
+
+class _Stripe:
+    """One lock-protected part of the LoggingRollupMetrics store."""
+
+    __slots__ = ("lock", "incr_stats", "gauge_stats", "histogram_stats")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Map of (key, tags) -> [count, sum]
+        self.incr_stats = {}
+        # Map of (key, tags) -> [count, current, min, max]
+        self.gauge_stats = {}
+        # Map of (key, tags) -> DDSketch
+        self.histogram_stats = {}
+
+
+# Number of stripes in the LoggingRollupMetrics store
+ROLLUP_STRIPES = 16
+
 
 class LoggingRollupMetrics(BackendBase):
     """Experimental logging backend for rolling up stats over a period.
@@ -124,15 +256,32 @@ class LoggingRollupMetrics(BackendBase):
 
     The :py:class:`markus.backends.logging.LoggingRollupMetrics` backend
     generates rollups every *flush_interval* of stats generated during that
-    period.
+    period. Periods are aligned to the wall clock, so with a *flush_interval* of
+    10 seconds, rollups happen at :00, :10, :20, and so on.
 
-    For incr stats, it shows count and rate.
+    Stats are rolled up for each combination of key and tags. Tags are sorted,
+    so the order they're passed in doesn't matter.
+
+    For incr stats, it shows count and rate. Sampled incr stats are scaled by
+    the sample rate, so they count as ``1 / sample_rate`` calls with
+    ``value / sample_rate`` each.
 
     For gauge stats, it shows count, current value, min value, and max value
     for the period.
 
-    For timing and histogram stats, it shows count, min, average, median, 95%,
-    and max for the period.
+    For timing, histogram, and distribution stats, it shows count, min,
+    average, the configured percentiles, and max for the period. For example::
+
+        ROLLUP HISTOGRAM save_time: count:2|min:50.00|avg:55.00|p50:50.00|p95:59.75|p99:59.75|max:60.00
+
+    Stats with tags have the tags after the key. For example::
+
+        ROLLUP INCR requests #env:prod,method:get: count:5|rate:5/10
+
+    Percentiles are computed with a :py:class:`markus.sketch.DDSketch`, so
+    memory doesn't grow with the number of values and percentiles are within
+    ``relative_accuracy`` of the real value. Count, min, average, and max are
+    exact.
 
     This will log at the ``logging.INFO`` level.
 
@@ -156,6 +305,41 @@ class LoggingRollupMetrics(BackendBase):
 
       Defaults to ``10`` seconds.
 
+    * ``background``: whether to generate rollups in a background thread
+
+      If this is ``True``, a background thread generates rollups at the end of
+      every period even if no stats are emitted and rolls up anything left when
+      the process exits.
+
+      If this is ``False``, rollups are generated when a stat is emitted after
+      the end of the period. A process that stops emitting stats won't
+      generate rollups and the next rollup covers everything since the last
+      one.
+
+      Defaults to ``False``.
+
+    * ``percentiles``: list of percentiles to show for timing, histogram, and
+      distribution stats
+
+      Each percentile is shown as ``p`` followed by the digits of the
+      percentile. For example, ``99.9`` is shown as ``p999``.
+
+      Defaults to ``[50, 95, 99]``.
+
+    * ``relative_accuracy``: relative accuracy of percentiles
+
+      Defaults to ``0.01``.
+
+    * ``max_bins``: maximum number of bins for each timing, histogram, and
+      distribution stat; this bounds memory used by each stat
+
+      Defaults to ``2048``.
+
+    Emitting stats and generating rollups is thread-safe. Stats are stored in
+    lock-protected stripes, so threads emitting different stats rarely wait on
+    each other and generating a rollup only holds a stripe's lock long enough
+    to swap out its stats.
+
     .. Note::
 
        This backend is experimental, probably has bugs, and may change over
@@ -170,84 +354,227 @@ class LoggingRollupMetrics(BackendBase):
         self.flush_interval = options.get("flush_interval", 10)
         self.logger_name = options.get("logger_name", "markus")
         self.leader = options.get("leader", "ROLLUP")
+        self.background = options.get("background", False)
+        self.percentiles = options.get("percentiles", [50, 95, 99])
+        self.relative_accuracy = options.get("relative_accuracy", 0.01)
+        self.max_bins = options.get("max_bins", 2048)
+
+        for percentile in self.percentiles:
+            if not 0 <= percentile <= 100:
+                raise ValueError(f"percentile {percentile!r} is not between 0 and 100")
+
+        self._percentile_labels = [
+            "p" + format(percentile, "g").replace(".", "")
+            for percentile in self.percentiles
+        ]
 
         self.logger = logging.getLogger(self.logger_name)
 
+        # Cache of tags -> formatted and sorted tags
+        self._format_tags = lru_cache(maxsize=WIRE_CACHE_SIZE)(self._build_tags)
+
+        self._reset()
+
+        self._stop = None
+        self._thread = None
+        if self.background:
+            self._start_thread()
+            atexit.register(self.close)
+
+    def _reset(self):
+        self._stripes = [_Stripe() for _ in range(ROLLUP_STRIPES)]
+
+        # Held while generating a rollup so rollups don't overlap
+        self._rollup_lock = threading.Lock()
+
         # Next time to rollup in seconds since epoch
-        self.next_rollup = time.time() + self.flush_interval
+        self.next_rollup = self._next_boundary(time.time())
 
-        # Map of key -> values list
-        self.incr_stats = {}
-        self.gauge_stats = {}
-        self.histogram_stats = {}
+    def _start_thread(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="markus-rollup", daemon=True
+        )
+        self._thread.start()
+
+    def _next_boundary(self, now):
+        """Return the end of the period that now is in."""
+        return (now // self.flush_interval + 1) * self.flush_interval
+
+    def _new_sketch(self):
+        return DDSketch(
+            relative_accuracy=self.relative_accuracy, max_bins=self.max_bins
+        )
+
+    def _build_tags(self, tags):
+        # NOTE: the tags part of the key is the formatted tags so the
+        # same tags in a different order roll up together
+        return " #%s" % ",".join(sorted(tags))
+
+    def _run(self):
+        while True:
+            # NOTE: this recomputes the wait every time around so that
+            # waking up early or the wall clock changing doesn't cause a rollup
+            # at the wrong time
+            remaining = self.next_rollup - time.time()
+            if remaining > 0:
+                if self._stop.wait(remaining):
+                    return
+                continue
+
+            try:
+                self.rollup()
+            except Exception:
+                logger.exception("Exception thrown while rolling up metrics")
+
+    def _collect(self):
+        """Swap out the stats in each stripe and return them.
+
+        Keys stay in the store so the next rollup can say they had no data.
+
+        """
+        incr_stats = []
+        gauge_stats = []
+        histogram_stats = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                incr, gauge, histogram = (
+                    stripe.incr_stats,
+                    stripe.gauge_stats,
+                    stripe.histogram_stats,
+                )
+                stripe.incr_stats = dict.fromkeys(incr, None)
+                stripe.gauge_stats = dict.fromkeys(gauge, None)
+                stripe.histogram_stats = dict.fromkeys(histogram, None)
+            incr_stats.extend(incr.items())
+            gauge_stats.extend(gauge.items())
+            histogram_stats.extend(histogram.items())
+
+        return sorted(incr_stats), sorted(gauge_stats), sorted(histogram_stats)
 
     def rollup(self):
-        """Roll up stats and log them."""
-        now = time.time()
-        if now < self.next_rollup:
+        """Roll up stats and log them if the period is over."""
+        if time.time() < self.next_rollup:
             return
 
-        self.next_rollup = now + self.flush_interval
+        with self._rollup_lock:
+            now = time.time()
+            if now < self.next_rollup:
+                # Another thread did the rollup already
+                return
+            self.next_rollup = self._next_boundary(now)
+            self._log_rollup()
+
+    def _log_rollup(self):
+        incr_stats, gauge_stats, histogram_stats = self._collect()
 
-        for key, values in sorted(self.incr_stats.items()):
+        for (key, tags), stat in incr_stats:
+            count, total = stat or (0, 0)
             self.logger.info(
-                "%s INCR %s: count:%d|rate:%d/%d",
+                "%s INCR %s%s: count:%d|rate:%d/%d",
                 self.leader,
                 key,
-                len(values),
-                sum(values),
+                tags,
+                count,
+                total,
                 self.flush_interval,
             )
-            self.incr_stats[key] = []
 
-        for key, values in sorted(self.gauge_stats.items()):
-            if values:
+        for (key, tags), gauge in gauge_stats:
+            if gauge is not None:
                 self.logger.info(
-                    "%s GAUGE %s: count:%d|current:%s|min:%s|max:%s",
+                    "%s GAUGE %s%s: count:%d|current:%s|min:%s|max:%s",
                     self.leader,
                     key,
-                    len(values),
-                    values[-1],
-                    min(values),
-                    max(values),
+                    tags,
+                    *gauge,
                 )
             else:
-                self.logger.info("%s (gauge) %s: no data", self.leader, key)
-
-            self.gauge_stats[key] = []
-
-        for key, values in sorted(self.histogram_stats.items()):
-            if values:
+                self.logger.info("%s (gauge) %s%s: no data", self.leader, key, tags)
+
+        for (key, tags), sketch in histogram_stats:
+            if sketch is not None:
+                percentiles = "".join(
+                    [
+                        "|%s:%.2f" % (label, sketch.quantile(percentile / 100))
+                        for label, percentile in zip(
+                            self._percentile_labels, self.percentiles
+                        )
+                    ]
+                )
                 self.logger.info(
-                    (
-                        "%s HISTOGRAM %s: "
-                        "count:%d|min:%.2f|avg:%.2f|median:%.2f|ninety-five:%.2f|max:%.2f"
-                    ),
+                    "%s HISTOGRAM %s%s: count:%d|min:%.2f|avg:%.2f%s|max:%.2f",
                     self.leader,
                     key,
-                    len(values),
-                    min(values),
-                    statistics.mean(values),
-                    statistics.median(values),
-                    values[int(len(values) * 95 / 100)],
-                    max(values),
+                    tags,
+                    sketch.count,
+                    sketch.min,
+                    sketch.avg,
+                    percentiles,
+                    sketch.max,
                 )
             else:
-                self.logger.info("%s (histogram) %s: no data", self.leader, key)
-
-            self.histogram_stats[key] = []
+                self.logger.info("%s (histogram) %s%s: no data", self.leader, key, tags)
 
     def emit(self, record):
-        stat_type_to_list = {
-            "incr": self.incr_stats,
-            "gauge": self.gauge_stats,
-            "timing": self.histogram_stats,
-            "histogram": self.histogram_stats,
-        }
+        if self._thread is None:
+            self.rollup()
+
+        stat_type = record.stat_type
+        value = record.value
+        tags = record.tags_tuple
+        key = (record.key, self._format_tags(tags) if tags else "")
+
+        count = 1
+        if stat_type == "incr" and record.sample_rate < 1:
+            # NOTE: a sampled record stands for 1/sample_rate calls
+            count = 1 / record.sample_rate
+            value = value / record.sample_rate
+
+        stripe = self._stripes[hash(key) % ROLLUP_STRIPES]
+        with stripe.lock:
+            if stat_type == "incr":
+                stat = stripe.incr_stats.get(key)
+                if stat is None:
+                    stripe.incr_stats[key] = [count, value]
+                else:
+                    stat[0] += count
+                    stat[1] += value
+
+            elif stat_type == "gauge":
+                gauge = stripe.gauge_stats.get(key)
+                if gauge is None:
+                    stripe.gauge_stats[key] = [1, value, value, value]
+                else:
+                    gauge[0] += 1
+                    gauge[1] = value
+                    if value < gauge[2]:
+                        gauge[2] = value
+                    if value > gauge[3]:
+                        gauge[3] = value
 
-        self.rollup()
-
-        # FIXME(willkg): what to do with tags?
-        stat_type_to_list[record.stat_type].setdefault(record.key, []).append(
-            record.value
-        )
+            else:
+                sketch = stripe.histogram_stats.get(key)
+                if sketch is None:
+                    sketch = stripe.histogram_stats[key] = self._new_sketch()
+                sketch.add(value)
+
+    def after_fork_child(self):
+        # NOTE: the parent rolls up the stats it has, so the child
+        # starts with none
+        self._reset()
+        if self._thread is not None:
+            self._start_thread()
+
+    def close(self):
+        """Stop the background thread and roll up what's left."""
+        if self._thread is None:
+            return
+        self._stop.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        atexit.unregister(self.close)
+
+        with self._rollup_lock:
+            self._log_rollup()
@@ -0,0 +1,351 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import atexit
+from bisect import bisect_left
+import glob
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from markus.backends import DEFAULT_BUCKETS, BackendBase
+
+
+logger = logging.getLogger(__name__)
+
+
+# Initial size of a process' file in bytes; files grow as needed
+INITIAL_FILE_SIZE = 1024 * 1024
+
+_HEADER = struct.Struct("i")
+_VALUE = struct.Struct("d")
+
+
+def _slot_key(stat_type, key, tags, slot):
+    return json.dumps([stat_type, key, tags, slot]).encode("utf-8")
+
+
+def _bucket_slot(bound):
+    return "le=" + repr(float(bound))
+
+
+class _MmapFile:
+    """File of named double-precision values that's mapped into memory.
+
+    The file starts with the number of bytes used. That's followed by
+    entries, each made up of the length of the name, the name, padding to an
+    8-byte boundary, and the value.
+
+    Only one process writes to a file. New entries are written before the
+    number of bytes used is updated, so readers never see a partial entry.
+    Values are 8 bytes and aligned, so readers never see a partial value.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self._file = open(path, "a+b")
+        self._capacity = os.fstat(self._file.fileno()).st_size
+        if self._capacity == 0:
+            self._capacity = INITIAL_FILE_SIZE
+            self._file.truncate(self._capacity)
+        self._mmap = mmap.mmap(self._file.fileno(), self._capacity)
+
+        # Map of name -> offset of value
+        self.positions = {}
+        self._used = _HEADER.unpack_from(self._mmap, 0)[0]
+        if self._used == 0:
+            self._used = 8
+            _HEADER.pack_into(self._mmap, 0, self._used)
+        else:
+            # NOTE: this file was left by a process with the same
+            # process id, so pick up where it left off
+            for name, _, offset in _read_entries(self._mmap):
+                self.positions[name] = offset
+
+    def _grow(self, size):
+        capacity = self._capacity
+        while capacity < size:
+            capacity *= 2
+        self._mmap.close()
+        self._file.truncate(capacity)
+        self._capacity = capacity
+        self._mmap = mmap.mmap(self._file.fileno(), capacity)
+
+    def offset(self, name):
+        """Return the offset of the value for name, adding it if it's new.
+
+        This needs to be called with the lock held.
+
+        """
+        offset = self.positions.get(name)
+        if offset is not None:
+            return offset
+
+        size = len(name)
+        # Length, name, and padding so the value is 8-byte aligned
+        padded = 4 + size + (8 - (4 + size) % 8) % 8
+        end = self._used + padded + 8
+        if end > self._capacity:
+            self._grow(end)
+
+        start = self._used
+        _HEADER.pack_into(self._mmap, start, size)
+        self._mmap[start + 4 : start + 4 + size] = name
+        offset = start + padded
+        _VALUE.pack_into(self._mmap, offset, 0.0)
+        self._used = end
+        _HEADER.pack_into(self._mmap, 0, end)
+        self.positions[name] = offset
+        return offset
+
+    def add(self, offset, amount):
+        """Add to the value at offset; needs to be called with the lock held."""
+        value = _VALUE.unpack_from(self._mmap, offset)[0] + amount
+        _VALUE.pack_into(self._mmap, offset, value)
+
+    def set(self, offset, value):
+        """Set the value at offset; needs to be called with the lock held."""
+        _VALUE.pack_into(self._mmap, offset, value)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+def _read_entries(data):
+    """Yield (name, value, offset) for each entry in a file's data."""
+    used = _HEADER.unpack_from(data, 0)[0]
+    pos = 8
+    while pos < used:
+        size = _HEADER.unpack_from(data, pos)[0]
+        name = bytes(data[pos + 4 : pos + 4 + size])
+        offset = pos + 4 + size + (8 - (4 + size) % 8) % 8
+        yield name, _VALUE.unpack_from(data, offset)[0], offset
+        pos = offset + 8
+
+
+# Map of path -> _MmapFile for files this process writes to; backends in
+# the same process that use the same directory share a file
+_files = {}
+_files_lock = threading.Lock()
+# Process id _files belongs to
+_files_pid = os.getpid()
+
+
+def _get_file(directory):
+    global _files_lock, _files_pid
+
+    pid = os.getpid()
+    if _files_pid != pid:
+        # NOTE: this is a child process; the files belong to the parent and a
+        # thread in the parent may have been holding the lock
+        _files_lock = threading.Lock()
+        for mmap_file in _files.values():
+            mmap_file.close()
+        _files.clear()
+        _files_pid = pid
+
+    path = os.path.join(directory, f"markus_{pid}.db")
+    with _files_lock:
+        mmap_file = _files.get(path)
+        if mmap_file is None:
+            if not _files:
+                atexit.register(_close_files)
+            mmap_file = _files[path] = _MmapFile(path)
+        return mmap_file
+
+
+def _close_files():
+    with _files_lock:
+        for mmap_file in _files.values():
+            mmap_file.close()
+        _files.clear()
+    atexit.unregister(_close_files)
+
+
+def collect(directory):
+    """Read and merge the metrics written by all processes to directory.
+
+    ``incr`` values are summed. For ``gauge`` values, the value set most
+    recently by any process wins. ``timing``, ``histogram``, and
+    ``distribution`` buckets, sums, and counts are summed.
+
+    :arg str directory: the directory
+        :py:class:`markus.backends.multiprocess.MultiprocessMetrics` writes to
+
+    :returns: dict of ``(stat_type, key, tags)`` to the value; ``tags`` is a
+        sorted tuple; for ``timing``, ``histogram``, and ``distribution``
+        stats, the value is a dict with ``"buckets"`` (a dict of upper bound
+        to count with ``float("inf")`` for values over the largest bound),
+        ``"sum"``, and ``"count"``
+
+    """
+    merged = {}
+    # Map of (stat_type, key, tags) -> time the gauge was set
+    gauge_times = {}
+
+    for path in sorted(glob.glob(os.path.join(directory, "markus_*.db"))):
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+        except OSError:
+            logger.warning("Exception thrown reading %s", path, exc_info=True)
+            continue
+        if len(data) < 8:
+            continue
+
+        gauges = {}
+        for name, value, _ in _read_entries(data):
+            stat_type, key, tags, slot = json.loads(name)
+            stat = (stat_type, key, tuple(tags))
+            if stat_type == "incr":
+                merged[stat] = merged.get(stat, 0) + value
+            elif stat_type == "gauge":
+                gauges.setdefault(stat, {})[slot] = value
+            else:
+                histogram = merged.get(stat)
+                if histogram is None:
+                    histogram = merged[stat] = {"buckets": {}, "sum": 0, "count": 0}
+                if slot.startswith("le="):
+                    bound = float(slot[3:])
+                    buckets = histogram["buckets"]
+                    buckets[bound] = buckets.get(bound, 0) + value
+                else:
+                    histogram[slot] += value
+
+        for stat, slots in gauges.items():
+            set_time = slots.get("time", 0)
+            if stat not in gauge_times or set_time >= gauge_times[stat]:
+                gauge_times[stat] = set_time
+                merged[stat] = slots.get("value", 0)
+
+    return merged
+
+
+class MultiprocessMetrics(BackendBase):
+    """Aggregate metrics across processes in memory-mapped files.
+
+    Under a pre-fork server like gunicorn, each worker process has its own
+    backends. This backend lets workers aggregate metrics together. Each
+    process adds its metrics to its own memory-mapped file in a shared
+    directory. A single collector process reads and merges all the files
+    with :py:func:`markus.backends.multiprocess.collect` and exports the
+    merged view. For example, with
+    :py:class:`markus.backends.prometheus.PrometheusMetrics` and its
+    ``multiprocess_directory`` option.
+
+    To use, add this to your backends list::
+
+        {
+            "class": "markus.backends.multiprocess.MultiprocessMetrics",
+            "options": {
+                "directory": "/tmp/markus_metrics",
+            }
+        }
+
+    Options:
+
+    * ``directory``: the directory to write files to
+
+      All processes that should be aggregated together use the same
+      directory. It should be empty when the server starts.
+
+      This is required.
+
+    * ``buckets``: list of upper bounds for histogram buckets
+
+      Defaults to ``[5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]``
+      which works for timings in milliseconds.
+
+    ``incr`` stats are counted, ``gauge`` stats keep the last value and when
+    it was set, and ``timing``, ``histogram``, and ``distribution`` stats are
+    counted in buckets along with their sum and count. Each combination of key
+    and tags is kept separately, so tags with unbounded values use unbounded
+    space.
+
+    Updates write directly to memory, so they cost about as much as updating
+    a dict and no data is sent anywhere. Files for processes that have exited
+    are still included when collecting, so counts from workers that were
+    restarted aren't lost.
+
+    After a fork, the child process writes to its own file. This requires
+    the backend to be configured with :py:func:`markus.configure`.
+
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        self.directory = options.get("directory")
+        self.buckets = sorted(options.get("buckets", DEFAULT_BUCKETS))
+
+        if not self.directory:
+            raise ValueError("directory option is required")
+        os.makedirs(self.directory, exist_ok=True)
+
+        self._bucket_slots = [_bucket_slot(bound) for bound in self.buckets] + [
+            "le=inf"
+        ]
+
+        self._file = None
+        # Map of (stat_type, key, tags) -> offsets of values in the file
+        self._offsets = {}
+        self._open()
+
+    def __repr__(self):
+        return f"<MultiprocessMetrics {self.directory}>"
+
+    def _open(self):
+        self._file = _get_file(self.directory)
+        self._offsets = {}
+
+    def _get_offsets(self, stat_type, key, tags):
+        """Return offsets for a stat's values; needs the lock held."""
+        sorted_tags = sorted(tags)
+        if stat_type == "incr":
+            slots = ["value"]
+        elif stat_type == "gauge":
+            slots = ["value", "time"]
+        else:
+            slots = ["sum", "count"] + self._bucket_slots
+
+        offsets = [
+            self._file.offset(_slot_key(stat_type, key, sorted_tags, slot))
+            for slot in slots
+        ]
+        self._offsets[(stat_type, key, tags)] = offsets
+        return offsets
+
+    def after_fork_child(self):
+        # NOTE: the file belongs to the parent, so the child needs its
+        # own file
+        self._open()
+
+    def emit(self, record):
+        stat_type = record.stat_type
+        mmap_file = self._file
+        with mmap_file.lock:
+            offsets = self._offsets.get((stat_type, record.key, record.tags_tuple))
+            if offsets is None:
+                offsets = self._get_offsets(stat_type, record.key, record.tags_tuple)
+
+            value = record.value
+            if stat_type == "incr":
+                if record.sample_rate < 1:
+                    value = value / record.sample_rate
+                mmap_file.add(offsets[0], value)
+            elif stat_type == "gauge":
+                mmap_file.set(offsets[0], value)
+                mmap_file.set(offsets[1], time.time())
+            else:
+                mmap_file.add(offsets[0], value)
+                mmap_file.add(offsets[1], 1)
+                mmap_file.add(offsets[2 + bisect_left(self.buckets, value)], 1)
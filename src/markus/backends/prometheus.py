@@ -0,0 +1,530 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import re
+import threading
+
+from markus.backends import DEFAULT_BUCKETS, BackendBase
+from markus.backends.multiprocess import collect
+
+
+logger = logging.getLogger(__name__)
+
+
+# Map of markus stat type -> Prometheus metric type
+STAT_TYPE_TO_METRIC_TYPE = {
+    "incr": "counter",
+    "gauge": "gauge",
+    "timing": "histogram",
+    "histogram": "histogram",
+    "distribution": "histogram",
+}
+
+# Number of locks shared by series
+LOCK_STRIPES = 64
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+INVALID_LABEL_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _sanitize(name, invalid):
+    name = invalid.sub("_", name)
+    if not name or name[0].isdigit():
+        name = "_" + name
+    return name
+
+
+def _format_value(value):
+    """Format a value like Prometheus client libraries do."""
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    return repr(float(value))
+
+
+def _escape_label_value(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class _Series:
+    """One combination of metric name and labels."""
+
+    __slots__ = ("lock", "family", "labels", "dirty", "text")
+
+    def __init__(self, lock, family, labels):
+        self.lock = lock
+        self.family = family
+        # Labels formatted as 'name="value",...'
+        self.labels = labels
+        # Whether this has changed since it was last rendered
+        self.dirty = True
+        # Rendered text from the last time it was rendered as utf-8 encoded
+        # bytes
+        self.text = b""
+
+    def _changed(self):
+        self.dirty = True
+        self.family.dirty = True
+
+
+class _Counter(_Series):
+    __slots__ = ("value", "warned")
+
+    def __init__(self, lock, family, labels):
+        super().__init__(lock, family, labels)
+        self.value = 0
+        # Whether a warning about negative increments was logged
+        self.warned = False
+
+    def observe(self, record):
+        value = record.value
+        if value < 0:
+            # NOTE: Prometheus treats a counter going down as a counter reset,
+            # so negative increments are dropped
+            if not self.warned:
+                self.warned = True
+                logger.warning(
+                    "Dropping negative increment for %s: counters can't go down",
+                    self.family.name,
+                )
+            return
+        if record.sample_rate < 1:
+            value = value / record.sample_rate
+        with self.lock:
+            self.value += value
+            self._changed()
+
+    def render(self):
+        with self.lock:
+            self.dirty = False
+            value = self.value
+        labels = "{%s}" % self.labels if self.labels else ""
+        line = "%s%s %s\n" % (self.family.name, labels, _format_value(value))
+        return line.encode("utf-8")
+
+
+class _Gauge(_Counter):
+    __slots__ = ()
+
+    def observe(self, record):
+        with self.lock:
+            self.value = record.value
+            self._changed()
+
+
+class _Histogram(_Series):
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, lock, family, labels):
+        super().__init__(lock, family, labels)
+        # Count of values in each bucket; the last one is for +Inf
+        self.counts = [0] * (len(family.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, record):
+        value = record.value
+        index = bisect_left(self.family.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self._changed()
+
+    def render(self):
+        with self.lock:
+            self.dirty = False
+            counts = list(self.counts)
+            total = self.sum
+
+        name = self.family.name
+        labels = self.labels
+        prefix = "%s_bucket{%s%sle=" % (name, labels, "," if labels else "")
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.family.bucket_labels, counts):
+            cumulative += count
+            lines.append('%s"%s"} %s\n' % (prefix, bound, _format_value(cumulative)))
+        labels = "{%s}" % labels if labels else ""
+        lines.append("%s_sum%s %s\n" % (name, labels, _format_value(total)))
+        lines.append("%s_count%s %s\n" % (name, labels, _format_value(cumulative)))
+        return "".join(lines).encode("utf-8")
+
+
+class _Family:
+    """All the series for one metric name."""
+
+    __slots__ = (
+        "name",
+        "metric_type",
+        "buckets",
+        "bucket_labels",
+        "series",
+        "dirty",
+        "parts",
+    )
+
+    def __init__(self, name, metric_type, buckets):
+        self.name = name
+        self.metric_type = metric_type
+        self.buckets = buckets
+        self.bucket_labels = [_format_value(bound) for bound in buckets] + ["+Inf"]
+        # Map of labels -> series
+        self.series = {}
+        # Whether any series has changed since this was last rendered
+        self.dirty = True
+        # Rendered text for the type line and each series from the last time
+        # it was rendered
+        self.parts = []
+
+    def render(self):
+        """Render series that changed and return the rendered parts."""
+        self.dirty = False
+        parts = [("# TYPE %s %s\n" % (self.name, self.metric_type)).encode("utf-8")]
+        for series in list(self.series.values()):
+            if series.dirty:
+                series.text = series.render()
+            parts.append(series.text)
+        self.parts = parts
+        return parts
+
+
+# Map of Prometheus metric type -> series class
+METRIC_TYPE_TO_SERIES = {
+    "counter": _Counter,
+    "gauge": _Gauge,
+    "histogram": _Histogram,
+}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Set on the subclass created for each backend
+    backend = None
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != self.backend.http_path:
+            self.send_error(404)
+            return
+
+        body = self.backend.render()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class PrometheusMetrics(BackendBase):
+    """Serve metrics for Prometheus to scrape.
+
+    This keeps counters, gauges, and histograms in memory and serves them in
+    the Prometheus text exposition format from an HTTP server running in a
+    background thread.
+
+    To use, add this to your backends list::
+
+        {
+            "class": "markus.backends.prometheus.PrometheusMetrics",
+            "options": {
+                "http_host": "0.0.0.0",
+                "http_port": 9464,
+            }
+        }
+
+    Options:
+
+    * ``http_host``: the address for the HTTP server to listen on
+
+      Defaults to ``"0.0.0.0"``.
+
+    * ``http_port``: the port for the HTTP server to listen on
+
+      If this is ``0``, the operating system picks a port. The port the server
+      is listening on is in the ``http_port`` attribute.
+
+      The server stops when the backend is closed. For example, when
+      :py:func:`markus.configure` is called again.
+
+      Defaults to ``9464``.
+
+    * ``http_path``: the path to serve metrics on
+
+      Defaults to ``"/metrics"``.
+
+    * ``start_server``: whether to start the HTTP server
+
+      If this is ``False``, use ``render()`` to get the metrics and serve them
+      some other way. For example, from a view in your web application.
+
+      Defaults to ``True``.
+
+    * ``namespace``: the namespace to prefix all metric names with
+
+      Defaults to ``""``.
+
+    * ``buckets``: list of upper bounds for histogram buckets
+
+      Defaults to ``[5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]``
+      which works for timings in milliseconds.
+
+    * ``multiprocess_directory``: serve metrics collected from all the
+      processes writing to this directory with
+      :py:class:`markus.backends.multiprocess.MultiprocessMetrics` instead of
+      metrics emitted to this backend
+
+      Use this in one process, like the gunicorn master process or a separate
+      process, to serve metrics aggregated across worker processes. Metrics
+      are read from the directory every scrape.
+
+      Defaults to ``None``.
+
+    Keys are converted to metric names by replacing characters that aren't
+    allowed with ``_``. For example, ``app.request_time`` becomes
+    ``app_request_time``.
+
+    Metrics are converted like this:
+
+    * ``incr`` stats become counters named ``key_total``; sampled values are
+      scaled by the sample rate and negative values are dropped with a warning
+      because Prometheus counters can't go down
+    * ``gauge`` stats become gauges
+    * ``timing``, ``histogram``, and ``distribution`` stats become histograms
+      with the configured buckets
+
+    Tags become labels. ``"key:value"`` tags become a ``key`` label with value
+    ``value`` and tags without a value get the value ``"true"``. Each
+    combination of key and tags is a separate series, so tags with unbounded
+    values use unbounded memory.
+
+    If a metric name is used with a different type than it was first used
+    with, the stat is dropped and a warning is logged.
+
+    In a forked child process, this starts with no metrics and doesn't serve
+    them. The parent process keeps serving its own metrics.
+
+    Rendering is incremental. Each series caches its rendered text and is only
+    rendered again if it has changed since the last scrape. If nothing has
+    changed, the last response is served as is. Emitting only waits on a
+    scrape for as long as it takes to copy the values for one series.
+
+    .. seealso::
+
+       https://prometheus.io/docs/instrumenting/exposition_formats/
+
+    """
+
+    def __init__(self, options=None, filters=None):
+        options = options or {}
+        self.filters = filters or []
+
+        self.http_host = options.get("http_host", "0.0.0.0")
+        self.http_port = options.get("http_port", 9464)
+        self.http_path = options.get("http_path", "/metrics")
+        self.start_server = options.get("start_server", True)
+        self.namespace = options.get("namespace", "")
+        self.buckets = sorted(options.get("buckets", DEFAULT_BUCKETS))
+        self.multiprocess_directory = options.get("multiprocess_directory")
+
+        self._prefix = f"{self.namespace}_" if self.namespace else ""
+
+        self._reset()
+
+        self._server = None
+        self._thread = None
+        if self.start_server:
+            handler = type("_Handler", (_Handler,), {"backend": self})
+            self._server = ThreadingHTTPServer(
+                (self.http_host, self.http_port), handler
+            )
+            self._server.daemon_threads = True
+            self.http_port = self._server.server_address[1]
+            self._thread = threading.Thread(
+                target=self._server.serve_forever,
+                name="markus-prometheus",
+                daemon=True,
+            )
+            self._thread.start()
+
+        logger.debug(
+            "%s configured: %s:%s%s",
+            self.__class__.__name__,
+            self.http_host,
+            self.http_port,
+            self.http_path,
+        )
+
+    def __repr__(self):
+        return f"<PrometheusMetrics {self.http_host}:{self.http_port}>"
+
+    def _reset(self):
+        # Map of metric name -> family
+        self._families = {}
+        # Map of (stat_type, key, tags) -> series; this is how emit finds the
+        # series for a record without having to build the name and labels
+        self._series = {}
+        # Names that were used with conflicting types
+        self._conflicts = set()
+
+        # Held while adding families and series
+        self._registry_lock = threading.Lock()
+        # Held while rendering so scrapes don't render the same thing twice
+        self._render_lock = threading.Lock()
+        # Locks shared by series
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+        # Rendered text from the last time it was rendered
+        self._rendered = b""
+
+    def _build_labels(self, tags):
+        labels = {}
+        for tag in tags:
+            name, _, value = tag.partition(":")
+            labels[_sanitize(name, INVALID_LABEL_CHARS)] = value or "true"
+        return ",".join(
+            '%s="%s"' % (name, _escape_label_value(value))
+            for name, value in sorted(labels.items())
+        )
+
+    def _build_name(self, stat_type, key):
+        """Return the metric name and metric type for a stat."""
+        metric_type = STAT_TYPE_TO_METRIC_TYPE[stat_type]
+        name = self._prefix + _sanitize(key, INVALID_NAME_CHARS)
+        if metric_type == "counter":
+            name = name + "_total"
+        return name, metric_type
+
+    def _add_series(self, record):
+        """Return the series for a record, adding it if it's new.
+
+        :returns: the series or ``None`` if the name has a conflicting type
+
+        """
+        name, metric_type = self._build_name(record.stat_type, record.key)
+        labels = self._build_labels(record.tags_tuple)
+
+        with self._registry_lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(name, metric_type, self.buckets)
+            elif family.metric_type != metric_type:
+                if name not in self._conflicts:
+                    self._conflicts.add(name)
+                    logger.warning(
+                        "Dropping %s %s: %s is already a %s",
+                        metric_type,
+                        name,
+                        name,
+                        family.metric_type,
+                    )
+                return None
+
+            series = family.series.get(labels)
+            if series is None:
+                lock = self._locks[hash((name, labels)) % LOCK_STRIPES]
+                series = family.series[labels] = METRIC_TYPE_TO_SERIES[metric_type](
+                    lock, family, labels
+                )
+                family.dirty = True
+
+            self._series[(record.stat_type, record.key, record.tags_tuple)] = series
+            return series
+
+    def emit(self, record):
+        series = self._series.get((record.stat_type, record.key, record.tags_tuple))
+        if series is None:
+            series = self._add_series(record)
+            if series is None:
+                return
+        series.observe(record)
+
+    def render(self):
+        """Render metrics in the Prometheus text exposition format.
+
+        :returns: the metrics as utf-8 encoded bytes
+
+        """
+        if self.multiprocess_directory:
+            return self._render_multiprocess()
+
+        with self._render_lock:
+            # NOTE: new families and families with new series are
+            # dirty, so if nothing is dirty, nothing has changed
+            families = list(self._families.values())
+            if not any(family.dirty for family in families):
+                return self._rendered
+
+            # NOTE: this joins the parts for all the series at once so
+            # the text is only copied once
+            parts = []
+            for family in families:
+                parts.extend(family.render() if family.dirty else family.parts)
+
+            self._rendered = b"".join(parts)
+            return self._rendered
+
+    def _render_multiprocess(self):
+        """Render metrics collected from multiprocess_directory."""
+        lock = threading.Lock()
+        families = {}
+        for (stat_type, key, tags), value in sorted(
+            collect(self.multiprocess_directory).items()
+        ):
+            name, metric_type = self._build_name(stat_type, key)
+            family = families.get(name)
+            if family is None:
+                buckets = []
+                if metric_type == "histogram":
+                    buckets = sorted(
+                        bound for bound in value["buckets"] if bound != math.inf
+                    )
+                family = families[name] = _Family(name, metric_type, buckets)
+            elif family.metric_type != metric_type:
+                continue
+
+            labels = self._build_labels(tags)
+            series = family.series.get(labels)
+            if series is None:
+                series = family.series[labels] = METRIC_TYPE_TO_SERIES[metric_type](
+                    lock, family, labels
+                )
+
+            if metric_type == "histogram":
+                for i, bound in enumerate(family.buckets + [math.inf]):
+                    series.counts[i] += value["buckets"].get(bound, 0)
+                series.sum += value["sum"]
+            else:
+                series.value += value
+
+        parts = []
+        for family in families.values():
+            parts.extend(family.render())
+        return b"".join(parts)
+
+    def after_fork_child(self):
+        # NOTE: the parent serves its metrics and has the HTTP server,
+        # so the child starts with no metrics and doesn't serve them; use
+        # MultiprocessMetrics to aggregate metrics across processes
+        self._reset()
+        if self._server is not None:
+            self._server.socket.close()
+            self._server = None
+            self._thread = None
+
+    def close(self):
+        """Stop the HTTP server."""
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        self._server = None
+        self._thread = None
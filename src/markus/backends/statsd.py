@@ -3,14 +3,283 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import atexit
+from functools import lru_cache
 import logging
+import socket
+import threading
+import time
 
-from statsd import StatsClient
-from markus.backends import BackendBase
+from statsd import StatsClient, UnixSocketStatsClient
+from statsd.client.base import StatsClientBase
+from statsd.client.stream import StreamPipeline
+from statsd.client.udp import Pipeline
+from markus.backends import WIRE_CACHE_SIZE, BackendBase
 
 
 logger = logging.getLogger(__name__)
 
+# Map of markus stat type -> statsd value format; statsd doesn't support
+# histograms or distributions so they're sent as timings
+STAT_TYPE_TO_FORMAT = {
+    "incr": "%s|c",
+    "gauge": "%s|g",
+    "timing": "%0.6f|ms",
+    "histogram": "%0.6f|ms",
+    "distribution": "%0.6f|ms",
+}
+
+
+class _UnixDatagramStatsClient(StatsClientBase):
+    """pystatsd client that sends to a Unix domain datagram socket.
+
+    If sending fails, the stat is dropped and the socket is reconnected for the
+    next stat.
+
+    """
+
+    def __init__(self, socket_path, prefix=None, maxudpsize=512):
+        self._socket_path = socket_path
+        self._prefix = prefix
+        self._maxudpsize = maxudpsize
+        self._sock = None
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        try:
+            sock.connect(self._socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+
+    def pipeline(self):
+        return Pipeline(self)
+
+    def _send(self, data):
+        try:
+            if self._sock is None:
+                self.connect()
+            self._sock.send(data.encode("ascii"))
+        except BlockingIOError:
+            # The socket buffer is full, so we drop the stat
+            pass
+        except OSError:
+            logger.debug("Exception thrown while sending stat", exc_info=True)
+            self.close()
+
+
+class _UnixStreamStatsClient(UnixSocketStatsClient):
+    """pystatsd client that sends to a Unix domain stream socket.
+
+    If sending fails, the stat is dropped and the socket is reconnected for the
+    next stat.
+
+    """
+
+    def _send(self, data):
+        try:
+            super()._send(data)
+        except OSError:
+            logger.debug("Exception thrown while sending stat", exc_info=True)
+            self.close()
+
+
+class _TCPStatsClient(StatsClientBase):
+    """pystatsd client that sends to a statsd daemon over TCP.
+
+    Stats are added to a buffer. A flusher thread sends the buffer over a
+    single long-lived connection when it's bigger than ``flush_size`` bytes or
+    every ``flush_interval`` seconds, whichever comes first. Code generating
+    stats never waits on the network.
+
+    If connecting fails, the flusher waits ``reconnect_backoff`` seconds before
+    trying again, doubling that every time it fails up to
+    ``max_reconnect_backoff`` seconds. Stats stay in the buffer while it waits.
+    If the buffer is bigger than ``max_buffer_size`` bytes, new stats are
+    dropped. If sending fails, the stats being sent are dropped and the
+    connection is reopened.
+
+    The number of stats sent and dropped are in the ``sent`` and ``dropped``
+    attributes.
+
+    """
+
+    def __init__(
+        self,
+        host="localhost",
+        port=8125,
+        prefix=None,
+        timeout=0.1,
+        flush_size=8192,
+        flush_interval=1,
+        max_buffer_size=1048576,
+        reconnect_backoff=0.5,
+        max_reconnect_backoff=30,
+    ):
+        self._host = host
+        self._port = port
+        self._prefix = prefix
+        self._timeout = timeout
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._max_buffer_size = max_buffer_size
+        self._reconnect_backoff = reconnect_backoff
+        self._max_reconnect_backoff = max_reconnect_backoff
+
+        self.sent = 0
+        self.dropped = 0
+
+        # NOTE: _lock guards the buffer and counters and is the only
+        # lock code generating stats takes; _flush_lock guards the socket and
+        # is held while talking to the network
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._buffer_size = 0
+        self._buffer_count = 0
+
+        self._flush_lock = threading.Lock()
+        self._sock = None
+        self._backoff = reconnect_backoff
+        self._next_connect = 0
+
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="markus-statsd-tcp", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def pipeline(self):
+        return StreamPipeline(self)
+
+    def _send(self, data):
+        # NOTE: pipelines send several stats separated by newlines
+        count = data.count("\n") + 1
+        size = len(data) + 1
+        with self._lock:
+            if self._buffer_size + size > self._max_buffer_size:
+                self.dropped += count
+                return
+            self._buffer.append(data)
+            self._buffer_size += size
+            self._buffer_count += count
+            full = self._buffer_size >= self._flush_size
+        if full:
+            self._wakeup.set()
+
+    def _connect(self):
+        """Connect if we're not connected and we're not backing off.
+
+        This needs to be called with the flush lock held.
+
+        :returns: True if there's a connection
+
+        """
+        if self._sock is not None:
+            return True
+
+        now = time.monotonic()
+        if now < self._next_connect:
+            return False
+
+        try:
+            self._sock = socket.create_connection(
+                (self._host, self._port), timeout=self._timeout
+            )
+        except OSError:
+            logger.debug("Exception thrown while connecting", exc_info=True)
+            self._next_connect = now + self._backoff
+            self._backoff = min(self._backoff * 2, self._max_reconnect_backoff)
+            return False
+
+        self._backoff = self._reconnect_backoff
+        return True
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def flush(self):
+        """Send buffered stats if there's a connection."""
+        with self._flush_lock:
+            if not self._buffer or not self._connect():
+                return
+
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+                count = self._buffer_count
+                self._buffer_size = 0
+                self._buffer_count = 0
+
+            lines.append("")
+            try:
+                self._sock.sendall("\n".join(lines).encode("ascii"))
+            except OSError:
+                logger.debug("Exception thrown while sending stats", exc_info=True)
+                self._disconnect()
+                self._next_connect = time.monotonic() + self._backoff
+                with self._lock:
+                    self.dropped += count
+                return
+
+            with self._lock:
+                self.sent += count
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Exception thrown while flushing")
+
+    def discard(self):
+        """Drop buffered stats and the connection without sending anything.
+
+        This is for a forked child process where the buffer and the connection
+        belong to the parent.
+
+        """
+        self._stop.set()
+        self._wakeup.set()
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        self._buffer = []
+        self._buffer_size = 0
+        self._buffer_count = 0
+        atexit.unregister(self.close)
+
+    def close(self):
+        """Stop the flusher thread, send buffered stats, and disconnect."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        with self._flush_lock:
+            # Try one more time even if we're backing off
+            self._next_connect = 0
+        self.flush()
+        with self._flush_lock:
+            self._disconnect()
+        with self._lock:
+            if self._buffer_count:
+                self.dropped += self._buffer_count
+                self._buffer = []
+                self._buffer_size = 0
+                self._buffer_count = 0
+        atexit.unregister(self.close)
+
 
 class StatsdMetrics(BackendBase):
     """Use pystatsd client for statsd pings.
@@ -34,6 +303,29 @@ class StatsdMetrics(BackendBase):
         }
 
 
+    To send over TCP instead, set ``statsd_protocol`` to ``"tcp"``::
+
+        {
+            "class": "markus.backends.statsd.StatsdMetrics",
+            "options": {
+                "statsd_host": "statsd.example.com",
+                "statsd_port": 8125,
+                "statsd_protocol": "tcp",
+            }
+        }
+
+
+    To send to a Unix domain socket, use ``statsd_socket_path``::
+
+        {
+            "class": "markus.backends.statsd.StatsdMetrics",
+            "options": {
+                "statsd_socket_path": "/var/run/statsd.sock",
+                "statsd_socket_type": "dgram",
+            }
+        }
+
+
     Options:
 
     * statsd_host: the hostname for the statsd daemon to connect to
@@ -52,6 +344,73 @@ class StatsdMetrics(BackendBase):
 
       Defaults to ``512``.
 
+    * statsd_protocol: the protocol to use to talk to the statsd daemon
+
+      * ``"udp"``: send each stat in a UDP packet; batches are packed into
+        packets of up to ``statsd_maxudpsize`` bytes
+      * ``"tcp"``: send stats over one long-lived TCP connection; stats are
+        buffered and sent in the background
+
+      Defaults to ``"udp"``.
+
+    * statsd_tcp_flush_size: with TCP, the number of buffered bytes that
+      triggers sending the buffer
+
+      Defaults to ``8192``.
+
+    * statsd_tcp_flush_interval: with TCP, the maximum number of seconds stats
+      are buffered before they're sent
+
+      Defaults to ``1``.
+
+    * statsd_tcp_max_buffer_size: with TCP, the maximum number of bytes to
+      buffer; when the buffer is full, for example because the statsd daemon
+      is down, new stats are dropped
+
+      Defaults to ``1048576``.
+
+    * statsd_tcp_reconnect_backoff: with TCP, the number of seconds to wait
+      before reconnecting after a failure; this doubles with each failure
+
+      Defaults to ``0.5``.
+
+    * statsd_tcp_max_reconnect_backoff: with TCP, the maximum number of seconds
+      to wait before reconnecting
+
+      Defaults to ``30``.
+
+    * statsd_socket_path: the path to a Unix domain socket for the statsd
+      daemon; if this is set, ``statsd_host`` and ``statsd_port`` are ignored
+
+      Defaults to ``None``.
+
+    * statsd_socket_type: the type of Unix domain socket
+
+      * ``"dgram"``: datagram socket; stats are packed into datagrams of up to
+        ``statsd_maxudpsize`` bytes
+      * ``"stream"``: stream socket; stats are separated by newlines
+
+      Defaults to ``"dgram"``.
+
+    * statsd_socket_timeout: the number of seconds to wait when connecting or
+      sending over TCP or a Unix domain stream socket
+
+      Defaults to ``0.1``.
+
+    * statsd_wire_cache_size: the maximum number of serialized keys to cache
+
+      Defaults to ``1000``.
+
+    If sending to a Unix domain socket fails, the stat is dropped and the
+    socket is reconnected for the next stat.
+
+    With TCP, stats are sent by a background thread, so code generating stats
+    never waits on the network. If connecting fails, the thread backs off
+    before trying again and stats are buffered in the meantime. If sending
+    fails, the stats being sent are dropped. The number of stats sent and
+    dropped are in the ``sent`` and ``dropped`` attributes of the ``client``.
+    Buffered stats are sent when the process exits.
+
     .. Note::
 
        The StatsdMetrics backend does not support tags. All tags will be
@@ -59,8 +418,25 @@ class StatsdMetrics(BackendBase):
 
     .. Note::
 
-       statsd doesn't support histograms so histogram metrics are reported as
-       timing metrics.
+       statsd doesn't support histograms or distributions so histogram and
+       distribution metrics are reported as timing metrics.
+
+    .. Note::
+
+       Sample rates for sampled metrics are sent along with the metric. For
+       example, ``foo:1|c|@0.1``.
+
+    .. Note::
+
+       The prefixed key and the metric type for a record are serialized once
+       and cached, so emitting a record only has to format the value. Use
+       ``wire_cache_info()`` to see whether the cache is big enough.
+
+    .. Note::
+
+       To send cached keys, this backend builds on pystatsd's client and
+       pipeline classes rather than their public methods, so it requires
+       pystatsd 4.x.
 
     .. seealso::
 
@@ -74,28 +450,165 @@ class StatsdMetrics(BackendBase):
         self.port = options.get("statsd_port", 8125)
         self.prefix = options.get("statsd_prefix")
         self.maxudpsize = options.get("statsd_maxudpsize", 512)
+        self.socket_path = options.get("statsd_socket_path")
+        self.socket_type = options.get("statsd_socket_type", "dgram")
+        self.socket_timeout = options.get("statsd_socket_timeout", 0.1)
+        self.protocol = options.get("statsd_protocol", "udp")
+        self.tcp_flush_size = options.get("statsd_tcp_flush_size", 8192)
+        self.tcp_flush_interval = options.get("statsd_tcp_flush_interval", 1)
+        self.tcp_max_buffer_size = options.get("statsd_tcp_max_buffer_size", 1048576)
+        self.tcp_reconnect_backoff = options.get("statsd_tcp_reconnect_backoff", 0.5)
+        self.tcp_max_reconnect_backoff = options.get(
+            "statsd_tcp_max_reconnect_backoff", 30
+        )
+        self.wire_cache_size = options.get("statsd_wire_cache_size", WIRE_CACHE_SIZE)
+
+        if self.socket_type not in ("dgram", "stream"):
+            raise ValueError(
+                f"statsd_socket_type {self.socket_type!r} is not one of dgram, stream"
+            )
+        if self.protocol not in ("udp", "tcp"):
+            raise ValueError(
+                f"statsd_protocol {self.protocol!r} is not one of udp, tcp"
+            )
+        if self.protocol == "tcp" and self.socket_path:
+            raise ValueError(
+                "statsd_protocol tcp can't be used with statsd_socket_path"
+            )
 
         self.filters = filters or []
 
-        self.client = self._get_client(
-            self.host, self.port, self.prefix, self.maxudpsize
-        )
-        logger.debug(
-            "%s configured: %s:%s %s",
-            self.__class__.__name__,
-            self.host,
-            self.port,
-            self.prefix,
+        # Cache of (stat_type, key) -> stat format string
+        self._wire_format = lru_cache(maxsize=self.wire_cache_size)(
+            self._build_wire_format
         )
 
+        self.client = self._build_client()
+        if self.socket_path:
+            logger.debug(
+                "%s configured: unix%s://%s %s",
+                self.__class__.__name__,
+                self.socket_type,
+                self.socket_path,
+                self.prefix,
+            )
+        elif self.protocol == "tcp":
+            logger.debug(
+                "%s configured: tcp://%s:%s %s",
+                self.__class__.__name__,
+                self.host,
+                self.port,
+                self.prefix,
+            )
+        else:
+            logger.debug(
+                "%s configured: %s:%s %s",
+                self.__class__.__name__,
+                self.host,
+                self.port,
+                self.prefix,
+            )
+
+    def _build_client(self):
+        if self.socket_path:
+            return self._get_unix_client(
+                self.socket_path,
+                self.socket_type,
+                self.socket_timeout,
+                self.prefix,
+                self.maxudpsize,
+            )
+        if self.protocol == "tcp":
+            return self._get_tcp_client(self.host, self.port, self.prefix)
+        return self._get_client(self.host, self.port, self.prefix, self.maxudpsize)
+
     def _get_client(self, host, port, prefix, maxudpsize):
         return StatsClient(host=host, port=port, prefix=prefix, maxudpsize=maxudpsize)
 
-    def emit(self, record):
+    def _get_tcp_client(self, host, port, prefix):
+        return _TCPStatsClient(
+            host=host,
+            port=port,
+            prefix=prefix,
+            timeout=self.socket_timeout,
+            flush_size=self.tcp_flush_size,
+            flush_interval=self.tcp_flush_interval,
+            max_buffer_size=self.tcp_max_buffer_size,
+            reconnect_backoff=self.tcp_reconnect_backoff,
+            max_reconnect_backoff=self.tcp_max_reconnect_backoff,
+        )
+
+    def _get_unix_client(self, socket_path, socket_type, timeout, prefix, maxudpsize):
+        if socket_type == "stream":
+            return _UnixStreamStatsClient(
+                socket_path=socket_path, prefix=prefix, timeout=timeout
+            )
+        return _UnixDatagramStatsClient(
+            socket_path=socket_path, prefix=prefix, maxudpsize=maxudpsize
+        )
+
+    def _build_wire_format(self, stat_type, key):
+        # NOTE: this builds a format string for the stat with a
+        # placeholder for the value, so everything else gets escaped
+        if self.prefix:
+            key = f"{self.prefix}.{key}"
+        return "%s:%s" % (key.replace("%", "%%"), STAT_TYPE_TO_FORMAT[stat_type])
+
+    def wire_cache_info(self):
+        """Return hits and misses for the serialized key cache.
+
+        If the number of misses keeps going up, there are more keys than fit
+        in the cache. Either increase ``statsd_wire_cache_size`` or look for
+        keys with unbounded names.
+
+        :returns: a ``CacheInfo`` named tuple with ``hits``, ``misses``,
+            ``maxsize``, and ``currsize``
+
+        """
+        return self._wire_format.cache_info()
+
+    def _emit(self, client, record):
         stat_type = record.stat_type
-        if stat_type == "incr":
-            self.client.incr(stat=record.key, count=record.value)
-        elif stat_type == "gauge":
-            self.client.gauge(stat=record.key, value=record.value)
-        elif stat_type in ("timing", "histogram"):
-            self.client.timing(stat=record.key, delta=record.value)
+        value = record.value
+        if stat_type == "gauge" and value < 0:
+            # NOTE: statsd treats "-5|g" as a delta, so the client
+            # sets negative gauges to 0 first and then applies the delta
+            client.gauge(stat=record.key, value=value)
+            return
+
+        data = self._wire_format(stat_type, record.key) % (value,)
+        if record.sample_rate < 1:
+            # NOTE: the record was already sampled, so we add the rate
+            # ourselves rather than having the client sample it again
+            data = "%s|@%s" % (data, record.sample_rate)
+        # NOTE: _after sends the data or adds it to the pipeline
+        client._after(data)
+
+    def emit(self, record):
+        self._emit(self.client, record)
+
+    def emit_batch(self, records):
+        # NOTE: the pipeline packs as many stats into each packet as
+        # will fit in maxudpsize and sends them when it exits
+        with self.client.pipeline() as pipeline:
+            for record in records:
+                self._emit(pipeline, record)
+
+    def flush(self):
+        # NOTE: only the TCP client buffers stats
+        if isinstance(self.client, _TCPStatsClient):
+            self.client.flush()
+
+    def after_fork_child(self):
+        # NOTE: the client's socket, buffer, and flusher thread belong
+        # to the parent, so the child gets its own client
+        if isinstance(self.client, _TCPStatsClient):
+            self.client.discard()
+        elif hasattr(self.client, "close"):
+            self.client.close()
+        self.client = self._build_client()
+
+    def close(self):
+        """Send buffered stats and close the client's socket."""
+        if hasattr(self.client, "close"):
+            self.client.close()
@@ -46,10 +46,10 @@ def _validate_registered_metrics(registered_metrics: RegisteredMetricsType):
                 f"key {key!r} has value missing type or description"
             )
 
-        if val["type"] not in ["incr", "gauge", "timing", "histogram"]:
+        if val["type"] not in ["incr", "gauge", "timing", "histogram", "distribution"]:
             raise MetricsInvalidSchema(
                 f"key {key!r} type is {val['type']}; "
-                + "not one of incr, gauge, timing, histogram"
+                + "not one of incr, gauge, timing, histogram, distribution"
             )
 
         if not isinstance(val["description"], str):
@@ -66,7 +66,8 @@ class RegisteredMetricsFilter(MetricsFilter):
 
         {
             KEY -> {
-                "type": str,         # one of "incr" | "gauge" | "timing" | "histogram"
+                "type": str,         # one of "incr" | "gauge" | "timing" |
+                                     # "histogram" | "distribution"
                 "description": str,  # can use markdown
             },
             ...
@@ -105,6 +106,8 @@ class RegisteredMetricsFilter(MetricsFilter):
 
     """
 
+    mutates = False
+
     def __init__(
         self, registered_metrics: RegisteredMetricsType, raise_error: bool = False
     ):
@@ -157,6 +160,8 @@ class AddTagFilter(MetricsFilter):
 
     """
 
+    mutates = True
+
     def __init__(self, tag: str):
         self.tag = tag
 
@@ -2,17 +2,25 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import contextlib
-from functools import wraps
+from functools import lru_cache, wraps
+import inspect
 import logging
+import os
+from random import random
 import re
 import sys
-import time
+from time import perf_counter_ns
+
+from markus.backends import BackendBase
 
 
 NOT_ALPHANUM_RE = re.compile(r"[^a-z0-9_\.]", re.I)
 CONSECUTIVE_PERIODS_RE = re.compile(r"\.+")
 
+# Maximum number of full keys cached; the cache is shared by all
+# MetricsInterface instances
+STAT_CACHE_SIZE = 10000
+
 
 logger = logging.getLogger(__name__)
 
@@ -20,23 +28,71 @@ logger = logging.getLogger(__name__)
 _override_backends = None
 _metrics_backends = []
 
+# Incremented every time the backends change; MetricsInterface instances use
+# this to know when to rebuild their dispatch plans
+_generation = 0
+
+# Whether there are any backends to publish to; when this is False, emitting
+# metrics does nothing
+_active = False
+
 
 def _override_metrics(backends):
     """Override backends for testing."""
-    global _override_backends
+    global _override_backends, _generation, _active
     _override_backends = backends
+    _generation += 1
+    _active = bool(_get_metrics_backends())
 
 
 def _change_metrics(backends):
-    """Set a new backend."""
-    global _metrics_backends
+    """Set a new backend and close old backends that aren't in it."""
+    global _metrics_backends, _generation, _active
+    old_backends = _metrics_backends
     _metrics_backends = backends
+    _generation += 1
+    _active = bool(_get_metrics_backends())
+
+    for backend in old_backends:
+        if any(backend is new_backend for new_backend in backends):
+            continue
+        try:
+            backend.close()
+        except Exception:
+            logger.exception("Exception thrown while closing %r", backend)
 
 
 def _get_metrics_backends():
     return _override_backends or _metrics_backends
 
 
+def _sanitize_key(key):
+    """Sanitize a key or key segment.
+
+    Anything that isn't alphanumeric, underscore, or period gets converted to a
+    period. Sequences of periods are collapsed to a single period. Periods at
+    the beginning and end are removed.
+
+    """
+    # Convert all bad characters to .
+    key = NOT_ALPHANUM_RE.sub(".", key)
+    # Collapse sequences of . to a single .
+    key = CONSECUTIVE_PERIODS_RE.sub(".", key)
+    # Remove . at beginning and end
+    return key.strip(".")
+
+
+@lru_cache(maxsize=STAT_CACHE_SIZE)
+def _build_full_stat(prefix, stat):
+    """Build the full key for a stat from a sanitized prefix."""
+    stat = _sanitize_key(stat)
+    if prefix:
+        stat = prefix + "." + stat
+    # NOTE: interning the key means all records for a given key
+    # share the same str which backends can use for cache lookups
+    return sys.intern(stat)
+
+
 def split_clspath(clspath):
     """Split of clspath into module and class name.
 
@@ -110,7 +166,8 @@ def configure(backends, raise_errors=False):
             }
         ])
 
-    You can set up zero or more backends.
+    You can set up zero or more backends. If you set up zero backends,
+    emitting metrics does no work at all.
 
     .. Note::
 
@@ -122,64 +179,294 @@ def configure(backends, raise_errors=False):
        :py:class:`markus.main.MetricsInterface` before Markus has been
        configured including at module load time.
 
+    .. Note::
+
+       Backend filters are looked up when metrics are first emitted after
+       configuring. If you change the filters on a backend after that, call
+       :py:func:`markus.configure` again.
+
+    .. Note::
+
+       It's fine to configure Markus before forking. For example, in a
+       pre-fork server like gunicorn or with :py:mod:`multiprocessing`.
+       Configured backends send buffered metrics before the process forks and
+       the child process gets its own sockets, threads, and buffers.
+
+    .. Note::
+
+       Calling :py:func:`markus.configure` again closes the backends that were
+       configured before. They send buffered metrics and stop their threads
+       and servers before the new backends are built, so a new backend can
+       use the same port as an old one.
+
     """
+    # NOTE: close the old backends first so they release ports and sockets
+    # the new backends might need
+    _change_metrics([])
+
     good_backends = []
 
     for backend in backends:
-        clspath = backend["class"]
-        options = backend.get("options", {})
-        filters = backend.get("filters", [])
-
-        if isinstance(clspath, str):
-            modpath, clsname = split_clspath(clspath)
-            try:
-                __import__(modpath)
-                module = sys.modules[modpath]
-                cls = getattr(module, clsname)
-            except Exception:
-                logger.exception("Exception while importing %s", clspath)
-                if raise_errors:
-                    raise
-                continue
-        else:
-            cls = clspath
-
         try:
-            good_backends.append(cls(options=options, filters=filters))
+            good_backends.append(_build_backend(backend))
         except Exception:
-            logger.exception(
-                "Exception thrown while instantiating %s, %s", clspath, options
-            )
             if raise_errors:
                 raise
 
     _change_metrics(good_backends)
 
 
+def flush():
+    """Send metrics that backends have buffered.
+
+    Some backends buffer metrics and send them later. This tells all the
+    configured backends to send what they have now. For example, in an AWS
+    Lambda function, call this at the end of each invocation::
+
+        import markus
+
+        def handler(event, context):
+            try:
+                ...
+            finally:
+                markus.flush()
+
+    Exceptions thrown by backends are logged and don't stop other backends from
+    being flushed.
+
+    """
+    for backend in _get_metrics_backends():
+        try:
+            backend.flush()
+        except Exception:
+            logger.exception("Exception thrown while flushing %r", backend)
+
+
+def _before_fork():
+    for backend in _get_metrics_backends():
+        try:
+            backend.before_fork()
+        except Exception:
+            logger.exception("Exception thrown before fork in %r", backend)
+
+
+def _after_fork_child():
+    for backend in _get_metrics_backends():
+        try:
+            backend.after_fork_child()
+        except Exception:
+            logger.exception("Exception thrown after fork in %r", backend)
+
+
+# NOTE: pre-fork servers and multiprocessing fork processes after
+# markus is configured, so backends need to flush in the parent and reset
+# their sockets, threads, and aggregated data in the child
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=_before_fork, after_in_child=_after_fork_child)
+
+
+def _build_backend(backend):
+    """Import and instantiate a backend from a backend configuration dict.
+
+    Errors are logged and then re-raised.
+
+    :arg dict backend: the backend configuration; see
+        :py:func:`markus.configure`
+
+    :returns: the backend instance
+
+    """
+    clspath = backend["class"]
+    options = backend.get("options", {})
+    filters = backend.get("filters", [])
+
+    if isinstance(clspath, str):
+        modpath, clsname = split_clspath(clspath)
+        try:
+            __import__(modpath)
+            module = sys.modules[modpath]
+            cls = getattr(module, clsname)
+        except Exception:
+            logger.exception("Exception while importing %s", clspath)
+            raise
+    else:
+        cls = clspath
+
+    try:
+        return cls(options=options, filters=filters)
+    except Exception:
+        logger.exception(
+            "Exception thrown while instantiating %s, %s", clspath, options
+        )
+        raise
+
+
+class _Timer:
+    """Context manager that times a block and emits it as a timing.
+
+    This works with ``with`` and ``async with``. Timings are only emitted
+    when the block finishes without raising an exception.
+
+    Timers can be used again once the block finishes, but not by two blocks at
+    the same time.
+
+    """
+
+    __slots__ = ("metrics", "stat", "tags", "start_ns")
+
+    def __init__(self, metrics, stat, tags):
+        self.metrics = metrics
+        self.stat = stat
+        self.tags = tags
+        self.start_ns = None
+
+    def _emit(self, delta_ns):
+        self.metrics._timing_ns(self.stat, delta_ns, self.tags)
+
+    def __enter__(self):
+        self.start_ns = perf_counter_ns()
+
+    def __exit__(self, exctype, excinst, exctb):
+        if exctype is None:
+            self._emit(perf_counter_ns() - self.start_ns)
+
+    async def __aenter__(self):
+        self.start_ns = perf_counter_ns()
+
+    async def __aexit__(self, exctype, excinst, exctb):
+        if exctype is None:
+            self._emit(perf_counter_ns() - self.start_ns)
+
+
+class _HandleTimer(_Timer):
+    """Context manager returned by TimerHandle.timer."""
+
+    __slots__ = ()
+
+    def __init__(self, handle):
+        super().__init__(handle, handle.key, handle.tags)
+
+    def _emit(self, delta_ns):
+        self.metrics._timing_ns(delta_ns)
+
+
+class _NullTimer:
+    """Context manager that does nothing for ``with`` and ``async with``."""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exctype, excinst, exctb):
+        pass
+
+    async def __aenter__(self):
+        pass
+
+    async def __aexit__(self, exctype, excinst, exctb):
+        pass
+
+
+# Context manager returned by MetricsInterface.timer when there are no backends
+_NULL_TIMER = _NullTimer()
+
+
+# Shared tags value for records that have no tags
+_NO_TAGS = ()
+
+# Map of timing unit -> number of nanoseconds in that unit
+NS_PER_UNIT = {"ns": 1, "us": 1_000, "ms": 1_000_000, "s": 1_000_000_000}
+
+
 class MetricsRecord:
     """Record for a single emitted metric.
 
     :attribute stat_type: the type of the stat ("incr", "gauge", "timing",
-        "histogram")
+        "histogram", "distribution")
     :attribute key: the full key for this record
     :attribute value: the value for this record
     :attribute tags: list of tag strings
+    :attribute sample_rate: the rate this record was sampled at; ``1.0`` means
+        it wasn't sampled
+    :attribute value_ns: for ``timing`` records measured by markus timers, the
+        timing in integer nanoseconds; otherwise ``None``
+
+    Records use ``__slots__`` and store tags as a tuple so they're cheap to
+    create and cheap to copy. The first time ``tags`` is accessed, it's
+    converted to a list so filters can continue to adjust tags in place.
 
     """
 
-    def __init__(self, stat_type, key, value, tags):
+    __slots__ = ("stat_type", "key", "value", "_tags", "sample_rate", "value_ns")
+
+    def __init__(self, stat_type, key, value, tags, sample_rate=1.0, value_ns=None):
         self.stat_type = stat_type
         self.key = key
         self.value = value
-        self.tags = tags or []
+        self.sample_rate = sample_rate
+        self.value_ns = value_ns
+        # NOTE: tuple() of a tuple returns the same tuple, so this only
+        # allocates when we're handed a list
+        self._tags = tuple(tags) if tags else _NO_TAGS
+
+    @property
+    def tags(self):
+        tags = self._tags
+        if type(tags) is tuple:
+            tags = self._tags = list(tags)
+        return tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags if tags is not None else _NO_TAGS
+
+    @property
+    def tags_tuple(self):
+        """Tags as a tuple.
+
+        Unlike ``tags``, this doesn't convert the tags to a list, so it's cheap
+        and it's hashable, which makes it good for cache keys.
+
+        """
+        return tuple(self._tags)
+
+    def value_in(self, unit):
+        """Return a ``timing`` value in the specified unit.
+
+        If the record has ``value_ns``, the value is computed from that, so
+        nothing is lost to float rounding along the way. Otherwise, ``value`` is
+        converted from milliseconds.
+
+        :arg str unit: one of ``"ns"``, ``"us"``, ``"ms"``, or ``"s"``
+
+        :returns: an int for ``"ns"`` and a float for everything else
+
+        >>> record = MetricsRecord("timing", "foo", 1.5, [], value_ns=1_500_000)
+        >>> record.value_in("us")
+        1500.0
+        >>> record.value_in("ns")
+        1500000
+
+        """
+        value_ns = self.value_ns
+        if value_ns is None:
+            value_ns = self.value * NS_PER_UNIT["ms"]
+            if unit == "ns":
+                return round(value_ns)
+        if unit == "ns":
+            return value_ns
+        return value_ns / NS_PER_UNIT[unit]
 
     def __repr__(self):
+        sample_rate = f" sample_rate={self.sample_rate}" if self.sample_rate < 1 else ""
         return (
             f"<MetricsRecord "
             f"type={self.stat_type} "
             f"key={self.key} "
             f"value={self.value} "
-            f"tags={self.tags!r}>"
+            f"tags={list(self._tags)!r}"
+            f"{sample_rate}>"
         )
 
     def __eq__(self, obj):
@@ -188,13 +475,21 @@ class MetricsRecord:
             and obj.stat_type == self.stat_type
             and obj.key == self.key
             and obj.value == self.value
-            and obj.tags == self.tags
+            and tuple(obj._tags) == tuple(self._tags)
+            and obj.sample_rate == self.sample_rate
         )
 
     def __copy__(self):
-        # NOTE(willkg): the only attribute that's mutable is tags--the rest
-        # we can just copy verbatim
-        return MetricsRecord(self.stat_type, self.key, self.value, list(self.tags))
+        # NOTE: the only attribute that's mutable is tags and only once
+        # it's been converted to a list--the new record gets a tuple snapshot
+        return MetricsRecord(
+            self.stat_type,
+            self.key,
+            self.value,
+            self._tags,
+            self.sample_rate,
+            self.value_ns,
+        )
 
 
 class MetricsFilter:
@@ -203,8 +498,15 @@ class MetricsFilter:
     Subclass MetricsFilter to build filters that augment metrics as they're
     published.
 
+    Records are shared between backends when possible. If your filter only
+    looks at records and never changes them, set ``mutates`` to ``False`` and
+    backends using it won't need their own copy of each record.
+
     """
 
+    #: Whether this filter modifies records passed to it.
+    mutates = True
+
     def __repr__(self):
         return "<MetricsFilter>"
 
@@ -220,6 +522,60 @@ class MetricsFilter:
         return record
 
 
+def _build_dispatch_plan(backends):
+    """Build the dispatch plan for publishing records to backends.
+
+    The plan is a tuple with one ``(copy, filter_funs, emit, emit_batch)``
+    step per backend where ``copy`` is whether the backend needs its own copy
+    of the record, ``filter_funs`` is a tuple of the backend's filter
+    functions, ``emit`` is the function to pass the record to, and
+    ``emit_batch`` is the function to pass a list of records to.
+
+    Backends that override ``emit_to_backend`` or ``_filter`` get a step that
+    calls their ``emit_to_backend`` with no filter functions.
+
+    """
+    plan = []
+    for backend in backends:
+        filters = getattr(backend, "filters", None)
+        backend_cls = type(backend)
+        if (
+            isinstance(backend, BackendBase)
+            and backend_cls.emit_to_backend is BackendBase.emit_to_backend
+            and backend_cls._filter is BackendBase._filter
+        ):
+            filter_funs = tuple(
+                metrics_filter.filter for metrics_filter in filters or ()
+            )
+            emit = backend.emit
+            emit_batch = backend.emit_batch
+        else:
+            filter_funs = ()
+            emit = backend.emit_to_backend
+            emit_batch = _emit_each(emit)
+        plan.append((_filters_mutate(filters), filter_funs, emit, emit_batch))
+    return tuple(plan)
+
+
+def _emit_each(emit):
+    """Return a function that emits a batch of records one at a time."""
+
+    def _emit_batch(records):
+        for record in records:
+            emit(record)
+
+    return _emit_batch
+
+
+def _filters_mutate(filters):
+    """Return whether any of the filters might modify records."""
+    if filters:
+        for metrics_filter in filters:
+            if getattr(metrics_filter, "mutates", True):
+                return True
+    return False
+
+
 class MetricsInterface:
     """Interface to generating metrics.
 
@@ -244,29 +600,40 @@ class MetricsInterface:
             collapsed to a single period.
 
             The prefix is prepended to all keys emitted by this metrics
-            interface.
+            interface. Stats are cleaned up the same way before they're
+            joined to the prefix.
 
         :arg list of MetricsFilter filters: list of filters to apply to
             records being emitted
 
         """
-        # Convert all bad characters to .
-        prefix = NOT_ALPHANUM_RE.sub(".", prefix)
-        # Collapse sequences of . to a single .
-        prefix = CONSECUTIVE_PERIODS_RE.sub(".", prefix)
-        # Remove . at beginning and end
-        self.prefix = prefix.strip(".")
+        self.prefix = _sanitize_key(prefix)
 
         self.filters = filters or []
 
+        # Dispatch plan for backends; see _build_dispatch_plan
+        self._plan = ()
+        self._plan_generation = -1
+
     def __repr__(self):
         return "<MetricsInterface %s %s>" % (self.prefix, repr(self.filters))
 
     def _full_stat(self, stat):
-        if self.prefix:
-            return self.prefix + "." + stat
-        else:
-            return stat
+        return _build_full_stat(self.prefix, stat)
+
+    def stat_cache_info(self):
+        """Return hits and misses for the full key cache.
+
+        Keys are built from the prefix and the stat and then cached. The cache
+        is shared by all ``MetricsInterface`` instances. If the number of
+        misses keeps going up, you're probably generating stats with unbounded
+        names, for example by putting ids in them. Use tags for that instead.
+
+        :returns: a ``CacheInfo`` named tuple with ``hits``, ``misses``,
+            ``maxsize``, and ``currsize``
+
+        """
+        return _build_full_stat.cache_info()
 
     def _publish(self, record):
         """Publish a record to backends.
@@ -281,11 +648,115 @@ class MetricsInterface:
             if record is None:
                 return
 
-        for backend in _get_metrics_backends():
-            # Copy the record so filtering in one backend doesn't affect other
-            # backends
-            fresh_record = record.__copy__()
-            backend.emit_to_backend(fresh_record)
+        plan = self._plan
+        if self._plan_generation != _generation:
+            plan = self._rebuild_plan()
+
+        for copy, filter_funs, emit, _ in plan:
+            # Copy the record if the filters for this backend might change it
+            # so filtering in one backend doesn't affect other backends
+            backend_record = record.__copy__() if copy else record
+            for filter_fun in filter_funs:
+                backend_record = filter_fun(backend_record)
+                if backend_record is None:
+                    break
+            else:
+                emit(backend_record)
+
+    def _publish_many(self, records):
+        """Publish a batch of records to backends.
+
+        Records rejected by a filter are dropped from the batch.
+
+        """
+        if self.filters:
+            batch = []
+            for record in records:
+                for metrics_filter in self.filters:
+                    record = metrics_filter.filter(record)
+                    if record is None:
+                        break
+                else:
+                    batch.append(record)
+            records = batch
+        if not records:
+            return
+
+        plan = self._plan
+        if self._plan_generation != _generation:
+            plan = self._rebuild_plan()
+
+        for copy, filter_funs, _, emit_batch in plan:
+            if not copy and not filter_funs:
+                emit_batch(records)
+                continue
+
+            batch = []
+            for record in records:
+                # Copy the record if the filters for this backend might change
+                # it so filtering in one backend doesn't affect other backends
+                backend_record = record.__copy__() if copy else record
+                for filter_fun in filter_funs:
+                    backend_record = filter_fun(backend_record)
+                    if backend_record is None:
+                        break
+                else:
+                    batch.append(backend_record)
+            if batch:
+                emit_batch(batch)
+
+    def _rebuild_plan(self):
+        # NOTE: read the generation first so that if backends change
+        # while we're building the plan, we rebuild it again next time
+        generation = _generation
+        self._plan = _build_dispatch_plan(_get_metrics_backends())
+        self._plan_generation = generation
+        return self._plan
+
+    def emit_many(self, records):
+        """Publish a list of records to backends as a batch.
+
+        Backends that can send many records at once, like
+        :py:class:`markus.backends.statsd.StatsdMetrics`, will send the whole
+        batch together.
+
+        :arg list records: list of :py:class:`markus.main.MetricsRecord`
+            instances; the keys are used as is and don't get the prefix
+
+        For example:
+
+        >>> import markus
+        >>> from markus.main import MetricsRecord
+        >>> metrics = markus.get_metrics("foo")
+        >>> metrics.emit_many([
+        ...     MetricsRecord("incr", "foo.requests", 1, None),
+        ...     MetricsRecord("gauge", "foo.queue_size", 10, None),
+        ... ])
+
+        """
+        if not _active:
+            return
+        self._publish_many(list(records))
+
+    def batch(self):
+        """Contextmanager for publishing several metrics as a batch.
+
+        Metrics generated using the batch are collected and then published to
+        backends when the context manager exits.
+
+        :returns: a :py:class:`markus.main.MetricsBatch`
+
+        For example:
+
+        >>> import markus
+        >>> metrics = markus.get_metrics("foo")
+        >>> def process_queue(queue):
+        ...     with metrics.batch() as batch:
+        ...         batch.incr("processed", value=len(queue))
+        ...         batch.gauge("queue_size", value=0)
+
+        """
+        return MetricsBatch(self)
 
     def extend_prefix(self, prefix):
         """Returns a duplicate MetricsInterface with prefix extended
@@ -312,7 +783,7 @@ class MetricsInterface:
             filters=list(self.filters),
         )
 
-    def incr(self, stat, value=1, tags=None):
+    def incr(self, stat, value=1, tags=None, sample_rate=1.0):
         """Incr is used for counting things.
 
         :arg string stat: A period delimited alphanumeric key.
@@ -327,6 +798,13 @@ class MetricsInterface:
 
             To pass no tags, either pass an empty list or ``None``.
 
+        :arg float sample_rate: The rate at which to sample this metric
+            between ``0.0`` and ``1.0``. For example, ``0.1`` sends roughly
+            one out of every ten calls. Backends that support it pass the rate
+            along so the server can scale values accordingly.
+
+            Defaults to ``1.0`` which sends every call.
+
         For example:
 
         >>> import markus
@@ -338,10 +816,10 @@ class MetricsInterface:
         You can also use incr to decrement by passing a negative value.
 
         """
+        if not _active or (sample_rate < 1.0 and random() >= sample_rate):
+            return
         self._publish(
-            MetricsRecord(
-                stat_type="incr", key=self._full_stat(stat), value=value, tags=tags
-            )
+            MetricsRecord("incr", self._full_stat(stat), value, tags, sample_rate)
         )
 
     def gauge(self, stat, value, tags=None):
@@ -368,13 +846,11 @@ class MetricsInterface:
         ...     # parse parse parse
 
         """
-        self._publish(
-            MetricsRecord(
-                stat_type="gauge", key=self._full_stat(stat), value=value, tags=tags
-            )
-        )
+        if not _active:
+            return
+        self._publish(MetricsRecord("gauge", self._full_stat(stat), value, tags))
 
-    def timing(self, stat, value, tags=None):
+    def timing(self, stat, value, tags=None, sample_rate=1.0):
         """Record a timing value.
 
         Record the length of time of something to be added to a set of values from
@@ -399,6 +875,13 @@ class MetricsInterface:
 
             To pass no tags, either pass an empty list or ``None``.
 
+        :arg float sample_rate: The rate at which to sample this metric
+            between ``0.0`` and ``1.0``. For example, ``0.1`` sends roughly
+            one out of every ten calls. Backends that support it pass the rate
+            along so the server can scale values accordingly.
+
+            Defaults to ``1.0`` which sends every call.
+
         For example:
 
         >>> import time
@@ -417,13 +900,28 @@ class MetricsInterface:
            :py:meth:`markus.main.MetricsInterface.timer_decorator`.
 
         """
+        if not _active or (sample_rate < 1.0 and random() >= sample_rate):
+            return
+        self._publish(
+            MetricsRecord("timing", self._full_stat(stat), value, tags, sample_rate)
+        )
+
+    def _timing_ns(self, stat, value_ns, tags):
+        """Record a timing measured in integer nanoseconds."""
+        if not _active:
+            return
         self._publish(
             MetricsRecord(
-                stat_type="timing", key=self._full_stat(stat), value=value, tags=tags
+                "timing",
+                self._full_stat(stat),
+                value_ns / 1_000_000,
+                tags,
+                1.0,
+                value_ns,
             )
         )
 
-    def histogram(self, stat, value, tags=None):
+    def histogram(self, stat, value, tags=None, sample_rate=1.0):
         """Record a histogram value.
 
         Record a value to be added to a set of values from which a statistical
@@ -448,6 +946,13 @@ class MetricsInterface:
 
             To pass no tags, either pass an empty list or ``None``.
 
+        :arg float sample_rate: The rate at which to sample this metric
+            between ``0.0`` and ``1.0``. For example, ``0.1`` sends roughly
+            one out of every ten calls. Backends that support it pass the rate
+            along so the server can scale values accordingly.
+
+            Defaults to ``1.0`` which sends every call.
+
         For example:
 
         >>> import time
@@ -464,13 +969,60 @@ class MetricsInterface:
            same as timing.
 
         """
+        if not _active or (sample_rate < 1.0 and random() >= sample_rate):
+            return
+        self._publish(
+            MetricsRecord("histogram", self._full_stat(stat), value, tags, sample_rate)
+        )
+
+    def distribution(self, stat, value, tags=None, sample_rate=1.0):
+        """Record a distribution value.
+
+        This is like a histogram, except the statistical distribution is
+        derived by the metrics server from all the values sent by all hosts
+        rather than by each host's agent. That makes percentiles accurate
+        across hosts.
+
+        :arg string stat: A period delimited alphanumeric key.
+
+        :arg int value: The value of the thing.
+
+        :arg list-of-strings tags: Each string in the tag consists of a key and
+            a value separated by a colon. Tags can make it easier to break down
+            metrics for analysis.
+
+            For example ``["env:stage", "compressed:yes"]``.
+
+            To pass no tags, either pass an empty list or ``None``.
+
+        :arg float sample_rate: The rate at which to sample this metric
+            between ``0.0`` and ``1.0``. For example, ``0.1`` sends roughly
+            one out of every ten calls. Backends that support it pass the rate
+            along so the server can scale values accordingly.
+
+            Defaults to ``1.0`` which sends every call.
+
+        For example:
+
+        >>> import markus
+        >>> metrics = markus.get_metrics("foo")
+        >>> def handle_request(request):
+        ...     metrics.distribution("request_size", value=len(request.body))
+
+        .. Note::
+
+           For metrics backends that don't have distribution, this will do the
+           same as histogram.
+
+        """
+        if not _active or (sample_rate < 1.0 and random() >= sample_rate):
+            return
         self._publish(
             MetricsRecord(
-                stat_type="histogram", key=self._full_stat(stat), value=value, tags=tags
+                "distribution", self._full_stat(stat), value, tags, sample_rate
             )
         )
 
-    @contextlib.contextmanager
     def timer(self, stat, tags=None):
         """Contextmanager for easily computing timings.
 
@@ -493,20 +1045,26 @@ class MetricsInterface:
         ...         # perform some thing we want to keep metrics on
         ...         pass
 
+        This works with ``async with``, too:
+
+        >>> async def long_coroutine():
+        ...     async with mymetrics.timer('long_coroutine'):
+        ...         # await some thing we want to keep metrics on
+        ...         pass
+
 
         .. Note::
 
            All timings generated with this are in milliseconds.
 
-        """
-        start_time = time.perf_counter()
-
-        yield
+        .. Note::
 
-        end_time = time.perf_counter()
+           If the block raises an exception, no timing is emitted.
 
-        delta = end_time - start_time
-        self.timing(stat, value=delta * 1000.0, tags=tags)
+        """
+        if not _active:
+            return _NULL_TIMER
+        return _Timer(self, stat, tags)
 
     def timer_decorator(self, stat, tags=None):
         """Timer decorator for easily computing timings.
@@ -529,23 +1087,311 @@ class MetricsInterface:
         ...     # perform some thing we want to keep metrics on
         ...     pass
 
+        This works with coroutine functions, generator functions, and
+        asynchronous generator functions, too. For coroutine functions, it
+        times from when the coroutine starts running until it returns,
+        including time spent awaiting. For generator functions and
+        asynchronous generator functions, it times from when iteration starts
+        until the generator is exhausted, including time the consumer spends
+        between items.
+
+        >>> @mymetrics.timer_decorator("long_coroutine")
+        ... async def long_coroutine():
+        ...     # await some thing we want to keep metrics on
+        ...     pass
+
 
         .. Note::
 
            All timings generated with this are in milliseconds.
 
+        .. Note::
+
+           If the function raises an exception or a generator is closed before
+           it's exhausted, no timing is emitted.
+
         """
 
         def _inner(fun):
+            if inspect.iscoroutinefunction(fun):
+
+                @wraps(fun)
+                async def _coroutine_timer_decorator(*args, **kwargs):
+                    if not _active:
+                        return await fun(*args, **kwargs)
+
+                    start_ns = perf_counter_ns()
+                    result = await fun(*args, **kwargs)
+                    self._timing_ns(stat, perf_counter_ns() - start_ns, tags)
+                    return result
+
+                return _coroutine_timer_decorator
+
+            if inspect.isasyncgenfunction(fun):
+
+                @wraps(fun)
+                async def _async_generator_timer_decorator(*args, **kwargs):
+                    agen = fun(*args, **kwargs)
+                    # NOTE: this has to stay an asynchronous generator, so if
+                    # there are no backends, it passes everything through
+                    # without timing
+                    start_ns = perf_counter_ns() if _active else None
+                    # NOTE: there's no "yield from" for asynchronous
+                    # generators, so this passes sent values, thrown
+                    # exceptions, and closing through by hand
+                    try:
+                        item = await agen.__anext__()
+                        while True:
+                            try:
+                                sent = yield item
+                            except GeneratorExit:
+                                await agen.aclose()
+                                raise
+                            except BaseException as exc:
+                                item = await agen.athrow(exc)
+                            else:
+                                item = await agen.asend(sent)
+                    except StopAsyncIteration:
+                        pass
+
+                    if start_ns is not None:
+                        self._timing_ns(stat, perf_counter_ns() - start_ns, tags)
+
+                return _async_generator_timer_decorator
+
+            if inspect.isgeneratorfunction(fun):
+
+                @wraps(fun)
+                def _generator_timer_decorator(*args, **kwargs):
+                    if not _active:
+                        return (yield from fun(*args, **kwargs))
+
+                    start_ns = perf_counter_ns()
+                    result = yield from fun(*args, **kwargs)
+                    self._timing_ns(stat, perf_counter_ns() - start_ns, tags)
+                    return result
+
+                return _generator_timer_decorator
+
             @wraps(fun)
             def _timer_decorator(*args, **kwargs):
-                with self.timer(stat, tags):
+                if not _active:
                     return fun(*args, **kwargs)
 
+                start_ns = perf_counter_ns()
+                result = fun(*args, **kwargs)
+                self._timing_ns(stat, perf_counter_ns() - start_ns, tags)
+                return result
+
             return _timer_decorator
 
         return _inner
 
+    def counter(self, stat, tags=None):
+        """Return a handle for a counter with a fixed stat and tags.
+
+        The full key and tags are computed once when the handle is created, so
+        this is handy for counters in hot code paths.
+
+        :arg string stat: A period delimited alphanumeric key.
+
+        :arg list-of-strings tags: Each string in the tag consists of a key and
+            a value separated by a colon. Tags can make it easier to break down
+            metrics for analysis.
+
+            For example ``["env:stage", "compressed:yes"]``.
+
+            To pass no tags, either pass an empty list or ``None``.
+
+        :returns: a :py:class:`markus.main.CounterHandle`
+
+        For example:
+
+        >>> import markus
+        >>> metrics = markus.get_metrics("foo")
+        >>> requests_counter = metrics.counter("requests", tags=["env:prod"])
+        >>> def handle_request(request):
+        ...     requests_counter.incr()
+
+        """
+        return CounterHandle(self, self._full_stat(stat), tags)
+
+    def timer_handle(self, stat, tags=None):
+        """Return a handle for a timing with a fixed stat and tags.
+
+        The full key and tags are computed once when the handle is created, so
+        this is handy for timings in hot code paths.
+
+        :arg string stat: A period delimited alphanumeric key.
+
+        :arg list-of-strings tags: Each string in the tag consists of a key and
+            a value separated by a colon. Tags can make it easier to break down
+            metrics for analysis.
+
+            For example ``["env:stage", "compressed:yes"]``.
+
+            To pass no tags, either pass an empty list or ``None``.
+
+        :returns: a :py:class:`markus.main.TimerHandle`
+
+        For example:
+
+        >>> import markus
+        >>> metrics = markus.get_metrics("foo")
+        >>> upload_timer = metrics.timer_handle("upload_file_time")
+        >>> def upload_file(payload):
+        ...     with upload_timer.timer():
+        ...         # upload the file
+        ...         pass
+
+        """
+        return TimerHandle(self, self._full_stat(stat), tags)
+
+
+class MetricsBatch:
+    """Collects metrics and publishes them as a batch.
+
+    Create these with :py:meth:`markus.main.MetricsInterface.batch`.
+
+    The ``incr``, ``gauge``, ``timing``, ``histogram``, and ``distribution``
+    methods take the same arguments as the ones on
+    :py:class:`markus.main.MetricsInterface`.
+
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.records = []
+
+    def __repr__(self):
+        return f"<MetricsBatch {self.metrics.prefix} {len(self.records)}>"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exctype, excinst, exctb):
+        self.publish()
+
+    def _add(self, stat_type, stat, value, tags):
+        if _active:
+            self.records.append(
+                MetricsRecord(stat_type, self.metrics._full_stat(stat), value, tags)
+            )
+
+    def incr(self, stat, value=1, tags=None):
+        """Add an incr to the batch."""
+        self._add("incr", stat, value, tags)
+
+    def gauge(self, stat, value, tags=None):
+        """Add a gauge to the batch."""
+        self._add("gauge", stat, value, tags)
+
+    def timing(self, stat, value, tags=None):
+        """Add a timing to the batch."""
+        self._add("timing", stat, value, tags)
+
+    def histogram(self, stat, value, tags=None):
+        """Add a histogram to the batch."""
+        self._add("histogram", stat, value, tags)
+
+    def distribution(self, stat, value, tags=None):
+        """Add a distribution to the batch."""
+        self._add("distribution", stat, value, tags)
+
+    def publish(self):
+        """Publish collected records to backends and clear the batch."""
+        records, self.records = self.records, []
+        if records and _active:
+            self.metrics._publish_many(records)
+
+
+class CounterHandle:
+    """Handle for emitting a counter with a fixed key and tags.
+
+    Create these with :py:meth:`markus.main.MetricsInterface.counter`.
+
+    Records are published through the :py:class:`markus.main.MetricsInterface`
+    that created the handle, so filters apply and changes to the configured
+    backends are picked up.
+
+    """
+
+    __slots__ = ("metrics", "key", "tags")
+
+    def __init__(self, metrics, key, tags):
+        self.metrics = metrics
+        self.key = key
+        self.tags = tuple(tags) if tags else _NO_TAGS
+
+    def __repr__(self):
+        return f"<CounterHandle {self.key} {list(self.tags)!r}>"
+
+    def incr(self, value=1):
+        """Increment the counter.
+
+        :arg int value: A value to increment the count by. Usually this is 1.
+
+        """
+        if not _active:
+            return
+        self.metrics._publish(MetricsRecord("incr", self.key, value, self.tags))
+
+
+class TimerHandle:
+    """Handle for emitting a timing with a fixed key and tags.
+
+    Create these with :py:meth:`markus.main.MetricsInterface.timer_handle`.
+
+    Records are published through the :py:class:`markus.main.MetricsInterface`
+    that created the handle, so filters apply and changes to the configured
+    backends are picked up.
+
+    """
+
+    __slots__ = ("metrics", "key", "tags")
+
+    def __init__(self, metrics, key, tags):
+        self.metrics = metrics
+        self.key = key
+        self.tags = tuple(tags) if tags else _NO_TAGS
+
+    def __repr__(self):
+        return f"<TimerHandle {self.key} {list(self.tags)!r}>"
+
+    def timing(self, value):
+        """Record a timing value.
+
+        :arg int value: A timing in milliseconds.
+
+        """
+        if not _active:
+            return
+        self.metrics._publish(MetricsRecord("timing", self.key, value, self.tags))
+
+    def _timing_ns(self, value_ns):
+        """Record a timing measured in integer nanoseconds."""
+        if not _active:
+            return
+        self.metrics._publish(
+            MetricsRecord(
+                "timing", self.key, value_ns / 1_000_000, self.tags, 1.0, value_ns
+            )
+        )
+
+    def timer(self):
+        """Contextmanager for timing a block of code.
+
+        This works with ``with`` and ``async with``.
+
+        .. Note::
+
+           All timings generated with this are in milliseconds.
+
+        """
+        if not _active:
+            return _NULL_TIMER
+        return _HandleTimer(self)
+
 
 def get_metrics(thing="", extra="", filters=None):
     """Return MetricsInterface instance with specified prefix.
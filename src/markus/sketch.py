@@ -0,0 +1,213 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+"""Streaming quantile sketch with bounded memory."""
+
+import math
+import sys
+
+
+# Values with a magnitude smaller than this are counted as zero; this doesn't
+# depend on the relative accuracy, so even tiny values keep their guarantee
+MIN_VALUE = sys.float_info.min
+
+
+class DDSketch:
+    """Mergeable quantile sketch with relative error guarantees.
+
+    Values are counted in logarithmically sized bins, so any quantile the
+    sketch returns is within ``relative_accuracy`` of the real value. Memory is
+    bounded by ``max_bins``: if there are more bins than that, the bins for
+    the lowest values are collapsed together, which only affects the accuracy
+    of the lowest quantiles.
+
+    The count, sum, minimum, and maximum are tracked exactly.
+
+    >>> sketch = DDSketch(relative_accuracy=0.01)
+    >>> for i in range(1, 1001):
+    ...     sketch.add(i)
+    >>> sketch.count
+    1000
+    >>> abs(sketch.quantile(0.99) - 990) <= 990 * 0.01
+    True
+
+    .. seealso::
+
+       https://arxiv.org/abs/1908.10693
+
+    """
+
+    __slots__ = (
+        "relative_accuracy",
+        "max_bins",
+        "gamma",
+        "_multiplier",
+        "positive",
+        "negative",
+        "zero_count",
+        "count",
+        "sum",
+        "min",
+        "max",
+    )
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        """
+        :arg float relative_accuracy: the relative error of quantiles; must be
+            between 0 and 1
+        :arg int max_bins: the maximum number of bins to keep for each of
+            positive and negative values
+
+        """
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        if max_bins < 1:
+            raise ValueError("max_bins must be at least 1")
+
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self.gamma)
+        # bin key -> count
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def __repr__(self):
+        return (
+            f"<DDSketch count={self.count} "
+            f"bins={len(self.positive) + len(self.negative)}>"
+        )
+
+    def _key(self, value):
+        return math.ceil(math.log(value) * self._multiplier)
+
+    def _value(self, key):
+        # NOTE: this is the point in the bin with the same relative
+        # distance to both edges
+        return 2 * self.gamma**key / (self.gamma + 1)
+
+    def _collapse(self, bins):
+        """Collapse the bins for the lowest values until there are max_bins bins.
+
+        For positive values, those are the bins with the lowest keys. For
+        negative values, keys are for the magnitude, so those are the bins with
+        the highest keys.
+
+        """
+        keys = sorted(bins, reverse=bins is self.negative)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            bins[target] += bins.pop(key)
+
+    def add(self, value, count=1):
+        """Add a value to the sketch.
+
+        :arg float value: the value to add
+        :arg int count: the number of times to add it
+
+        """
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+        if value > MIN_VALUE:
+            bins = self.positive
+            key = self._key(value)
+        elif value < -MIN_VALUE:
+            bins = self.negative
+            key = self._key(-value)
+        else:
+            self.zero_count += count
+            return
+
+        bins[key] = bins.get(key, 0) + count
+        if len(bins) > self.max_bins:
+            self._collapse(bins)
+
+    def merge(self, other):
+        """Add the values from another sketch to this one.
+
+        :arg DDSketch other: the sketch to merge; it must have the same
+            ``relative_accuracy``
+
+        """
+        if other.gamma != self.gamma:
+            raise ValueError("can't merge sketches with different accuracies")
+        if not other.count:
+            return
+
+        for bins, other_bins in (
+            (self.positive, other.positive),
+            (self.negative, other.negative),
+        ):
+            for key, count in other_bins.items():
+                bins[key] = bins.get(key, 0) + count
+            if len(bins) > self.max_bins:
+                self._collapse(bins)
+
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def quantile(self, q):
+        """Return the approximate value at quantile ``q``.
+
+        :arg float q: the quantile between 0 and 1; for example, ``0.99`` for
+            the 99th percentile
+
+        :returns: the value or ``None`` if the sketch is empty
+
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("q must be between 0 and 1")
+        if not self.count:
+            return None
+
+        # NOTE: this uses the nearest-rank definition of a quantile:
+        # the smallest value that's greater than or equal to q of the values;
+        # the small adjustment keeps float error from bumping it up a rank
+        rank = max(math.ceil(q * self.count - 1e-9) - 1, 0)
+        seen = 0
+        value = None
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                value = -self._value(key)
+                break
+        else:
+            seen += self.zero_count
+            if seen > rank:
+                value = 0
+            else:
+                for key in sorted(self.positive):
+                    seen += self.positive[key]
+                    if seen > rank:
+                        value = self._value(key)
+                        break
+
+        if value is None:
+            value = self.max
+        # Bins are approximate, but the min and max are exact
+        return min(max(value, self.min), self.max)
+
+    @property
+    def avg(self):
+        """The average of the values or ``None`` if the sketch is empty."""
+        if not self.count:
+            return None
+        return self.sum / self.count
@@ -7,7 +7,7 @@ import functools
 from types import TracebackType
 from typing import List, Optional, Type, Union
 
-from markus import INCR, GAUGE, TIMING, HISTOGRAM  # noqa
+from markus import INCR, GAUGE, TIMING, HISTOGRAM, DISTRIBUTION  # noqa
 from markus.main import _override_metrics, MetricsRecord
 
 
@@ -148,7 +148,8 @@ class MetricsMock:
         :py:class:`markus.main.MetricsRecord` instances that are ``"incr"`` AND
         the stat is ``"some.key"`` AND the tags list is ``["color:blue"]``.
 
-        :arg fun_name: "incr", "gauge", "timing", "histogram", or ``None``
+        :arg fun_name: "incr", "gauge", "timing", "histogram", "distribution", or
+            ``None``
         :arg stat: the stat emitted
         :arg value: the value
         :arg tags: the list of tag strings or ``[]`` or ``None``
@@ -189,7 +190,8 @@ class MetricsMock:
     ) -> bool:
         """Return True/False regarding whether collected metrics match criteria.
 
-        :arg fun_name: "incr", "gauge", "timing", "histogram", or ``None``
+        :arg fun_name: "incr", "gauge", "timing", "histogram", "distribution", or
+            ``None``
         :arg stat: the stat emitted
         :arg value: the value
         :arg tags: the list of tag strings or ``[]`` or ``None``
@@ -335,3 +337,42 @@ class MetricsMock:
         assert (
             len(self.filter_records(HISTOGRAM, stat=stat, value=value, tags=tags)) == 0
         )
+
+    @print_on_failure
+    def assert_distribution(
+        self,
+        stat: Optional[str],
+        value: Optional[float] = None,
+        tags: Optional[List[Union[str, AnyTagValue]]] = None,
+    ):
+        """Asserts a distribution was emitted at least once."""
+        assert (
+            len(self.filter_records(DISTRIBUTION, stat=stat, value=value, tags=tags))
+            >= 1
+        )
+
+    @print_on_failure
+    def assert_distribution_once(
+        self,
+        stat: Optional[str],
+        value: Optional[float] = None,
+        tags: Optional[List[Union[str, AnyTagValue]]] = None,
+    ):
+        """Asserts a distribution was emitted exactly once."""
+        assert (
+            len(self.filter_records(DISTRIBUTION, stat=stat, value=value, tags=tags))
+            == 1
+        )
+
+    @print_on_failure
+    def assert_not_distribution(
+        self,
+        stat: Optional[str],
+        value: Optional[float] = None,
+        tags: Optional[List[Union[str, AnyTagValue]]] = None,
+    ):
+        """Asserts a distribution was not emitted."""
+        assert (
+            len(self.filter_records(DISTRIBUTION, stat=stat, value=value, tags=tags))
+            == 0
+        )
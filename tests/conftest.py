@@ -0,0 +1,76 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+
+import pytest
+
+from markus.backends import BackendBase
+from markus.main import _change_metrics
+
+
+class RecordingMetrics(BackendBase):
+    """Backend that records what it's given and can be paused."""
+
+    def __init__(self, options=None, filters=None):
+        self.filters = filters or []
+        self.records = []
+        self.batches = []
+        self.flushed = 0
+        self.closed = 0
+        self.unpaused = threading.Event()
+        self.unpaused.set()
+
+    def emit(self, record):
+        self.unpaused.wait()
+        self.records.append(record)
+
+    def emit_batch(self, records):
+        self.unpaused.wait()
+        self.batches.append(list(records))
+        self.records.extend(records)
+
+    def flush(self):
+        self.flushed += 1
+
+    def close(self):
+        self.closed += 1
+
+
+@pytest.fixture
+def configure_backends():
+    """Sets backend instances as the configured backends."""
+    yield _change_metrics
+    _change_metrics([])
+
+
+@pytest.fixture
+def backend_options():
+    """Default options for backends built by make_backend.
+
+    Override this in a test module to change them.
+
+    """
+    return {}
+
+
+@pytest.fixture
+def make_backend(backend_class, backend_options):
+    """Builds backend_class backends and closes them after the test.
+
+    Test modules that use this define a ``backend_class`` fixture.
+
+    """
+    backends = []
+
+    def _make_backend(options=None, filters=None):
+        options = {**backend_options, **(options or {})}
+        backend = backend_class(options=options, filters=filters)
+        backends.append(backend)
+        return backend
+
+    yield _make_backend
+
+    for backend in backends:
+        backend.close()
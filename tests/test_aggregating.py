@@ -0,0 +1,139 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+
+import pytest
+
+from markus.backends.aggregating import AggregatingMetrics
+from markus.main import MetricsRecord
+
+from conftest import RecordingMetrics
+
+
+@pytest.fixture
+def backend_class():
+    return AggregatingMetrics
+
+
+@pytest.fixture
+def backend_options():
+    # Set a long flush interval so the tests control flushing
+    return {"backend": {"class": RecordingMetrics}, "flush_interval": 1000}
+
+
+def test_requires_backend():
+    with pytest.raises(ValueError):
+        AggregatingMetrics(options={})
+
+
+def test_counters(make_backend):
+    backend = make_backend()
+    backend.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    backend.emit_to_backend(MetricsRecord("incr", "foo", 2, []))
+    backend.emit_to_backend(MetricsRecord("incr", "foo", 1, ["color:blue"]))
+    backend.emit_to_backend(MetricsRecord("incr", "bar", 1, [], sample_rate=0.5))
+    assert backend.backend.records == []
+
+    backend.flush()
+    assert backend.backend.records == [
+        MetricsRecord("incr", "foo", 3, []),
+        MetricsRecord("incr", "foo", 1, ["color:blue"]),
+        MetricsRecord("incr", "bar", 2, []),
+    ]
+
+    # Nothing new, nothing emitted
+    backend.flush()
+    assert len(backend.backend.records) == 3
+
+
+def test_gauges(make_backend):
+    backend = make_backend(options={"gauge_min_max": True})
+    for value in [5, 1, 10, 3]:
+        backend.emit_to_backend(MetricsRecord("gauge", "foo", value, []))
+
+    backend.flush()
+    assert backend.backend.records == [
+        MetricsRecord("gauge", "foo", 3, []),
+        MetricsRecord("gauge", "foo.min", 1, []),
+        MetricsRecord("gauge", "foo.max", 10, []),
+    ]
+
+
+def test_timings_pass_through(make_backend):
+    backend = make_backend()
+    backend.emit_to_backend(MetricsRecord("timing", "foo", 5, []))
+    backend.emit_to_backend(MetricsRecord("histogram", "bar", 10, []))
+    assert backend.backend.records == [
+        MetricsRecord("timing", "foo", 5, []),
+        MetricsRecord("histogram", "bar", 10, []),
+    ]
+
+
+def test_threads_merged(make_backend):
+    backend = make_backend()
+
+    def work():
+        for _ in range(1000):
+            backend.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    backend.emit_to_backend(MetricsRecord("gauge", "bar", 7, []))
+
+    backend.close()
+    assert backend.backend.records == [
+        MetricsRecord("incr", "foo", 8000, []),
+        MetricsRecord("gauge", "bar", 7, []),
+    ]
+    # Buffers for finished threads are dropped after they're flushed
+    assert len(backend._buffers) == 1
+
+
+def test_flush_interval(make_backend):
+    backend = make_backend(options={"flush_interval": 0.01})
+    backend.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    for _ in range(500):
+        if backend.backend.records:
+            break
+        threading.Event().wait(0.01)
+    assert backend.backend.records == [MetricsRecord("incr", "foo", 1, [])]
+
+
+def test_flush_flushes_backend(make_backend):
+    backend = make_backend()
+    backend.flush()
+    assert backend.backend.flushed == 1
+
+
+def test_fork(make_backend):
+    class ForkingMetrics(RecordingMetrics):
+        before = 0
+        after = 0
+
+        def before_fork(self):
+            self.before += 1
+
+        def after_fork_child(self):
+            self.after += 1
+
+    backend = make_backend({"backend": {"class": ForkingMetrics}})
+    backend.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+
+    # The parent flushes aggregated data before forking
+    backend.before_fork()
+    assert [record.key for record in backend.backend.records] == ["foo"]
+    assert backend.backend.before == 1
+
+    backend.emit_to_backend(MetricsRecord("incr", "bar", 1, []))
+
+    # The child drops aggregated data that the parent has
+    backend.after_fork_child()
+    assert backend.backend.after == 1
+    backend.emit_to_backend(MetricsRecord("incr", "baz", 1, []))
+    backend.flush()
+    assert [record.key for record in backend.backend.records] == ["foo", "baz"]
@@ -0,0 +1,208 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import threading
+import time
+
+import pytest
+
+import markus
+import markus.main
+from markus.backends.background import BackgroundMetrics
+from markus.filters import AddTagFilter
+from markus.main import MetricsRecord, _change_metrics
+
+from conftest import RecordingMetrics
+
+
+@pytest.fixture
+def backend_class():
+    return BackgroundMetrics
+
+
+@pytest.fixture
+def backend_options():
+    return {"backend": {"class": RecordingMetrics}}
+
+
+def records(count):
+    return [
+        MetricsRecord("incr", key=f"key{i}", value=1, tags=[]) for i in range(count)
+    ]
+
+
+def test_requires_backend():
+    with pytest.raises(ValueError):
+        BackgroundMetrics(options={})
+
+
+def test_bad_policy(make_backend):
+    with pytest.raises(ValueError):
+        make_backend(options={"queue_full_policy": "shrug"})
+
+
+def test_emit_and_close(make_backend):
+    backend = make_backend()
+    for record in records(5):
+        backend.emit_to_backend(record)
+    backend.close()
+
+    emitted = [record for batch in backend.backend.batches for record in batch]
+    assert emitted == records(5)
+    # Closing closes the wrapped backend
+    assert backend.backend.closed == 1
+
+
+def test_batch_size(make_backend):
+    backend = make_backend(options={"batch_size": 2})
+    backend.backend.unpaused.clear()
+    backend.emit_batch_to_backend(records(5))
+    backend.backend.unpaused.set()
+    backend.close()
+
+    assert all(len(batch) <= 2 for batch in backend.backend.batches)
+    emitted = [record for batch in backend.backend.batches for record in batch]
+    assert emitted == records(5)
+
+
+def test_emit_after_close(make_backend):
+    backend = make_backend()
+    backend.close()
+    backend.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    assert backend.backend.batches == [[MetricsRecord("incr", "foo", 1, [])]]
+
+
+@pytest.mark.parametrize(
+    "policy, expected_keys",
+    [
+        ("drop_newest", ["key0", "key1", "key2", "key3"]),
+        ("drop_oldest", ["key0", "key3", "key4", "key5"]),
+    ],
+)
+def test_drop_policies(make_backend, policy, expected_keys):
+    backend = make_backend(options={"max_queue_size": 3, "queue_full_policy": policy})
+    inner = backend.backend
+    inner.unpaused.clear()
+
+    # Wait for the worker to take the first record off the queue and get stuck
+    # emitting it
+    backend.emit_to_backend(records(1)[0])
+    while backend._queue:
+        pass
+
+    backend.emit_batch_to_backend(records(6)[1:])
+    assert backend.dropped == 2
+
+    inner.unpaused.set()
+    backend.close()
+    emitted = [record.key for batch in inner.batches for record in batch]
+    assert emitted == expected_keys
+
+
+def test_block_policy(make_backend):
+    backend = make_backend(options={"max_queue_size": 1, "queue_full_policy": "block"})
+    backend.emit_batch_to_backend(records(20))
+    backend.close()
+
+    assert backend.dropped == 0
+    emitted = [record for batch in backend.backend.batches for record in batch]
+    assert emitted == records(20)
+
+
+def test_wrapped_filters_get_copies(make_backend):
+    backend = make_backend(
+        options={
+            "backend": {
+                "class": RecordingMetrics,
+                "filters": [AddTagFilter("color:blue")],
+            }
+        }
+    )
+    record = MetricsRecord("incr", key="foo", value=1, tags=[])
+    backend.emit_to_backend(record)
+    backend.close()
+
+    assert record.tags == []
+    assert backend.backend.batches == [
+        [MetricsRecord("incr", "foo", 1, ["color:blue"])]
+    ]
+
+
+def test_flush(make_backend):
+    backend = make_backend(options={"batch_size": 2})
+    backend._queue.extend(records(3))
+
+    backend.flush()
+    assert backend.backend.batches == [records(3)[:2], records(3)[2:]]
+    assert backend.backend.flushed == 1
+
+
+def test_flush_waits_for_worker(make_backend):
+    backend = make_backend()
+    backend.backend.unpaused.clear()
+    backend.emit_batch(records(1))
+
+    # Wait for the worker to take the batch off the queue
+    while backend._queue:
+        time.sleep(0.01)
+
+    # The batch is emitted before the wrapped backend is flushed
+    threading.Timer(0.1, backend.backend.unpaused.set).start()
+    backend.flush()
+    assert backend.backend.batches == [records(1)]
+    assert backend.backend.flushed == 1
+
+
+def test_markus_flush_cloudwatch(capsys):
+    markus.configure(
+        [
+            {
+                "class": "markus.backends.background.BackgroundMetrics",
+                "options": {
+                    "backend": {
+                        "class": "markus.backends.cloudwatch.CloudwatchMetrics",
+                        "options": {"buffered": True},
+                    }
+                },
+            }
+        ]
+    )
+    try:
+        markus.get_metrics("app").incr("foo")
+        markus.flush()
+        out, _ = capsys.readouterr()
+        assert "|1|count|app.foo|" in out
+    finally:
+        [backend] = markus.main._get_metrics_backends()
+        _change_metrics([])
+        backend.close()
+
+
+def test_fork(make_backend):
+    class ForkingMetrics(RecordingMetrics):
+        before = 0
+        after = 0
+
+        def before_fork(self):
+            self.before += 1
+
+        def after_fork_child(self):
+            self.after += 1
+
+    backend = make_backend({"backend": {"class": ForkingMetrics}})
+    backend.before_fork()
+    assert backend.backend.before == 1
+
+    # NOTE: this queues records without starting the worker thread because
+    # the child doesn't have the parent's worker thread
+    backend._queue.extend(records(2))
+
+    # The child drops records queued in the parent
+    backend.after_fork_child()
+    assert backend.backend.after == 1
+    assert len(backend._queue) == 0
+
+    backend.emit_batch(records(1))
+    backend.close()
+    assert backend.backend.batches == [records(1)]
@@ -3,6 +3,7 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import json
 
 import pytest
 
@@ -26,6 +27,13 @@ class TestCloudwatch:
         assert out == "MONITORING|1488817800|10|count|foo|#key1:val,key2:val\n"
         assert err == ""
 
+    def test_incr_sample_rate(self, capsys):
+        rec = MetricsRecord("incr", key="foo", value=1, tags=[], sample_rate=0.5)
+        ddcm = CloudwatchMetrics()
+        ddcm.emit_to_backend(rec)
+        out, err = capsys.readouterr()
+        assert out == "MONITORING|1488817800|2.0|count|foo|\n"
+
     def test_gauge(self, capsys):
         rec = MetricsRecord(
             "gauge", key="foo", value=100, tags=["key1:val", "key2:val"]
@@ -57,6 +65,16 @@ class TestCloudwatch:
         assert out == "MONITORING|1488817800|100|histogram|foo|#key1:val,key2:val\n"
         assert err == ""
 
+    def test_distribution(self, capsys):
+        rec = MetricsRecord(
+            "distribution", key="foo", value=100, tags=["key1:val", "key2:val"]
+        )
+        ddcm = CloudwatchMetrics()
+        ddcm.emit_to_backend(rec)
+        out, err = capsys.readouterr()
+        assert out == "MONITORING|1488817800|100|histogram|foo|#key1:val,key2:val\n"
+        assert err == ""
+
     def test_filters(self, capsys):
         class BlueFilter(MetricsFilter):
             def filter(self, record):
@@ -70,3 +88,169 @@ class TestCloudwatch:
         out, err = capsys.readouterr()
         assert out == "MONITORING|1488817800|2|count|foo.blue|\n"
         assert err == ""
+
+    def test_emit_batch(self, capsys):
+        ddcm = CloudwatchMetrics()
+        ddcm.emit_batch_to_backend(
+            [
+                MetricsRecord("incr", key="foo", value=1, tags=[]),
+                MetricsRecord("gauge", key="bar", value=10, tags=["key1:val"]),
+            ]
+        )
+        out, err = capsys.readouterr()
+        assert out == (
+            "MONITORING|1488817800|1|count|foo|\n"
+            + "MONITORING|1488817800|10|gauge|bar|#key1:val\n"
+        )
+        assert err == ""
+
+    def test_wire_cache(self, capsys):
+        ddcm = CloudwatchMetrics(options={"wire_cache_size": 10})
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=["a:b"]))
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=2, tags=["a:b"]))
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=3, tags=["a:c"]))
+        out, err = capsys.readouterr()
+        assert out == (
+            "MONITORING|1488817800|1|count|foo|#a:b\n"
+            + "MONITORING|1488817800|2|count|foo|#a:b\n"
+            + "MONITORING|1488817800|3|count|foo|#a:c\n"
+        )
+
+        info = ddcm.wire_cache_info()
+        assert info.hits == 1
+        assert info.misses == 2
+        assert info.maxsize == 10
+
+    def test_percent_in_key_and_tags(self, capsys):
+        ddcm = CloudwatchMetrics()
+        ddcm.emit_to_backend(
+            MetricsRecord("incr", key="foo%s", value=1, tags=["rate:100%"])
+        )
+        out, err = capsys.readouterr()
+        assert out == "MONITORING|1488817800|1|count|foo%s|#rate:100%\n"
+
+    def test_bad_format(self):
+        with pytest.raises(ValueError):
+            CloudwatchMetrics(options={"format": "foo"})
+
+    def test_buffered(self, capsys):
+        ddcm = CloudwatchMetrics(options={"buffered": True})
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        ddcm.emit_batch_to_backend(
+            [MetricsRecord("gauge", key="bar", value=10, tags=["key1:val"])]
+        )
+        out, err = capsys.readouterr()
+        assert out == ""
+
+        ddcm.flush()
+        out, err = capsys.readouterr()
+        assert out == (
+            "MONITORING|1488817800|1|count|foo|\n"
+            + "MONITORING|1488817800|10|gauge|bar|#key1:val\n"
+        )
+
+        # Nothing is buffered, so this doesn't write anything
+        ddcm.flush()
+        out, err = capsys.readouterr()
+        assert out == ""
+
+    def test_after_fork_child(self, capsys):
+        ddcm = CloudwatchMetrics(options={"buffered": True})
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+
+        # The child drops what the parent has buffered
+        ddcm.after_fork_child()
+        ddcm.flush()
+        out, err = capsys.readouterr()
+        assert out == ""
+
+    def test_buffered_max_buffer_size(self, capsys):
+        ddcm = CloudwatchMetrics(options={"buffered": True, "max_buffer_size": 2})
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        out, err = capsys.readouterr()
+        assert out == ""
+
+        ddcm.emit_to_backend(MetricsRecord("incr", key="foo", value=2, tags=[]))
+        out, err = capsys.readouterr()
+        assert out == (
+            "MONITORING|1488817800|1|count|foo|\n"
+            + "MONITORING|1488817800|2|count|foo|\n"
+        )
+
+    def test_emf(self, capsys):
+        ddcm = CloudwatchMetrics(options={"format": "emf", "emf_namespace": "app"})
+        ddcm.emit_batch_to_backend(
+            [
+                MetricsRecord("incr", key="foo", value=1, tags=["env:prod"]),
+                MetricsRecord("incr", key="foo", value=2, tags=["env:prod"]),
+                MetricsRecord(
+                    "incr", key="foo", value=1, tags=["env:prod"], sample_rate=0.5
+                ),
+                MetricsRecord("timing", key="bar", value=10, tags=["env:prod"]),
+                MetricsRecord("timing", key="bar", value=20, tags=["env:prod"]),
+                MetricsRecord("gauge", key="baz", value=5, tags=["canary"]),
+            ]
+        )
+        ddcm.flush()
+        out, err = capsys.readouterr()
+        documents = [json.loads(line) for line in out.splitlines()]
+        assert documents == [
+            {
+                "env": "prod",
+                "foo": 5.0,
+                "bar": [10, 20],
+                "_aws": {
+                    "Timestamp": 1488817800000,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "app",
+                            "Dimensions": [["env"]],
+                            "Metrics": [
+                                {"Name": "foo", "Unit": "Count"},
+                                {"Name": "bar", "Unit": "Milliseconds"},
+                            ],
+                        }
+                    ],
+                },
+            },
+            {
+                "canary": "true",
+                "baz": 5,
+                "_aws": {
+                    "Timestamp": 1488817800000,
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "app",
+                            "Dimensions": [["canary"]],
+                            "Metrics": [{"Name": "baz", "Unit": "None"}],
+                        }
+                    ],
+                },
+            },
+        ]
+
+    def test_emf_limits(self, capsys):
+        ddcm = CloudwatchMetrics(options={"format": "emf", "max_buffer_size": 1000})
+        records = [
+            MetricsRecord("timing", key="foo", value=i, tags=[]) for i in range(150)
+        ]
+        records.extend(
+            MetricsRecord("gauge", key=f"gauge{i}", value=i, tags=[])
+            for i in range(101)
+        )
+        ddcm.emit_batch_to_backend(records)
+        ddcm.flush()
+        out, err = capsys.readouterr()
+        documents = [json.loads(line) for line in out.splitlines()]
+
+        # The first 100 metrics with the first 100 values, then the rest of the
+        # foo values, then the last two gauges
+        assert len(documents) == 3
+        assert documents[0]["foo"] == list(range(100))
+        assert len(documents[0]["_aws"]["CloudWatchMetrics"][0]["Metrics"]) == 100
+        assert documents[1]["foo"] == list(range(100, 150))
+        assert documents[1]["_aws"]["CloudWatchMetrics"][0]["Metrics"] == [
+            {"Name": "foo", "Unit": "Milliseconds"}
+        ]
+        assert documents[2]["gauge99"] == 99
+        assert documents[2]["gauge100"] == 100
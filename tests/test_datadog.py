@@ -2,6 +2,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import socket
+
 import pytest
 
 from markus.backends import datadog
@@ -26,6 +28,19 @@ class MockDogStatsd:
     def histogram(self, *args, **kwargs):
         self.calls.append(("histogram", args, kwargs))
 
+    def distribution(self, *args, **kwargs):
+        self.calls.append(("distribution", args, kwargs))
+
+    def close_socket(self):
+        self.calls.append(("close_socket", (), {}))
+
+    def __enter__(self):
+        self.calls.append(("open_buffer", (), {}))
+        return self
+
+    def __exit__(self, exctype, excinst, exctb):
+        self.calls.append(("close_buffer", (), {}))
+
 
 @pytest.fixture
 def mockdogstatsd():
@@ -79,6 +94,33 @@ def test_options(mockdogstatsd):
     }
 
 
+@pytest.mark.parametrize(
+    "socket_type, expected",
+    [
+        ("dgram", "unixgram:///var/run/dsd.sock"),
+        ("stream", "unixstream:///var/run/dsd.sock"),
+    ],
+)
+def test_socket_path(mockdogstatsd, socket_type, expected):
+    ddm = datadog.DatadogMetrics(
+        options={
+            "statsd_socket_path": "/var/run/dsd.sock",
+            "statsd_socket_type": socket_type,
+        }
+    )
+    assert ddm.client.initkwargs["socket_path"] == expected
+
+
+def test_bad_socket_type(mockdogstatsd):
+    with pytest.raises(ValueError):
+        datadog.DatadogMetrics(
+            options={
+                "statsd_socket_path": "/var/run/dsd.sock",
+                "statsd_socket_type": "foo",
+            }
+        )
+
+
 def test_incr(mockdogstatsd):
     rec = MetricsRecord("incr", key="foo", value=10, tags=["key1:val"])
     ddm = datadog.DatadogMetrics()
@@ -115,6 +157,15 @@ def test_histogram(mockdogstatsd):
     ]
 
 
+def test_distribution(mockdogstatsd):
+    rec = MetricsRecord("distribution", key="foo", value=4321, tags=["key1:val"])
+    ddm = datadog.DatadogMetrics()
+    ddm.emit_to_backend(rec)
+    assert ddm.client.calls == [
+        ("distribution", (), {"metric": "foo", "value": 4321, "tags": ["key1:val"]})
+    ]
+
+
 def test_filters(mockdogstatsd):
     class BlueFilter(MetricsFilter):
         def filter(self, record):
@@ -128,3 +179,68 @@ def test_filters(mockdogstatsd):
     assert ddm.client.calls == [
         ("increment", (), {"metric": "foo.blue", "value": 2, "tags": []})
     ]
+
+
+def test_emit_batch(mockdogstatsd):
+    ddm = datadog.DatadogMetrics()
+    ddm.emit_batch_to_backend(
+        [
+            MetricsRecord("incr", key="foo", value=10, tags=[]),
+            MetricsRecord("gauge", key="bar", value=100, tags=["key1:val"]),
+        ]
+    )
+    assert ddm.client.calls == [
+        ("open_buffer", (), {}),
+        ("increment", (), {"metric": "foo", "value": 10, "tags": []}),
+        ("gauge", (), {"metric": "bar", "value": 100, "tags": ["key1:val"]}),
+        ("close_buffer", (), {}),
+    ]
+
+
+@pytest.fixture
+def udp_server():
+    """Local UDP server socket to receive stats."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(2)
+    yield sock
+    sock.close()
+
+
+@pytest.mark.parametrize(
+    "stat_type, value, expected",
+    [
+        # Sampled counts are scaled by the sample rate
+        ("incr", 1, b"foo:2.0|c|#a:b\n"),
+        # Other values are sent as is
+        ("gauge", 10, b"foo:10|g|#a:b\n"),
+        ("timing", 10, b"foo:10|ms|#a:b\n"),
+        ("histogram", 10, b"foo:10|h|#a:b\n"),
+        ("distribution", 10, b"foo:10|d|#a:b\n"),
+    ],
+)
+def test_sample_rate(udp_server, stat_type, value, expected):
+    rec = MetricsRecord(
+        stat_type, key="foo", value=value, tags=["a:b"], sample_rate=0.5
+    )
+    ddm = datadog.DatadogMetrics(
+        {"statsd_host": "127.0.0.1", "statsd_port": udp_server.getsockname()[1]}
+    )
+    try:
+        # The client doesn't sample the record again, so this is always sent
+        for _ in range(10):
+            ddm.emit_to_backend(rec)
+            assert udp_server.recv(65535) == expected
+    finally:
+        ddm.close()
+
+
+def test_after_fork_child(mockdogstatsd):
+    ddm = datadog.DatadogMetrics({"statsd_socket_path": "/var/run/dsd.socket"})
+    client = ddm.client
+
+    # The child closes the parent's socket and gets its own client
+    ddm.after_fork_child()
+    assert client.calls == [("close_socket", (), {})]
+    assert ddm.client is not client
+    assert ddm.client.initkwargs == client.initkwargs
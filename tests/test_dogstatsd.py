@@ -0,0 +1,590 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+
+import pytest
+
+from markus.backends.dogstatsd import AsyncioDogStatsdMetrics, DogStatsdMetrics
+from markus.main import MetricsFilter, MetricsRecord
+
+
+@pytest.fixture
+def udp_server():
+    """Local UDP socket to receive packets."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(1)
+    yield sock
+    sock.close()
+
+
+def recv_all(sock):
+    packets = []
+    sock.settimeout(0.1)
+    try:
+        while True:
+            packets.append(sock.recv(65535))
+    except socket.timeout:
+        pass
+    return packets
+
+
+@pytest.fixture
+def backend_class():
+    return DogStatsdMetrics
+
+
+@pytest.fixture
+def backend_options(udp_server):
+    return {"statsd_host": "127.0.0.1", "statsd_port": udp_server.getsockname()[1]}
+
+
+def test_default_options():
+    dsm = DogStatsdMetrics()
+    assert dsm.host == "localhost"
+    assert dsm.port == 8125
+    assert dsm.namespace == ""
+    assert dsm.max_packet_size == 1432
+    assert dsm.flush_interval == 0
+
+
+@pytest.mark.parametrize(
+    "record, expected",
+    [
+        (MetricsRecord("incr", "foo", 10, []), b"foo:10|c"),
+        (MetricsRecord("gauge", "foo", 100, ["key1:val"]), b"foo:100|g|#key1:val"),
+        (
+            MetricsRecord("timing", "foo", 1.5, ["key1:val", "key2:val"]),
+            b"foo:1.5|ms|#key1:val,key2:val",
+        ),
+        (MetricsRecord("histogram", "foo", 4321, []), b"foo:4321|h"),
+        (MetricsRecord("distribution", "foo", 4321, []), b"foo:4321|d"),
+        (
+            MetricsRecord("incr", "foo", 1, ["key1:val"], sample_rate=0.1),
+            b"foo:1|c|@0.1|#key1:val",
+        ),
+    ],
+)
+def test_emit(make_backend, udp_server, record, expected):
+    dsm = make_backend()
+    dsm.emit_to_backend(record)
+    assert udp_server.recv(65535) == expected
+    assert dsm.packets_sent == 1
+
+
+def test_namespace(make_backend, udp_server):
+    dsm = make_backend(options={"statsd_namespace": "app"})
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    assert udp_server.recv(65535) == b"app.foo:1|c"
+
+
+def test_emit_batch_packs_packets(make_backend, udp_server):
+    dsm = make_backend(options={"max_packet_size": 30})
+    dsm.emit_batch_to_backend(
+        [MetricsRecord("incr", f"key{i}", 1, []) for i in range(5)]
+    )
+    assert recv_all(udp_server) == [
+        b"key0:1|c\nkey1:1|c\nkey2:1|c",
+        b"key3:1|c\nkey4:1|c",
+    ]
+    assert dsm.packets_sent == 2
+
+
+def test_buffered(make_backend, udp_server):
+    dsm = make_backend(options={"flush_interval": 1000})
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    dsm.emit_to_backend(MetricsRecord("incr", "bar", 1, []))
+    assert recv_all(udp_server) == []
+
+    dsm.flush()
+    assert recv_all(udp_server) == [b"foo:1|c\nbar:1|c"]
+
+
+def test_dropped_packets(make_backend, monkeypatch):
+    class FullSocket:
+        def send(self, data):
+            raise BlockingIOError()
+
+    dsm = make_backend()
+    dsm._sock = FullSocket()
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    assert dsm.packets_sent == 0
+    assert dsm.packets_dropped == 1
+    dsm._sock = None
+
+
+def test_filters(make_backend, udp_server):
+    class BlueFilter(MetricsFilter):
+        def filter(self, record):
+            if "blue" not in record.key:
+                return
+            return record
+
+    dsm = make_backend(filters=[BlueFilter()])
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    dsm.emit_to_backend(MetricsRecord("incr", "foo.blue", 2, []))
+    assert recv_all(udp_server) == [b"foo.blue:2|c"]
+
+
+def test_wire_cache(make_backend, udp_server):
+    dsm = make_backend({"wire_cache_size": 10})
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, ["key1:val"]))
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 2, ["key1:val"]))
+    dsm.emit_to_backend(MetricsRecord("gauge", "foo", 3, ["key1:val"]))
+    assert recv_all(udp_server) == [
+        b"foo:1|c|#key1:val",
+        b"foo:2|c|#key1:val",
+        b"foo:3|g|#key1:val",
+    ]
+
+    info = dsm.wire_cache_info()
+    assert info.hits == 1
+    assert info.misses == 2
+    assert info.maxsize == 10
+
+
+def test_aggregate_values(make_backend, udp_server):
+    dsm = make_backend(options={"flush_interval": 1000, "aggregate_values": True})
+    for value in [1, 2.5, 3]:
+        dsm.emit_to_backend(MetricsRecord("distribution", "foo", value, ["env:prod"]))
+        dsm.emit_to_backend(MetricsRecord("timing", "bar", value, []))
+    dsm.emit_to_backend(MetricsRecord("incr", "baz", 1, []))
+    dsm.emit_to_backend(MetricsRecord("histogram", "qux", 1, [], sample_rate=0.5))
+    assert recv_all(udp_server) == []
+
+    dsm.flush()
+    assert recv_all(udp_server) == [
+        b"baz:1|c\nqux:1|h|@0.5\nfoo:1:2.5:3|d|#env:prod\nbar:1:2.5:3|ms"
+    ]
+    assert dsm._values == {}
+
+
+def test_aggregate_values_max_values(make_backend, udp_server):
+    dsm = make_backend(
+        options={"flush_interval": 1000, "aggregate_values": True, "max_values": 3}
+    )
+    for value in range(4):
+        dsm.emit_to_backend(MetricsRecord("histogram", "foo", value, []))
+    # The first three values are written to the packet buffer and the fourth
+    # waits for more values
+    assert dsm._values == {("histogram", "foo", ()): [3]}
+
+    dsm.flush()
+    assert recv_all(udp_server) == [b"foo:0:1:2|h\nfoo:3|h"]
+
+
+def test_aggregate_values_split_packets(make_backend, udp_server):
+    dsm = make_backend(
+        options={
+            "flush_interval": 1000,
+            "aggregate_values": True,
+            "max_packet_size": 20,
+        }
+    )
+    dsm.emit_batch_to_backend(
+        [MetricsRecord("distribution", "foo", 1000 + i, []) for i in range(5)]
+    )
+    dsm.flush()
+    # Each line fits in a packet
+    assert recv_all(udp_server) == [
+        b"foo:1000:1001:1002|d",
+        b"foo:1003:1004|d",
+    ]
+
+
+def test_aggregate_values_batch_unbuffered(make_backend, udp_server):
+    dsm = make_backend(options={"aggregate_values": True})
+    dsm.emit_batch_to_backend(
+        [MetricsRecord("distribution", "foo", i, []) for i in range(3)]
+        + [MetricsRecord("incr", "bar", 1, [])]
+    )
+    dsm.emit_to_backend(MetricsRecord("distribution", "foo", 5, []))
+    assert recv_all(udp_server) == [b"bar:1|c\nfoo:0:1:2|d", b"foo:5|d"]
+
+
+def test_percent_in_key_and_tags(make_backend, udp_server):
+    dsm = make_backend({"statsd_namespace": "a%s"})
+    dsm.emit_to_backend(MetricsRecord("incr", "foo%d", 1, ["rate:100%"]))
+    assert udp_server.recv(65535) == b"a%s.foo%d:1|c|#rate:100%"
+
+
+@pytest.fixture
+def socket_path():
+    """Path for a Unix domain socket.
+
+    This doesn't use tmp_path because Unix domain socket paths have a short
+    maximum length.
+
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yield os.path.join(tmpdir, "dsd.sock")
+
+
+def uds_dgram_server(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(1)
+    return sock
+
+
+def test_uds_default_options(socket_path):
+    dsm = DogStatsdMetrics(options={"statsd_socket_path": socket_path})
+    assert dsm.socket_type == "dgram"
+    assert dsm.max_packet_size == 8192
+    assert repr(dsm) == f"<DogStatsdMetrics unixdgram://{socket_path}>"
+
+
+def test_uds_bad_socket_type(socket_path):
+    with pytest.raises(ValueError):
+        DogStatsdMetrics(
+            options={"statsd_socket_path": socket_path, "statsd_socket_type": "foo"}
+        )
+
+
+def test_uds_dgram(socket_path):
+    server = uds_dgram_server(socket_path)
+    dsm = DogStatsdMetrics(options={"statsd_socket_path": socket_path})
+    try:
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, ["key1:val"]))
+        assert server.recv(65535) == b"foo:1|c|#key1:val"
+
+        dsm.emit_batch_to_backend(
+            [MetricsRecord("incr", "foo", i, []) for i in range(3)]
+        )
+        assert server.recv(65535) == b"foo:0|c\nfoo:1|c\nfoo:2|c"
+        assert dsm.packets_sent == 2
+    finally:
+        dsm.close()
+        server.close()
+
+
+def test_uds_dgram_reconnects(socket_path):
+    dsm = DogStatsdMetrics(options={"statsd_socket_path": socket_path})
+    try:
+        # Nothing is listening, so this is dropped
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        assert dsm.packets_dropped == 1
+        assert dsm._sock is None
+
+        server = uds_dgram_server(socket_path)
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 2, []))
+        assert server.recv(65535) == b"foo:2|c"
+        assert dsm.packets_sent == 1
+
+        # The agent restarts, so the socket needs to be reconnected
+        server.close()
+        os.unlink(socket_path)
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 3, []))
+        assert dsm.packets_dropped == 2
+
+        server = uds_dgram_server(socket_path)
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 4, []))
+        assert server.recv(65535) == b"foo:4|c"
+        server.close()
+    finally:
+        dsm.close()
+
+
+def test_uds_stream(socket_path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    server.settimeout(1)
+    dsm = DogStatsdMetrics(
+        options={"statsd_socket_path": socket_path, "statsd_socket_type": "stream"}
+    )
+    try:
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        dsm.emit_batch_to_backend(
+            [MetricsRecord("gauge", "bar", i, []) for i in range(2)]
+        )
+
+        conn, _ = server.accept()
+        conn.settimeout(1)
+        data = b""
+        while len(data) < 30:
+            data += conn.recv(65535)
+        assert data == (
+            (7).to_bytes(4, "little")
+            + b"foo:1|c"
+            + (15).to_bytes(4, "little")
+            + b"bar:0|g\nbar:1|g"
+        )
+
+        # The agent hangs up, so the packet is dropped and the next one
+        # reconnects
+        conn.close()
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 2, []))
+        assert dsm.packets_dropped == 1
+
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 3, []))
+        conn, _ = server.accept()
+        conn.settimeout(1)
+        assert conn.recv(65535) == (7).to_bytes(4, "little") + b"foo:3|c"
+        conn.close()
+    finally:
+        dsm.close()
+        server.close()
+
+
+def test_after_fork_child(make_backend, udp_server):
+    dsm = make_backend(options={"flush_interval": 1000})
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+
+    # The parent sends buffered metrics before forking
+    dsm.before_fork()
+    assert recv_all(udp_server) == [b"foo:1|c"]
+
+    dsm.emit_to_backend(MetricsRecord("incr", "bar", 1, []))
+    old_stop = dsm._stop
+    old_thread = dsm._thread
+
+    # The child drops what the parent has buffered and starts its own thread
+    dsm.after_fork_child()
+    try:
+        assert dsm._buffer_len == 0
+        assert dsm._sock is None
+        assert dsm._thread is not old_thread
+        assert dsm._thread.is_alive()
+
+        dsm.emit_to_backend(MetricsRecord("incr", "baz", 1, []))
+        dsm.flush()
+        assert recv_all(udp_server) == [b"baz:1|c"]
+    finally:
+        # NOTE: this process didn't fork, so the old thread is still running
+        old_stop.set()
+
+
+@pytest.fixture
+def make_asyncio_backend(udp_server):
+    def _make_backend(options=None, filters=None):
+        options = options or {}
+        options.setdefault("statsd_host", "127.0.0.1")
+        options.setdefault("statsd_port", udp_server.getsockname()[1])
+        return AsyncioDogStatsdMetrics(options=options, filters=filters)
+
+    return _make_backend
+
+
+async def run_loop(times=10):
+    """Let the event loop run callbacks and tasks."""
+    for _ in range(times):
+        await asyncio.sleep(0)
+
+
+def test_asyncio_coalesces_records(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend()
+    assert repr(dsm).startswith("<AsyncioDogStatsdMetrics 127.0.0.1:")
+
+    async def main():
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        dsm.emit_to_backend(MetricsRecord("gauge", "bar", 2, ["key1:val"]))
+        dsm.emit_batch_to_backend(
+            [MetricsRecord("timing", "baz", i, []) for i in range(2)]
+        )
+        # Nothing is sent until the event loop gets a chance to run
+        assert dsm.packets_sent == 0
+        await run_loop()
+        assert dsm.packets_sent == 1
+
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 3, []))
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [
+        b"foo:1|c\nbar:2|g|#key1:val\nbaz:0|ms\nbaz:1|ms",
+        b"foo:3|c",
+    ]
+    assert dsm.packets_sent == 2
+
+
+def test_asyncio_packs_packets(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend(options={"max_packet_size": 30})
+
+    async def main():
+        for i in range(5):
+            dsm.emit_to_backend(MetricsRecord("incr", f"key{i}", 1, []))
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [
+        b"key0:1|c\nkey1:1|c\nkey2:1|c",
+        b"key3:1|c\nkey4:1|c",
+    ]
+
+
+def test_asyncio_emit_from_thread(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend()
+
+    async def main():
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        await run_loop()
+
+        thread = threading.Thread(
+            target=dsm.emit_to_backend,
+            args=(MetricsRecord("incr", "bar", 1, []),),
+        )
+        thread.start()
+        thread.join()
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [b"foo:1|c", b"bar:1|c"]
+
+
+def test_asyncio_queues_until_loop(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend(options={"max_queue_size": 2})
+
+    # There's no event loop yet, so these wait and the third is dropped
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 2, []))
+    dsm.emit_to_backend(MetricsRecord("incr", "foo", 3, []))
+    assert dsm.records_dropped == 1
+    # flush and close don't do anything without an event loop
+    dsm.flush()
+    dsm.close()
+
+    async def main():
+        # The queue is still full, so this is dropped, but it hands the queue
+        # to the event loop
+        dsm.emit_to_backend(MetricsRecord("incr", "bar", 1, []))
+        assert dsm.records_dropped == 2
+        await run_loop()
+        dsm.emit_to_backend(MetricsRecord("incr", "bar", 2, []))
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [b"foo:1|c\nfoo:2|c", b"bar:2|c"]
+
+
+def test_asyncio_new_loop(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend()
+
+    async def main(value):
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", value, []))
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main(1))
+    asyncio.run(main(2))
+    assert recv_all(udp_server) == [b"foo:1|c", b"foo:2|c"]
+
+
+def test_asyncio_flush_interval(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend(options={"flush_interval": 1000})
+    assert dsm.flush_interval == 1000
+    assert dsm._thread is None
+
+    async def main():
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        await run_loop()
+        # The transport is connected, but nothing is sent until the interval
+        assert dsm._transport is not None
+        assert dsm.packets_sent == 0
+
+        dsm.emit_to_backend(MetricsRecord("incr", "bar", 1, []))
+        dsm.flush()
+        assert dsm.packets_sent == 1
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [b"foo:1|c\nbar:1|c"]
+
+
+def test_asyncio_dropped_packets(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend()
+
+    async def main():
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        await run_loop()
+
+        # The transport's buffer is full, so packets are dropped
+        dsm._protocol.pause_writing()
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 2, []))
+        await run_loop()
+        assert dsm.packets_dropped == 1
+
+        dsm._protocol.resume_writing()
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 3, []))
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [b"foo:1|c", b"foo:3|c"]
+    assert dsm.packets_sent == 2
+
+
+def test_asyncio_aggregate_values(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend(options={"aggregate_values": True})
+
+    async def main():
+        for value in range(3):
+            dsm.emit_to_backend(MetricsRecord("distribution", "foo", value, []))
+        dsm.emit_batch_to_backend(
+            [
+                MetricsRecord("distribution", "foo", 3, []),
+                MetricsRecord("incr", "bar", 1, []),
+            ]
+        )
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [b"bar:1|c\nfoo:0:1:2:3|d"]
+
+
+def test_asyncio_uds_dgram(socket_path):
+    server = uds_dgram_server(socket_path)
+    dsm = AsyncioDogStatsdMetrics(options={"statsd_socket_path": socket_path})
+
+    async def main():
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        await run_loop()
+        dsm.close()
+
+    try:
+        asyncio.run(main())
+        assert server.recv(65535) == b"foo:1|c"
+    finally:
+        server.close()
+
+
+def test_asyncio_uds_stream(socket_path):
+    with pytest.raises(ValueError):
+        AsyncioDogStatsdMetrics(
+            options={"statsd_socket_path": socket_path, "statsd_socket_type": "stream"}
+        )
+
+
+def test_asyncio_after_fork_child(make_asyncio_backend, udp_server):
+    dsm = make_asyncio_backend()
+
+    async def main():
+        dsm.emit_to_backend(MetricsRecord("incr", "foo", 1, []))
+        await run_loop()
+        transport = dsm._transport
+
+        # The child drops the parent's queue, loop, and transport
+        dsm.emit_to_backend(MetricsRecord("incr", "bar", 1, []))
+        dsm.after_fork_child()
+        assert dsm._loop is None
+        assert dsm._transport is None
+        assert dsm.packets_sent == 0
+        transport.close()
+
+        dsm.emit_to_backend(MetricsRecord("incr", "baz", 1, []))
+        await run_loop()
+        dsm.close()
+
+    asyncio.run(main())
+    assert recv_all(udp_server) == [b"foo:1|c", b"baz:1|c"]
@@ -78,7 +78,8 @@ def test_validate_registered_metrics(schema):
         ),
         pytest.param(
             {"key": {"type": "foo", "description": "foo"}},
-            "key 'key' type is foo; not one of incr, gauge, timing, histogram",
+            "key 'key' type is foo; "
+            + "not one of incr, gauge, timing, histogram, distribution",
             id="invalid_type",
         ),
         pytest.param(
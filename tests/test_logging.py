@@ -3,6 +3,11 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import datetime
+import random
+import threading
+import time
+
+import pytest
 
 from markus.backends.logging import LoggingMetrics, LoggingRollupMetrics
 from markus.main import MetricsFilter, MetricsRecord
@@ -18,6 +23,13 @@ class TestLoggingMetrics:
             ("markus", 20, "METRICS|incr|foo|10|#key1:val,key2:val")
         ]
 
+    def test_incr_sample_rate(self, caplog):
+        caplog.set_level("DEBUG")
+        rec = MetricsRecord("incr", key="foo", value=1, tags=[], sample_rate=0.5)
+        lm = LoggingMetrics()
+        lm.emit_to_backend(rec)
+        assert caplog.record_tuples == [("markus", 20, "METRICS|incr|foo|2.0|")]
+
     def test_gauge(self, caplog):
         caplog.set_level("DEBUG")
         rec = MetricsRecord(
@@ -76,6 +88,19 @@ class TestLoggingMetrics:
         lm.emit_to_backend(MetricsRecord("incr", key="foo.blue", value=2, tags=[]))
         assert caplog.record_tuples == [("markus", 20, "METRICS|incr|foo.blue|2|")]
 
+    def test_emit_batch(self, caplog):
+        caplog.set_level("DEBUG")
+        lm = LoggingMetrics()
+        lm.emit_batch_to_backend(
+            [
+                MetricsRecord("incr", key="foo", value=1, tags=[]),
+                MetricsRecord("gauge", key="bar", value=10, tags=["key1:val"]),
+            ]
+        )
+        assert caplog.record_tuples == [
+            ("markus", 20, "METRICS|incr|foo|1|\nMETRICS|gauge|bar|10|#key1:val")
+        ]
+
     def test_utc_timezone_incr(self, caplog, time_machine):
         time_machine.move_to("2017-03-06 16:30:00 +0000", tick=False)
         caplog.set_level("DEBUG")
@@ -100,8 +125,85 @@ class TestLoggingMetrics:
             ("markus", 20, "METRICS|2017-03-06T16:30:00|incr|foo|10|#key1:val,key2:val")
         ]
 
+    def test_disabled_logger(self, caplog, monkeypatch):
+        caplog.set_level("WARNING")
+        lm = LoggingMetrics()
+
+        def _format(record, timestamp):
+            raise AssertionError("records shouldn't be formatted")
+
+        monkeypatch.setattr(lm, "_format", _format)
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        assert caplog.record_tuples == []
+
+    def test_percent_in_leader(self, caplog):
+        caplog.set_level("DEBUG")
+        lm = LoggingMetrics(options={"leader": "100%"})
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        assert caplog.record_tuples == [("markus", 20, "100%|incr|foo|1|")]
+
+    def test_background(self, caplog, time_machine):
+        time_machine.move_to("2017-03-06 16:30:00 +0000", tick=False)
+        caplog.set_level("DEBUG")
+        lm = LoggingMetrics(options={"timestamp_mode": "utc", "background": True})
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+
+        # The timestamp is when the record was emitted, not when it's logged
+        time_machine.move_to("2017-03-06 16:31:00 +0000", tick=False)
+        lm.emit_batch_to_backend(
+            [
+                MetricsRecord("incr", key="foo", value=2, tags=[]),
+                MetricsRecord("gauge", key="bar", value=10, tags=["key1:val"]),
+            ]
+        )
+        lm.close()
+
+        assert caplog.record_tuples == [
+            ("markus", 20, "METRICS|2017-03-06T16:30:00+00:00|incr|foo|1|"),
+            (
+                "markus",
+                20,
+                "METRICS|2017-03-06T16:31:00+00:00|incr|foo|2|\n"
+                + "METRICS|2017-03-06T16:31:00+00:00|gauge|bar|10|#key1:val",
+            ),
+        ]
+        # Closing again is fine
+        lm.close()
+
+    def test_background_emit_after_close(self, caplog):
+        caplog.set_level("DEBUG")
+        lm = LoggingMetrics(options={"background": True})
+        lm.close()
+
+        # Records emitted after closing are logged in this thread
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        assert caplog.record_tuples == [("markus", 20, "METRICS|incr|foo|1|")]
+
 
 class TestLoggingRollupMetrics:
+    def test_rollup_sample_rate(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+
+        time_machine.move_to(
+            datetime.datetime(2017, 4, 19, 12, 0, 0, tzinfo=datetime.timezone.utc),
+            tick=False,
+        )
+        lm = LoggingRollupMetrics()
+        for _ in range(3):
+            lm.emit_to_backend(
+                MetricsRecord("incr", key="foo", value=1, tags=None, sample_rate=0.1)
+            )
+
+        time_machine.move_to(
+            datetime.datetime(2017, 4, 19, 12, 0, 11, tzinfo=datetime.timezone.utc),
+            tick=False,
+        )
+        lm.rollup()
+
+        assert caplog.record_tuples == [
+            ("markus", 20, "ROLLUP INCR foo: count:30|rate:30/10"),
+        ]
+
     def test_rollup(self, caplog, time_machine):
         caplog.set_level("DEBUG")
 
@@ -138,6 +240,177 @@ class TestLoggingRollupMetrics:
                 "markus",
                 20,
                 "ROLLUP HISTOGRAM save_time: "
-                "count:2|min:50.00|avg:55.00|median:55.00|ninety-five:60.00|max:60.00",
+                "count:2|min:50.00|avg:55.00|p50:50.00|p95:59.75|p99:59.75|max:60.00",
+            ),
+        ]
+
+    def test_rollup_no_data(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+        time_machine.move_to("2017-04-19 12:00:00 +0000", tick=False)
+        lm = LoggingRollupMetrics()
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=None))
+        lm.emit_to_backend(MetricsRecord("gauge", key="widget", value=1, tags=None))
+        lm.emit_to_backend(MetricsRecord("timing", key="save_time", value=1, tags=None))
+
+        time_machine.move_to("2017-04-19 12:00:11 +0000", tick=False)
+        lm.rollup()
+        caplog.clear()
+
+        time_machine.move_to("2017-04-19 12:00:22 +0000", tick=False)
+        lm.rollup()
+        assert caplog.record_tuples == [
+            ("markus", 20, "ROLLUP INCR foo: count:0|rate:0/10"),
+            ("markus", 20, "ROLLUP (gauge) widget: no data"),
+            ("markus", 20, "ROLLUP (histogram) save_time: no data"),
+        ]
+
+    def test_rollup_percentiles(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+        time_machine.move_to("2017-04-19 12:00:00 +0000", tick=False)
+        lm = LoggingRollupMetrics(options={"percentiles": [50, 90, 99, 99.9]})
+
+        # Values arrive out of order; percentiles shouldn't depend on that
+        values = list(range(1, 1001))
+        random.Random(0).shuffle(values)
+        for value in values:
+            lm.emit_to_backend(
+                MetricsRecord("timing", key="save_time", value=value, tags=None)
+            )
+
+        time_machine.move_to("2017-04-19 12:00:11 +0000", tick=False)
+        lm.rollup()
+
+        line = caplog.record_tuples[0][2]
+        assert line.startswith("ROLLUP HISTOGRAM save_time: count:1000|min:1.00|")
+        stats = dict(item.split(":") for item in line.split(": ", 1)[1].split("|"))
+        assert float(stats["avg"]) == 500.5
+        assert float(stats["max"]) == 1000
+        for label, expected in [
+            ("p50", 500),
+            ("p90", 900),
+            ("p99", 990),
+            ("p999", 999),
+        ]:
+            assert abs(float(stats[label]) - expected) <= expected * 0.01
+
+    def test_rollup_bad_percentile(self):
+        with pytest.raises(ValueError):
+            LoggingRollupMetrics(options={"percentiles": [101]})
+
+    def test_rollup_tags(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+        time_machine.move_to("2017-04-19 12:00:00 +0000", tick=False)
+        lm = LoggingRollupMetrics()
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=None))
+        lm.emit_to_backend(
+            MetricsRecord("incr", key="foo", value=1, tags=["env:prod", "color:red"])
+        )
+        # Same tags in a different order roll up together
+        lm.emit_to_backend(
+            MetricsRecord("incr", key="foo", value=1, tags=["color:red", "env:prod"])
+        )
+        lm.emit_to_backend(
+            MetricsRecord("gauge", key="widget", value=5, tags=["env:prod"])
+        )
+        lm.emit_to_backend(
+            MetricsRecord("timing", key="save_time", value=50, tags=["env:prod"])
+        )
+
+        time_machine.move_to("2017-04-19 12:00:11 +0000", tick=False)
+        lm.rollup()
+
+        assert caplog.record_tuples == [
+            ("markus", 20, "ROLLUP INCR foo: count:1|rate:1/10"),
+            ("markus", 20, "ROLLUP INCR foo #color:red,env:prod: count:2|rate:2/10"),
+            (
+                "markus",
+                20,
+                "ROLLUP GAUGE widget #env:prod: count:1|current:5|min:5|max:5",
+            ),
+            (
+                "markus",
+                20,
+                "ROLLUP HISTOGRAM save_time #env:prod: "
+                "count:1|min:50.00|avg:50.00|p50:50.00|p95:50.00|p99:50.00|max:50.00",
             ),
         ]
+
+    def test_rollup_aligned_to_interval(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+        time_machine.move_to("2017-04-19 12:00:07 +0000", tick=False)
+        lm = LoggingRollupMetrics()
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=None))
+
+        # The period ends at 12:00:10 and not 10 seconds after the first stat
+        time_machine.move_to("2017-04-19 12:00:09 +0000", tick=False)
+        lm.rollup()
+        assert caplog.record_tuples == []
+
+        time_machine.move_to("2017-04-19 12:00:10 +0000", tick=False)
+        lm.rollup()
+        assert caplog.record_tuples == [
+            ("markus", 20, "ROLLUP INCR foo: count:1|rate:1/10"),
+        ]
+
+    def test_rollup_threads(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+        time_machine.move_to("2017-04-19 12:00:00 +0000", tick=False)
+        lm = LoggingRollupMetrics()
+
+        def emit_stats():
+            for i in range(1000):
+                lm.emit_to_backend(
+                    MetricsRecord("incr", key="foo", value=1, tags=[f"n:{i % 10}"])
+                )
+
+        threads = [threading.Thread(target=emit_stats) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        time_machine.move_to("2017-04-19 12:00:11 +0000", tick=False)
+        lm.rollup()
+
+        assert caplog.record_tuples == [
+            ("markus", 20, f"ROLLUP INCR foo #n:{i}: count:400|rate:400/10")
+            for i in range(10)
+        ]
+
+    def test_rollup_after_fork_child(self, caplog, time_machine):
+        caplog.set_level("DEBUG")
+        time_machine.move_to("2017-04-19 12:00:00 +0000", tick=False)
+        lm = LoggingRollupMetrics()
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=None))
+
+        # The child drops the stats the parent has
+        lm.after_fork_child()
+        lm.emit_to_backend(MetricsRecord("incr", key="bar", value=1, tags=None))
+
+        time_machine.move_to("2017-04-19 12:00:11 +0000", tick=False)
+        lm.rollup()
+        assert caplog.record_tuples == [
+            ("markus", 20, "ROLLUP INCR bar: count:1|rate:1/10"),
+        ]
+
+    def test_rollup_background(self, caplog):
+        caplog.set_level("DEBUG")
+        lm = LoggingRollupMetrics(options={"flush_interval": 0.05, "background": True})
+        lm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=None))
+
+        # The background thread generates a rollup without any more stats
+        # being emitted
+        deadline = time.monotonic() + 5
+        while not caplog.record_tuples and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert caplog.record_tuples[0][2].startswith("ROLLUP INCR foo: count:1|")
+
+        # Closing rolls up what's left
+        lm.emit_to_backend(MetricsRecord("incr", key="bar", value=1, tags=None))
+        lm.close()
+        assert any(
+            msg.startswith("ROLLUP INCR bar: count:1|")
+            for _, _, msg in caplog.record_tuples
+        )
+        # Closing again is fine
+        lm.close()
@@ -1,10 +1,21 @@
+import asyncio
+import inspect
+import os
+import threading
+import time
+import weakref
+
 import pytest
 
+import markus
+import markus.main
 from markus import get_metrics
 from markus.filters import AddTagFilter
-from markus.main import MetricsRecord
+from markus.main import MetricsFilter, MetricsRecord, _change_metrics
 from markus.testing import MetricsMock
 
+from conftest import RecordingMetrics
+
 
 @pytest.fixture
 def metricsmock():
@@ -71,6 +82,70 @@ def test_dunders():
     assert record == record2
 
 
+def test_record_slots():
+    record = MetricsRecord("incr", "foo", 10, None)
+    assert not hasattr(record, "__dict__")
+    assert record.tags == []
+    assert repr(record) == "<MetricsRecord type=incr key=foo value=10 tags=[]>"
+
+
+def test_record_copy_tags_independent():
+    record = MetricsRecord("incr", "foo", 10, ["a:b"])
+    record2 = record.__copy__()
+    record2.tags.append("c:d")
+    assert record.tags == ["a:b"]
+    assert record2.tags == ["a:b", "c:d"]
+    assert record != record2
+
+
+def test_record_copy_value_ns():
+    record = MetricsRecord("timing", "foo", 1.5, [], value_ns=1_500_000)
+    record2 = record.__copy__()
+    assert record2.value_ns == 1_500_000
+    assert record == record2
+
+
+@pytest.mark.parametrize(
+    "record, unit, expected",
+    [
+        (MetricsRecord("timing", "foo", 1.5, [], value_ns=1_500_000), "ns", 1_500_000),
+        (MetricsRecord("timing", "foo", 1.5, [], value_ns=1_500_000), "us", 1500.0),
+        (MetricsRecord("timing", "foo", 1.5, [], value_ns=1_500_000), "ms", 1.5),
+        (MetricsRecord("timing", "foo", 1.5, [], value_ns=1_500_000), "s", 0.0015),
+        (MetricsRecord("timing", "foo", 1.5, []), "ns", 1_500_000),
+        (MetricsRecord("timing", "foo", 1.5, []), "us", 1500.0),
+        (MetricsRecord("timing", "foo", 1.5, []), "s", 0.0015),
+    ],
+)
+def test_record_value_in(record, unit, expected):
+    value = record.value_in(unit)
+    assert value == expected
+    assert type(value) is type(expected)
+
+
+def test_record_tags_tuple():
+    record = MetricsRecord("incr", "foo", 10, ["a:b"])
+    assert record.tags_tuple == ("a:b",)
+    # tags_tuple doesn't convert tags to a list
+    assert type(record._tags) is tuple
+
+    record.tags.append("c:d")
+    assert record.tags_tuple == ("a:b", "c:d")
+
+
+def test_record_does_not_share_caller_tags(metricsmock):
+    metrics = get_metrics("thing", filters=[AddTagFilter("foo:bar")])
+    tags = ["color:blue"]
+
+    with metricsmock as mm:
+        metrics.incr("foo", value=5, tags=tags)
+
+    assert tags == ["color:blue"]
+    assert mm.get_records() == [
+        MetricsRecord("incr", "thing.foo", 5, ["color:blue", "foo:bar"])
+    ]
+
+
 def test_incr(metricsmock):
     metrics = get_metrics("thing")
 
@@ -107,6 +182,17 @@ def test_histogram(metricsmock):
     assert mm.get_records() == [MetricsRecord("histogram", "thing.foo", 4321, [])]
 
 
+def test_distribution(metricsmock):
+    metrics = get_metrics("thing")
+
+    with metricsmock as mm:
+        metrics.distribution("foo", value=4321, tags=["color:blue"])
+
+    assert mm.get_records() == [
+        MetricsRecord("distribution", "thing.foo", 4321, ["color:blue"])
+    ]
+
+
 def test_timer_contextmanager(metricsmock):
     metrics = get_metrics("thing")
 
@@ -128,3 +214,598 @@ def test_timer_decorator(metricsmock):
         something()
 
     assert mm.has_record(fun_name="timing", stat="thing.long_fun")
+
+
+def test_timer_value_ns(metricsmock):
+    metrics = get_metrics("thing")
+    handle = metrics.timer_handle("handle")
+
+    @metrics.timer_decorator("decorator")
+    def something():
+        pass
+
+    with metricsmock as mm:
+        with metrics.timer("timer"):
+            pass
+        with handle.timer():
+            pass
+        something()
+        metrics.timing("timing", value=10)
+
+    records = mm.get_records()
+    assert [record.key for record in records] == [
+        "thing.timer",
+        "thing.handle",
+        "thing.decorator",
+        "thing.timing",
+    ]
+    for record in records[:3]:
+        assert type(record.value_ns) is int
+        assert record.value == record.value_ns / 1_000_000
+    assert records[3].value_ns is None
+
+
+def test_timer_reusable(metricsmock):
+    metrics = get_metrics("thing")
+
+    with metricsmock as mm:
+        timer = metrics.timer("long_fun")
+        with timer:
+            pass
+        with timer:
+            pass
+
+    assert len(mm.filter_records("timing", stat="thing.long_fun")) == 2
+
+
+def test_timer_exception(metricsmock):
+    metrics = get_metrics("thing")
+
+    with metricsmock as mm:
+        with pytest.raises(ValueError):
+            with metrics.timer("long_fun"):
+                raise ValueError("boom")
+
+    assert mm.get_records() == []
+
+
+def test_timer_async_contextmanager(metricsmock):
+    metrics = get_metrics("thing")
+
+    async def something():
+        async with metrics.timer("long_fun"):
+            await asyncio.sleep(0.01)
+
+    with metricsmock as mm:
+        asyncio.run(something())
+
+    records = mm.filter_records("timing", stat="thing.long_fun")
+    assert len(records) == 1
+    assert records[0].value >= 5
+
+
+def test_timer_async_contextmanager_inactive():
+    _change_metrics([])
+    metrics = get_metrics("thing")
+
+    async def something():
+        async with metrics.timer("long_fun"):
+            return 5
+
+    assert asyncio.run(something()) == 5
+
+
+def test_timer_decorator_coroutine(metricsmock):
+    metrics = get_metrics("thing")
+
+    @metrics.timer_decorator("long_fun", tags=["color:blue"])
+    async def something(value):
+        await asyncio.sleep(0.01)
+        return value
+
+    assert inspect.iscoroutinefunction(something)
+    with metricsmock as mm:
+        assert asyncio.run(something(5)) == 5
+
+    records = mm.filter_records("timing", stat="thing.long_fun", tags=["color:blue"])
+    assert len(records) == 1
+    # NOTE: this is the time the coroutine ran including awaiting and
+    # not just the time it took to create it
+    assert records[0].value >= 5
+
+
+def test_timer_decorator_coroutine_exception(metricsmock):
+    metrics = get_metrics("thing")
+
+    @metrics.timer_decorator("long_fun")
+    async def something():
+        raise ValueError("boom")
+
+    with metricsmock as mm:
+        with pytest.raises(ValueError):
+            asyncio.run(something())
+
+    assert mm.get_records() == []
+
+
+def test_timer_decorator_generator(metricsmock):
+    metrics = get_metrics("thing")
+
+    @metrics.timer_decorator("long_fun")
+    def something():
+        received = yield 1
+        time.sleep(0.01)
+        yield received
+        return "done"
+
+    assert inspect.isgeneratorfunction(something)
+    with metricsmock as mm:
+        gen = something()
+        assert mm.get_records() == []
+        assert next(gen) == 1
+        assert gen.send("sent") == "sent"
+        with pytest.raises(StopIteration) as excinfo:
+            next(gen)
+
+    assert excinfo.value.value == "done"
+    records = mm.filter_records("timing", stat="thing.long_fun")
+    assert len(records) == 1
+    assert records[0].value >= 5
+
+
+def test_timer_decorator_generator_closed(metricsmock):
+    metrics = get_metrics("thing")
+
+    @metrics.timer_decorator("long_fun")
+    def something():
+        yield 1
+        yield 2
+
+    with metricsmock as mm:
+        gen = something()
+        next(gen)
+        gen.close()
+
+    assert mm.get_records() == []
+
+
+def test_timer_decorator_async_generator(metricsmock):
+    metrics = get_metrics("thing")
+
+    @metrics.timer_decorator("long_fun")
+    async def something():
+        received = yield 1
+        await asyncio.sleep(0.01)
+        try:
+            yield received
+        except KeyError:
+            yield "caught"
+
+    async def consume():
+        agen = something()
+        items = [await agen.__anext__()]
+        items.append(await agen.asend("sent"))
+        items.append(await agen.athrow(KeyError()))
+        with pytest.raises(StopAsyncIteration):
+            await agen.__anext__()
+        return items
+
+    assert inspect.isasyncgenfunction(something)
+    with metricsmock as mm:
+        assert asyncio.run(consume()) == [1, "sent", "caught"]
+
+    records = mm.filter_records("timing", stat="thing.long_fun")
+    assert len(records) == 1
+    assert records[0].value >= 5
+
+
+def test_timer_decorator_async_generator_closed(metricsmock):
+    metrics = get_metrics("thing")
+    closed = []
+
+    @metrics.timer_decorator("long_fun")
+    async def something():
+        try:
+            yield 1
+            yield 2
+        finally:
+            closed.append(True)
+
+    async def consume():
+        agen = something()
+        assert await agen.__anext__() == 1
+        await agen.aclose()
+
+    with metricsmock as mm:
+        asyncio.run(consume())
+
+    assert closed == [True]
+    assert mm.get_records() == []
+
+
+def test_publish_shares_record_without_mutating_filters(configure_backends):
+    class ReadOnlyFilter(MetricsFilter):
+        mutates = False
+
+    backend1 = RecordingMetrics()
+    backend2 = RecordingMetrics(filters=[ReadOnlyFilter()])
+    configure_backends([backend1, backend2])
+    get_metrics("thing").incr("foo")
+
+    assert backend1.records[0] is backend2.records[0]
+
+
+def test_publish_copies_record_for_mutating_filters(configure_backends):
+    backend1 = RecordingMetrics(filters=[AddTagFilter("color:blue")])
+    backend2 = RecordingMetrics()
+    configure_backends([backend1, backend2])
+    get_metrics("thing").incr("foo")
+
+    assert backend1.records == [MetricsRecord("incr", "thing.foo", 1, ["color:blue"])]
+    assert backend2.records == [MetricsRecord("incr", "thing.foo", 1, [])]
+
+
+def test_publish_after_reconfigure(configure_backends):
+    metrics = get_metrics("thing")
+    backend1 = RecordingMetrics()
+    backend2 = RecordingMetrics()
+
+    configure_backends([backend1])
+    metrics.incr("foo")
+    configure_backends([backend2])
+    metrics.incr("bar")
+
+    assert backend1.records == [MetricsRecord("incr", "thing.foo", 1, [])]
+    assert backend2.records == [MetricsRecord("incr", "thing.bar", 1, [])]
+
+
+def test_reconfigure_closes_old_backends(configure_backends):
+    backend1 = RecordingMetrics()
+    backend2 = RecordingMetrics()
+    backend3 = RecordingMetrics()
+
+    configure_backends([backend1, backend2])
+    configure_backends([backend2, backend3])
+    assert (backend1.closed, backend2.closed, backend3.closed) == (1, 0, 0)
+
+    configure_backends([])
+    assert (backend1.closed, backend2.closed, backend3.closed) == (1, 1, 1)
+
+
+def test_reconfigure_close_exception(configure_backends, caplog):
+    class BrokenBackend(RecordingMetrics):
+        def close(self):
+            raise Exception("broken")
+
+    backend1 = BrokenBackend()
+    backend2 = RecordingMetrics()
+    configure_backends([backend1, backend2])
+    configure_backends([])
+
+    assert backend2.closed == 1
+    assert "Exception thrown while closing" in caplog.text
+
+
+def test_reconfigure_stops_threads():
+    def markus_threads():
+        return sorted(
+            thread.name
+            for thread in threading.enumerate()
+            if thread.name.startswith("markus-")
+        )
+
+    before = markus_threads()
+    try:
+        for _ in range(3):
+            markus.configure(
+                [
+                    {
+                        "class": "markus.backends.dogstatsd.DogStatsdMetrics",
+                        "options": {"flush_interval": 10},
+                    },
+                    {
+                        "class": "markus.backends.prometheus.PrometheusMetrics",
+                        "options": {"http_host": "127.0.0.1", "http_port": 0},
+                    },
+                ]
+            )
+        assert markus_threads() == sorted(
+            before + ["markus-dogstatsd", "markus-prometheus"]
+        )
+    finally:
+        _change_metrics([])
+    assert markus_threads() == before
+
+
+def test_publish_emit_to_backend_override(configure_backends):
+    class OverrideBackend(RecordingMetrics):
+        def emit_to_backend(self, record):
+            self.records.append(("emit_to_backend", record))
+
+    backend = OverrideBackend()
+    configure_backends([backend])
+    get_metrics("thing").incr("foo")
+
+    assert backend.records == [
+        ("emit_to_backend", MetricsRecord("incr", "thing.foo", 1, []))
+    ]
+
+
+def test_no_backends_does_no_work(configure_backends, monkeypatch):
+    class ExplodingFilter(MetricsFilter):
+        def filter(self, record):
+            raise AssertionError("filter should not run")
+
+    def exploding_perf_counter_ns():
+        raise AssertionError("perf_counter_ns should not run")
+
+    configure_backends([])
+    metrics = get_metrics("thing", filters=[ExplodingFilter()])
+    monkeypatch.setattr(markus.main, "perf_counter_ns", exploding_perf_counter_ns)
+
+    metrics.incr("foo")
+    metrics.gauge("foo", value=1)
+    metrics.timing("foo", value=1)
+    metrics.histogram("foo", value=1)
+    with metrics.timer("foo"):
+        pass
+
+    @metrics.timer_decorator("foo")
+    def something():
+        return 5
+
+    assert something() == 5
+
+    @metrics.timer_decorator("foo")
+    async def something_agen():
+        yield 5
+
+    async def consume():
+        return [item async for item in something_agen()]
+
+    assert asyncio.run(consume()) == [5]
+
+
+@pytest.mark.parametrize(
+    "stat, expected",
+    [
+        ("foo", "thing.foo"),
+        ("foo-bar", "thing.foo.bar"),
+        (".foo..bar.", "thing.foo.bar"),
+    ],
+)
+def test_full_stat_sanitized(metricsmock, stat, expected):
+    metrics = get_metrics("thing")
+
+    with metricsmock as mm:
+        metrics.incr(stat)
+
+    assert mm.get_records() == [MetricsRecord("incr", expected, 1, [])]
+
+
+def test_stat_cache_info():
+    metrics = get_metrics("thing")
+    before = metrics.stat_cache_info()
+    key1 = metrics._full_stat("cache.foo")
+    key2 = metrics._full_stat("cache.foo")
+    metrics._full_stat("cache.bar")
+
+    assert key1 is key2
+    info = metrics.stat_cache_info()
+    assert info.hits - before.hits == 1
+    assert info.misses - before.misses == 2
+
+    # The cache is shared by all MetricsInterface instances
+    assert get_metrics("thing")._full_stat("cache.foo") is key1
+    assert get_metrics("thing").stat_cache_info().hits - before.hits == 2
+
+
+def test_metrics_interface_is_collected():
+    metrics = get_metrics("thing")
+    metrics.incr("foo")
+    ref = weakref.ref(metrics)
+    del metrics
+    # The stat cache doesn't hold onto the MetricsInterface, so it's freed
+    # without waiting for the garbage collector
+    assert ref() is None
+
+
+def test_counter_handle(metricsmock):
+    metrics = get_metrics("thing")
+    counter = metrics.counter("foo", tags=["color:blue"])
+
+    with metricsmock as mm:
+        counter.incr()
+        counter.incr(value=5)
+
+    assert mm.get_records() == [
+        MetricsRecord("incr", "thing.foo", 1, ["color:blue"]),
+        MetricsRecord("incr", "thing.foo", 5, ["color:blue"]),
+    ]
+
+
+def test_timer_handle(metricsmock):
+    metrics = get_metrics("thing")
+    timer = metrics.timer_handle("foo")
+
+    with metricsmock as mm:
+        timer.timing(100)
+        with timer.timer():
+            pass
+
+    assert mm.filter_records("timing", stat="thing.foo", value=100)
+    assert len(mm.filter_records("timing", stat="thing.foo")) == 2
+
+
+def test_handle_follows_configure(configure_backends):
+    metrics = get_metrics("thing", filters=[AddTagFilter("color:blue")])
+    counter = metrics.counter("foo")
+    backend1 = RecordingMetrics()
+    backend2 = RecordingMetrics()
+
+    counter.incr()
+    configure_backends([backend1])
+    counter.incr()
+    configure_backends([backend2])
+    counter.incr(value=2)
+
+    assert backend1.records == [MetricsRecord("incr", "thing.foo", 1, ["color:blue"])]
+    assert backend2.records == [MetricsRecord("incr", "thing.foo", 2, ["color:blue"])]
+
+
+class BatchRecordingMetrics(RecordingMetrics):
+    def emit_batch(self, records):
+        self.records.append(list(records))
+
+
+def test_batch(configure_backends):
+    metrics = get_metrics("thing")
+    backend = BatchRecordingMetrics()
+    configure_backends([backend])
+
+    with metrics.batch() as batch:
+        batch.incr("foo")
+        batch.gauge("bar", value=10, tags=["color:blue"])
+        batch.timing("baz", value=100)
+        batch.histogram("qux", value=1000)
+        batch.distribution("quux", value=10000)
+        assert backend.records == []
+
+    assert backend.records == [
+        [
+            MetricsRecord("incr", "thing.foo", 1, []),
+            MetricsRecord("gauge", "thing.bar", 10, ["color:blue"]),
+            MetricsRecord("timing", "thing.baz", 100, []),
+            MetricsRecord("histogram", "thing.qux", 1000, []),
+            MetricsRecord("distribution", "thing.quux", 10000, []),
+        ]
+    ]
+
+
+def test_emit_many_filters(configure_backends):
+    class DropBarFilter(MetricsFilter):
+        mutates = False
+
+        def filter(self, record):
+            if record.key != "bar":
+                return record
+
+    metrics = get_metrics("thing", filters=[DropBarFilter()])
+    backend1 = BatchRecordingMetrics(filters=[AddTagFilter("color:blue")])
+    backend2 = BatchRecordingMetrics()
+    backend3 = RecordingMetrics()
+    configure_backends([backend1, backend2, backend3])
+
+    metrics.emit_many(
+        [
+            MetricsRecord("incr", "foo", 1, []),
+            MetricsRecord("incr", "bar", 1, []),
+        ]
+    )
+
+    assert backend1.records == [[MetricsRecord("incr", "foo", 1, ["color:blue"])]]
+    assert backend2.records == [[MetricsRecord("incr", "foo", 1, [])]]
+    assert backend3.records == [MetricsRecord("incr", "foo", 1, [])]
+
+
+def test_batch_metricsmock(metricsmock):
+    metrics = get_metrics("thing")
+
+    with metricsmock as mm:
+        with metrics.batch() as batch:
+            batch.incr("foo")
+            batch.incr("bar")
+
+    assert mm.get_records() == [
+        MetricsRecord("incr", "thing.foo", 1, []),
+        MetricsRecord("incr", "thing.bar", 1, []),
+    ]
+
+
+@pytest.mark.parametrize("fun_name", ["incr", "timing", "histogram"])
+def test_sample_rate(metricsmock, monkeypatch, fun_name):
+    metrics = get_metrics("thing")
+    random_values = iter([0.5, 0.05])
+    monkeypatch.setattr(markus.main, "random", lambda: next(random_values))
+
+    with metricsmock as mm:
+        # First one is rejected, second one is sampled
+        getattr(metrics, fun_name)("foo", value=1, sample_rate=0.1)
+        getattr(metrics, fun_name)("foo", value=2, sample_rate=0.1)
+
+    assert mm.get_records() == [
+        MetricsRecord(fun_name, "thing.foo", 2, [], sample_rate=0.1)
+    ]
+
+
+def test_flush(configure_backends, caplog):
+    class FlushingBackend(RecordingMetrics):
+        flushed = 0
+
+        def flush(self):
+            self.flushed += 1
+
+    class BrokenBackend(RecordingMetrics):
+        def flush(self):
+            raise Exception("broken")
+
+    plain = RecordingMetrics()
+    flushing = FlushingBackend()
+    configure_backends([plain, BrokenBackend(), flushing])
+
+    markus.flush()
+    assert flushing.flushed == 1
+    assert "Exception thrown while flushing" in caplog.text
+
+
+def test_before_fork_flushes():
+    class FlushingBackend(RecordingMetrics):
+        flushed = 0
+
+        def flush(self):
+            self.flushed += 1
+
+    backend = FlushingBackend()
+    backend.before_fork()
+    assert backend.flushed == 1
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_fork_hooks(configure_backends, caplog):
+    class ForkingBackend(RecordingMetrics):
+        before = 0
+        after = 0
+
+        def before_fork(self):
+            self.before += 1
+
+        def after_fork_child(self):
+            self.after += 1
+
+    class BrokenBackend(RecordingMetrics):
+        def before_fork(self):
+            raise Exception("broken")
+
+        def after_fork_child(self):
+            raise Exception("broken")
+
+    forking = ForkingBackend()
+    configure_backends([BrokenBackend(), forking])
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Child process: report what was called and exit
+        os.write(write_fd, f"{forking.before} {forking.after}".encode("ascii"))
+        os._exit(0)
+
+    os.close(write_fd)
+    os.waitpid(pid, 0)
+    with os.fdopen(read_fd, "rb") as fp:
+        child = fp.read()
+
+    # The parent called before_fork and the child called after_fork_child
+    assert forking.before == 1
+    assert forking.after == 0
+    assert child == b"1 1"
+    assert "Exception thrown before fork" in caplog.text
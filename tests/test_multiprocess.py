@@ -0,0 +1,205 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import math
+import os
+
+import pytest
+
+import markus
+import markus.main
+from markus.backends import multiprocess
+from markus.backends.multiprocess import MultiprocessMetrics, collect
+from markus.backends.prometheus import PrometheusMetrics
+from markus.main import MetricsRecord, _change_metrics
+
+
+@pytest.fixture(autouse=True)
+def close_files():
+    yield
+    multiprocess._close_files()
+    _change_metrics([])
+
+
+def fork(func):
+    """Run func in a forked child process and wait for it to finish."""
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+def test_directory_is_required():
+    with pytest.raises(ValueError):
+        MultiprocessMetrics()
+
+
+def test_incr(tmp_path):
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    mm.emit(MetricsRecord("incr", key="foo", value=5, tags=[]))
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=[], sample_rate=0.5))
+    assert collect(str(tmp_path)) == {("incr", "foo", ()): 8}
+
+
+def test_gauge(tmp_path):
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm.emit(MetricsRecord("gauge", key="foo", value=10, tags=[]))
+    mm.emit(MetricsRecord("gauge", key="foo", value=5, tags=[]))
+    assert collect(str(tmp_path)) == {("gauge", "foo", ()): 5}
+
+
+@pytest.mark.parametrize("stat_type", ["timing", "histogram", "distribution"])
+def test_histogram(tmp_path, stat_type):
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path), "buckets": [10, 100]})
+    for value in [5, 10, 50, 500]:
+        mm.emit(MetricsRecord(stat_type, key="foo", value=value, tags=[]))
+    assert collect(str(tmp_path)) == {
+        (stat_type, "foo", ()): {
+            "buckets": {10.0: 2, 100.0: 1, math.inf: 1},
+            "sum": 565,
+            "count": 4,
+        }
+    }
+
+
+def test_tags(tmp_path):
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=["b:2", "a:1"]))
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=["a:1", "b:2"]))
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=["a:2"]))
+    assert collect(str(tmp_path)) == {
+        ("incr", "foo", ("a:1", "b:2")): 2,
+        ("incr", "foo", ("a:2",)): 1,
+    }
+
+
+def test_backends_share_file(tmp_path):
+    mm1 = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm2 = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm1.emit(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    mm2.emit(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    mm2.emit(MetricsRecord("incr", key="bar", value=1, tags=[]))
+    assert len(os.listdir(tmp_path)) == 1
+    assert collect(str(tmp_path)) == {
+        ("incr", "foo", ()): 2,
+        ("incr", "bar", ()): 1,
+    }
+
+
+def test_file_grows(tmp_path, monkeypatch):
+    monkeypatch.setattr(multiprocess, "INITIAL_FILE_SIZE", 64)
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    for i in range(100):
+        mm.emit(MetricsRecord("incr", key=f"foo{i}", value=i, tags=[]))
+    mm.emit(MetricsRecord("incr", key="foo0", value=1, tags=[]))
+
+    merged = collect(str(tmp_path))
+    assert len(merged) == 100
+    assert merged[("incr", "foo0", ())] == 1
+    assert merged[("incr", "foo99", ())] == 99
+
+
+def test_existing_file(tmp_path):
+    # A new process with the same process id as one that exited picks up
+    # where the old file left off
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=[]))
+
+    multiprocess._close_files()
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path)})
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    mm.emit(MetricsRecord("incr", key="bar", value=1, tags=[]))
+    assert collect(str(tmp_path)) == {
+        ("incr", "foo", ()): 2,
+        ("incr", "bar", ()): 1,
+    }
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_processes_are_merged(tmp_path):
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path), "buckets": [10]})
+    _change_metrics([mm])
+    mm.emit(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    mm.emit(MetricsRecord("gauge", key="bar", value=1, tags=[]))
+    mm.emit(MetricsRecord("timing", key="baz", value=5, tags=[]))
+
+    def child():
+        # The child inherits the configured backend and writes to its own file
+        mm.emit(MetricsRecord("incr", key="foo", value=2, tags=[]))
+        mm.emit(MetricsRecord("gauge", key="bar", value=2, tags=[]))
+        mm.emit(MetricsRecord("timing", key="baz", value=50, tags=[]))
+
+    fork(child)
+
+    assert len(os.listdir(tmp_path)) == 2
+    assert collect(str(tmp_path)) == {
+        ("incr", "foo", ()): 3,
+        # The child set the gauge last
+        ("gauge", "bar", ()): 2,
+        ("timing", "baz", ()): {
+            "buckets": {10.0: 1, math.inf: 1},
+            "sum": 55,
+            "count": 2,
+        },
+    }
+
+    # The parent still writes to its own file
+    mm.emit(MetricsRecord("gauge", key="bar", value=3, tags=[]))
+    assert collect(str(tmp_path))[("gauge", "bar", ())] == 3
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_backends_share_file_after_fork(tmp_path):
+    options = {"directory": str(tmp_path)}
+    markus.configure([{"class": MultiprocessMetrics, "options": options}])
+    [backend1] = markus.main._get_metrics_backends()
+
+    def child():
+        # A backend created in the child shares the child's file with the
+        # backend that was configured in the parent
+        markus.configure(
+            [
+                {"class": MultiprocessMetrics, "options": options},
+                {"class": MultiprocessMetrics, "options": options},
+            ]
+        )
+        backend2, backend3 = markus.main._get_metrics_backends()
+        backend1.emit(MetricsRecord("incr", key="from_1", value=5, tags=[]))
+        backend2.emit(MetricsRecord("incr", key="from_2", value=7, tags=[]))
+        backend3.emit(MetricsRecord("incr", key="from_3", value=9, tags=[]))
+
+    fork(child)
+
+    assert collect(str(tmp_path)) == {
+        ("incr", "from_1", ()): 5,
+        ("incr", "from_2", ()): 7,
+        ("incr", "from_3", ()): 9,
+    }
+
+
+def test_prometheus_multiprocess_directory(tmp_path):
+    mm = MultiprocessMetrics(options={"directory": str(tmp_path), "buckets": [10]})
+    mm.emit(MetricsRecord("incr", key="app.foo", value=1, tags=["env:prod"]))
+    mm.emit(MetricsRecord("gauge", key="app.bar", value=5, tags=[]))
+    mm.emit(MetricsRecord("timing", key="app.baz", value=5, tags=[]))
+    mm.emit(MetricsRecord("timing", key="app.baz", value=50, tags=[]))
+
+    pm = PrometheusMetrics(
+        options={"start_server": False, "multiprocess_directory": str(tmp_path)}
+    )
+    assert pm.render().decode("utf-8").splitlines() == [
+        "# TYPE app_bar gauge",
+        "app_bar 5.0",
+        "# TYPE app_foo_total counter",
+        'app_foo_total{env="prod"} 1.0',
+        "# TYPE app_baz histogram",
+        'app_baz_bucket{le="10.0"} 1.0',
+        'app_baz_bucket{le="+Inf"} 2.0',
+        "app_baz_sum 55.0",
+        "app_baz_count 2.0",
+    ]
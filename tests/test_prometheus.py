@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import urllib.error
+import urllib.request
+
+import pytest
+
+import markus
+import markus.main
+from markus.backends.prometheus import PrometheusMetrics
+from markus.main import MetricsRecord, _change_metrics
+
+
+@pytest.fixture
+def pm():
+    return PrometheusMetrics(options={"start_server": False, "buckets": [10, 100]})
+
+
+def render(pm):
+    return pm.render().decode("utf-8").splitlines()
+
+
+def test_incr(pm):
+    pm.emit(MetricsRecord("incr", key="app.foo", value=1, tags=[]))
+    pm.emit(MetricsRecord("incr", key="app.foo", value=5, tags=[]))
+    assert render(pm) == [
+        "# TYPE app_foo_total counter",
+        "app_foo_total 6.0",
+    ]
+
+
+def test_incr_sample_rate(pm):
+    pm.emit(MetricsRecord("incr", key="app.foo", value=1, tags=[], sample_rate=0.1))
+    assert render(pm) == [
+        "# TYPE app_foo_total counter",
+        "app_foo_total 10.0",
+    ]
+
+
+def test_incr_negative(pm, caplog):
+    pm.emit(MetricsRecord("incr", key="app.foo", value=5, tags=[]))
+    pm.emit(MetricsRecord("incr", key="app.foo", value=-1, tags=[]))
+    pm.emit(MetricsRecord("incr", key="app.foo", value=-2, tags=[]))
+    assert render(pm) == [
+        "# TYPE app_foo_total counter",
+        "app_foo_total 5.0",
+    ]
+    assert [record.message for record in caplog.records] == [
+        "Dropping negative increment for app_foo_total: counters can't go down"
+    ]
+
+
+def test_gauge(pm):
+    pm.emit(MetricsRecord("gauge", key="app.foo", value=10, tags=[]))
+    pm.emit(MetricsRecord("gauge", key="app.foo", value=5, tags=[]))
+    assert render(pm) == [
+        "# TYPE app_foo gauge",
+        "app_foo 5.0",
+    ]
+
+
+@pytest.mark.parametrize("stat_type", ["timing", "histogram", "distribution"])
+def test_histogram(pm, stat_type):
+    for value in [5, 10, 50, 500]:
+        pm.emit(MetricsRecord(stat_type, key="app.foo", value=value, tags=[]))
+    assert render(pm) == [
+        "# TYPE app_foo histogram",
+        'app_foo_bucket{le="10.0"} 2.0',
+        'app_foo_bucket{le="100.0"} 3.0',
+        'app_foo_bucket{le="+Inf"} 4.0',
+        "app_foo_sum 565.0",
+        "app_foo_count 4.0",
+    ]
+
+
+def test_tags(pm):
+    pm.emit(MetricsRecord("incr", key="foo", value=1, tags=["env:prod", "canary"]))
+    # Tag order doesn't matter
+    pm.emit(MetricsRecord("incr", key="foo", value=1, tags=["canary", "env:prod"]))
+    pm.emit(MetricsRecord("incr", key="foo", value=1, tags=["env:stage"]))
+    pm.emit(MetricsRecord("timing", key="bar", value=1, tags=["env:prod"]))
+    assert render(pm) == [
+        "# TYPE foo_total counter",
+        'foo_total{canary="true",env="prod"} 2.0',
+        'foo_total{env="stage"} 1.0',
+        "# TYPE bar histogram",
+        'bar_bucket{env="prod",le="10.0"} 1.0',
+        'bar_bucket{env="prod",le="100.0"} 1.0',
+        'bar_bucket{env="prod",le="+Inf"} 1.0',
+        'bar_sum{env="prod"} 1.0',
+        'bar_count{env="prod"} 1.0',
+    ]
+
+
+def test_names_and_labels_are_sanitized(pm):
+    pm.emit(MetricsRecord("gauge", key="1app-foo.bar", value=1, tags=['my-tag:a"b\\c']))
+    assert render(pm) == [
+        "# TYPE _1app_foo_bar gauge",
+        '_1app_foo_bar{my_tag="a\\"b\\\\c"} 1.0',
+    ]
+
+
+def test_namespace():
+    pm = PrometheusMetrics(options={"start_server": False, "namespace": "app"})
+    pm.emit(MetricsRecord("gauge", key="foo", value=1, tags=[]))
+    assert render(pm) == ["# TYPE app_foo gauge", "app_foo 1.0"]
+
+
+def test_conflicting_types(pm, caplog):
+    pm.emit(MetricsRecord("gauge", key="foo", value=1, tags=[]))
+    pm.emit(MetricsRecord("timing", key="foo", value=1, tags=[]))
+    pm.emit(MetricsRecord("timing", key="foo", value=1, tags=[]))
+    assert render(pm) == ["# TYPE foo gauge", "foo 1.0"]
+    assert [record.message for record in caplog.records] == [
+        "Dropping histogram foo: foo is already a gauge"
+    ]
+
+
+def test_render_is_cached(pm):
+    pm.emit(MetricsRecord("gauge", key="foo", value=1, tags=[]))
+    pm.emit(MetricsRecord("gauge", key="bar", value=1, tags=["a:b"]))
+    first = pm.render()
+    # Nothing changed, so it's the same object
+    assert pm.render() is first
+
+    pm.emit(MetricsRecord("gauge", key="bar", value=2, tags=["a:b"]))
+    assert render(pm) == [
+        "# TYPE foo gauge",
+        "foo 1.0",
+        "# TYPE bar gauge",
+        'bar{a="b"} 2.0',
+    ]
+
+    # New series are rendered
+    pm.emit(MetricsRecord("gauge", key="bar", value=3, tags=["a:c"]))
+    assert render(pm)[-1] == 'bar{a="c"} 3.0'
+
+
+def test_http_server():
+    pm = PrometheusMetrics(options={"http_host": "127.0.0.1", "http_port": 0})
+    try:
+        pm.emit(MetricsRecord("gauge", key="foo", value=1, tags=[]))
+        url = f"http://127.0.0.1:{pm.http_port}"
+        with urllib.request.urlopen(url + "/metrics") as resp:
+            assert resp.headers["Content-Type"] == (
+                "text/plain; version=0.0.4; charset=utf-8"
+            )
+            assert resp.read() == b"# TYPE foo gauge\nfoo 1.0\n"
+
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(url + "/other")
+        assert excinfo.value.code == 404
+        excinfo.value.close()
+    finally:
+        pm.close()
+    # Closing again is fine
+    pm.close()
+
+
+def test_reconfigure_same_port():
+    def configure(port):
+        markus.configure(
+            [
+                {
+                    "class": "markus.backends.prometheus.PrometheusMetrics",
+                    "options": {"http_host": "127.0.0.1", "http_port": port},
+                }
+            ]
+        )
+        [backend] = markus.main._get_metrics_backends()
+        return backend
+
+    try:
+        old_pm = configure(0)
+        # Reconfiguring stops the old server so the new one can use its port
+        new_pm = configure(old_pm.http_port)
+        assert old_pm._server is None
+        assert new_pm.http_port == old_pm.http_port
+
+        new_pm.emit(MetricsRecord("gauge", key="foo", value=1, tags=[]))
+        url = f"http://127.0.0.1:{new_pm.http_port}/metrics"
+        with urllib.request.urlopen(url) as resp:
+            assert resp.read() == b"# TYPE foo gauge\nfoo 1.0\n"
+    finally:
+        _change_metrics([])
+
+
+def test_after_fork_child(pm):
+    pm.emit(MetricsRecord("gauge", key="foo", value=1, tags=[]))
+    pm.render()
+
+    # The child starts with no metrics
+    pm.after_fork_child()
+    assert pm.render() == b""
+    pm.emit(MetricsRecord("gauge", key="bar", value=1, tags=[]))
+    assert render(pm) == ["# TYPE bar gauge", "bar 1.0"]
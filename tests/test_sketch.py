@@ -0,0 +1,126 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import random
+
+import pytest
+
+from markus.sketch import DDSketch
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[max(int(-(-q * len(values) // 1)) - 1, 0)]
+
+
+def test_empty():
+    sketch = DDSketch()
+    assert sketch.count == 0
+    assert sketch.quantile(0.5) is None
+    assert sketch.avg is None
+
+
+def test_bad_arguments():
+    with pytest.raises(ValueError):
+        DDSketch(relative_accuracy=0)
+    with pytest.raises(ValueError):
+        DDSketch(max_bins=0)
+    with pytest.raises(ValueError):
+        DDSketch().quantile(1.5)
+
+
+def test_exact_stats():
+    sketch = DDSketch()
+    for value in [5, 1, 3]:
+        sketch.add(value)
+    assert sketch.count == 3
+    assert sketch.sum == 9
+    assert sketch.min == 1
+    assert sketch.max == 5
+    assert sketch.avg == 3
+    assert sketch.quantile(0) == 1
+    assert sketch.quantile(1) == 5
+
+
+@pytest.mark.parametrize("relative_accuracy", [0.01, 0.05])
+def test_relative_accuracy(relative_accuracy):
+    rng = random.Random(0)
+    values = [rng.lognormvariate(3, 1) for _ in range(10000)]
+    sketch = DDSketch(relative_accuracy=relative_accuracy)
+    for value in values:
+        sketch.add(value)
+
+    for q in [0.5, 0.9, 0.95, 0.99, 0.999]:
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= expected * relative_accuracy
+
+
+def test_small_values():
+    rng = random.Random(0)
+    values = [rng.uniform(0.001, 0.1) for _ in range(1000)]
+    sketch = DDSketch(relative_accuracy=0.001)
+    for value in values:
+        sketch.add(value)
+
+    # Small values aren't counted as zero
+    assert sketch.zero_count == 0
+    for q in [0.01, 0.5, 0.99]:
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= expected * 0.001
+
+
+def test_negative_and_zero():
+    sketch = DDSketch()
+    for value in [-10, -5, 0, 0, 5, 10]:
+        sketch.add(value)
+    assert sketch.quantile(0) == -10
+    assert abs(sketch.quantile(0.3) - -5) <= 0.05
+    assert sketch.quantile(0.5) == 0
+    assert sketch.quantile(0.6) == 0
+    assert abs(sketch.quantile(0.8) - 5) <= 0.05
+    assert sketch.quantile(1) == 10
+
+
+def test_max_bins():
+    sketch = DDSketch(max_bins=10)
+    for value in range(1, 10001):
+        sketch.add(value)
+    assert len(sketch.positive) == 10
+    assert sketch.count == 10000
+    # High quantiles are still accurate
+    assert abs(sketch.quantile(0.99) - 9900) <= 9900 * 0.01
+
+
+def test_max_bins_negative():
+    sketch = DDSketch(max_bins=50)
+    for value in range(1, 1001):
+        sketch.add(-value)
+    assert len(sketch.negative) == 50
+    assert sketch.count == 1000
+    # High quantiles are the values nearest zero and are still accurate
+    assert abs(sketch.quantile(0.99) - -11) <= 11 * 0.01
+
+
+def test_merge():
+    values = list(range(1, 1001))
+    sketch1 = DDSketch()
+    sketch2 = DDSketch()
+    whole = DDSketch()
+    for value in values:
+        (sketch1 if value % 2 else sketch2).add(value)
+        whole.add(value)
+
+    sketch1.merge(sketch2)
+    assert sketch1.count == whole.count
+    assert sketch1.sum == whole.sum
+    assert sketch1.min == whole.min
+    assert sketch1.max == whole.max
+    assert sketch1.positive == whole.positive
+    for q in [0.5, 0.9, 0.99]:
+        assert sketch1.quantile(q) == whole.quantile(q)
+
+
+def test_merge_different_accuracy():
+    with pytest.raises(ValueError):
+        DDSketch(relative_accuracy=0.01).merge(DDSketch(relative_accuracy=0.02))
@@ -2,8 +2,13 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import os
+import socket
+import tempfile
+
 import pytest
 
+import markus
 from markus.backends import statsd
 from markus.main import MetricsFilter, MetricsRecord
 
@@ -14,14 +19,8 @@ class MockStatsd:
         self.initkwargs = kwargs
         self.calls = []
 
-    def incr(self, *args, **kwargs):
-        self.calls.append(("incr", args, kwargs))
-
-    def gauge(self, *args, **kwargs):
-        self.calls.append(("gauge", args, kwargs))
-
-    def timing(self, *args, **kwargs):
-        self.calls.append(("timing", args, kwargs))
+    def _after(self, *args, **kwargs):
+        self.calls.append(("_after", args, kwargs))
 
 
 @pytest.fixture
@@ -34,6 +33,26 @@ def mockstatsd():
     statsd.StatsClient = _old_statsd
 
 
+@pytest.fixture
+def udp_server():
+    """Local UDP server socket to receive stats."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.settimeout(2)
+    yield sock
+    sock.close()
+
+
+@pytest.fixture
+def backend_class():
+    return statsd.StatsdMetrics
+
+
+@pytest.fixture
+def backend_options(udp_server):
+    return {"statsd_host": "127.0.0.1", "statsd_port": udp_server.getsockname()[1]}
+
+
 def test_default_options(mockstatsd):
     ddm = statsd.StatsdMetrics()
 
@@ -77,42 +96,415 @@ def test_options(mockstatsd):
     }
 
 
-def test_incr(mockstatsd):
+def test_incr(make_backend, udp_server):
     rec = MetricsRecord("incr", key="foo", value=10, tags=["key1:val"])
-    ddm = statsd.StatsdMetrics()
+    ddm = make_backend()
     ddm.emit_to_backend(rec)
-    assert ddm.client.calls == [("incr", (), {"stat": "foo", "count": 10})]
+    assert udp_server.recv(65535) == b"foo:10|c"
 
 
-def test_gauge(mockstatsd):
+def test_gauge(make_backend, udp_server):
     rec = MetricsRecord("gauge", key="foo", value=100, tags=["key1:val"])
-    ddm = statsd.StatsdMetrics()
+    ddm = make_backend()
     ddm.emit_to_backend(rec)
-    assert ddm.client.calls == [("gauge", (), {"stat": "foo", "value": 100})]
+    assert udp_server.recv(65535) == b"foo:100|g"
 
 
-def test_timing(mockstatsd):
+def test_timing(make_backend, udp_server):
     rec = MetricsRecord("timing", key="foo", value=1234, tags=["key1:val"])
-    ddm = statsd.StatsdMetrics()
+    ddm = make_backend()
     ddm.emit_to_backend(rec)
-    assert ddm.client.calls == [("timing", (), {"stat": "foo", "delta": 1234})]
+    assert udp_server.recv(65535) == b"foo:1234.000000|ms"
 
 
-def test_histogram(mockstatsd):
+def test_histogram(make_backend, udp_server):
     rec = MetricsRecord("histogram", key="foo", value=4321, tags=["key1:val"])
-    ddm = statsd.StatsdMetrics()
+    ddm = make_backend()
     ddm.emit_to_backend(rec)
-    assert ddm.client.calls == [("timing", (), {"stat": "foo", "delta": 4321})]
+    assert udp_server.recv(65535) == b"foo:4321.000000|ms"
 
 
-def test_filters(mockstatsd):
+def test_distribution(make_backend, udp_server):
+    rec = MetricsRecord("distribution", key="foo", value=4321, tags=["key1:val"])
+    ddm = make_backend()
+    ddm.emit_to_backend(rec)
+    assert udp_server.recv(65535) == b"foo:4321.000000|ms"
+
+
+def test_filters(make_backend, udp_server):
     class BlueFilter(MetricsFilter):
         def filter(self, record):
             if "blue" not in record.key:
                 return
             return record
 
-    ddm = statsd.StatsdMetrics(filters=[BlueFilter()])
+    ddm = make_backend(filters=[BlueFilter()])
     ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
     ddm.emit_to_backend(MetricsRecord("incr", key="foo.blue", value=2, tags=[]))
-    assert ddm.client.calls == [("incr", (), {"stat": "foo.blue", "count": 2})]
+    assert udp_server.recv(65535) == b"foo.blue:2|c"
+
+
+def test_emit_batch(make_backend, udp_server):
+    ddm = make_backend(options={"statsd_maxudpsize": 20})
+    ddm.emit_batch_to_backend(
+        [
+            MetricsRecord("incr", key="foo", value=10, tags=[]),
+            MetricsRecord("gauge", key="bar", value=100, tags=[]),
+            MetricsRecord("gauge", key="baz", value=1, tags=[]),
+        ]
+    )
+    # Batches are packed into datagrams of up to maxudpsize
+    assert udp_server.recv(65535) == b"foo:10|c\nbar:100|g"
+    assert udp_server.recv(65535) == b"baz:1|g"
+
+
+@pytest.mark.parametrize(
+    "stat_type, value, expected",
+    [
+        ("incr", 1, b"foo:1|c|@0.1"),
+        ("gauge", 10, b"foo:10|g|@0.1"),
+        ("timing", 100, b"foo:100.000000|ms|@0.1"),
+        ("histogram", 100, b"foo:100.000000|ms|@0.1"),
+    ],
+)
+def test_sample_rate(make_backend, udp_server, stat_type, value, expected):
+    rec = MetricsRecord(stat_type, key="foo", value=value, tags=[], sample_rate=0.1)
+    ddm = make_backend()
+    ddm.emit_to_backend(rec)
+    assert udp_server.recv(65535) == expected
+
+
+def test_negative_gauge(make_backend, udp_server):
+    rec = MetricsRecord("gauge", key="foo", value=-5, tags=[])
+    ddm = make_backend()
+    ddm.emit_to_backend(rec)
+    assert udp_server.recv(65535) == b"foo:0|g\nfoo:-5|g"
+
+
+def test_prefix(make_backend, udp_server):
+    ddm = make_backend(options={"statsd_prefix": "joe"})
+    ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    assert udp_server.recv(65535) == b"joe.foo:1|c"
+
+
+def test_percent_in_key(make_backend, udp_server):
+    ddm = make_backend(options={"statsd_prefix": "a%s"})
+    ddm.emit_to_backend(MetricsRecord("incr", key="foo%d", value=1, tags=[]))
+    assert udp_server.recv(65535) == b"a%s.foo%d:1|c"
+
+
+def test_wire_cache(mockstatsd):
+    ddm = statsd.StatsdMetrics(options={"statsd_wire_cache_size": 2})
+    for key in ["foo", "foo", "bar", "foo", "baz", "bar"]:
+        ddm.emit_to_backend(MetricsRecord("incr", key=key, value=1, tags=[]))
+
+    info = ddm.wire_cache_info()
+    assert info.hits == 2
+    assert info.misses == 4
+    assert info.maxsize == 2
+    assert info.currsize == 2
+
+
+@pytest.fixture
+def socket_path():
+    """Path for a Unix domain socket.
+
+    This doesn't use tmp_path because Unix domain socket paths have a short
+    maximum length.
+
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        yield os.path.join(tmpdir, "statsd.sock")
+
+
+def uds_dgram_server(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(1)
+    return sock
+
+
+def test_uds_dgram(socket_path):
+    server = uds_dgram_server(socket_path)
+    ddm = statsd.StatsdMetrics(
+        options={"statsd_socket_path": socket_path, "statsd_maxudpsize": 20}
+    )
+    try:
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        assert server.recv(65535) == b"foo:1|c"
+
+        # Batches are packed into datagrams of up to maxudpsize
+        ddm.emit_batch_to_backend(
+            [MetricsRecord("gauge", key="foo", value=i, tags=[]) for i in range(3)]
+        )
+        assert server.recv(65535) == b"foo:0|g\nfoo:1|g"
+        assert server.recv(65535) == b"foo:2|g"
+    finally:
+        ddm.client.close()
+        server.close()
+
+
+def test_uds_dgram_reconnects(socket_path):
+    ddm = statsd.StatsdMetrics(options={"statsd_socket_path": socket_path})
+    try:
+        # Nothing is listening, so this is dropped
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        assert ddm.client._sock is None
+
+        server = uds_dgram_server(socket_path)
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=2, tags=[]))
+        assert server.recv(65535) == b"foo:2|c"
+        server.close()
+    finally:
+        ddm.client.close()
+
+
+def test_uds_stream(socket_path):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(1)
+    server.settimeout(1)
+    ddm = statsd.StatsdMetrics(
+        options={"statsd_socket_path": socket_path, "statsd_socket_type": "stream"}
+    )
+    try:
+        ddm.emit_batch_to_backend(
+            [MetricsRecord("incr", key="foo", value=i, tags=[]) for i in range(2)]
+        )
+        conn, _ = server.accept()
+        conn.settimeout(1)
+        assert conn.recv(65535) == b"foo:0|c\nfoo:1|c\n"
+
+        # The daemon hangs up, so the stat is dropped and the next one
+        # reconnects
+        conn.close()
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=2, tags=[]))
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=3, tags=[]))
+        conn, _ = server.accept()
+        conn.settimeout(1)
+        assert conn.recv(65535) == b"foo:3|c\n"
+        conn.close()
+    finally:
+        ddm.client.close()
+        server.close()
+
+
+@pytest.fixture
+def tcp_server():
+    """Local TCP server socket to accept connections."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(5)
+    sock.settimeout(2)
+    yield sock
+    sock.close()
+
+
+def recv_lines(conn, count):
+    conn.settimeout(2)
+    data = b""
+    while data.count(b"\n") < count:
+        chunk = conn.recv(65535)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def unused_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def test_tcp_bad_options():
+    with pytest.raises(ValueError):
+        statsd.StatsdMetrics(options={"statsd_protocol": "foo"})
+    with pytest.raises(ValueError):
+        statsd.StatsdMetrics(
+            options={"statsd_protocol": "tcp", "statsd_socket_path": "/tmp/foo"}
+        )
+
+
+def test_tcp_batches_writes(tcp_server):
+    ddm = statsd.StatsdMetrics(
+        options={
+            "statsd_host": "127.0.0.1",
+            "statsd_port": tcp_server.getsockname()[1],
+            "statsd_protocol": "tcp",
+            "statsd_tcp_flush_interval": 60,
+        }
+    )
+    try:
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        ddm.emit_batch_to_backend(
+            [MetricsRecord("gauge", key="bar", value=i, tags=[]) for i in range(2)]
+        )
+        ddm.client.flush()
+
+        conn, _ = tcp_server.accept()
+        assert recv_lines(conn, 3) == b"foo:1|c\nbar:0|g\nbar:1|g\n"
+        assert ddm.client.sent == 3
+        assert ddm.client.dropped == 0
+        conn.close()
+    finally:
+        ddm.client.close()
+
+
+def test_tcp_flushes_by_size(tcp_server):
+    ddm = statsd.StatsdMetrics(
+        options={
+            "statsd_host": "127.0.0.1",
+            "statsd_port": tcp_server.getsockname()[1],
+            "statsd_protocol": "tcp",
+            "statsd_tcp_flush_interval": 60,
+            "statsd_tcp_flush_size": 16,
+        }
+    )
+    try:
+        # The second stat puts the buffer over flush_size which wakes the
+        # flusher thread up
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        ddm.emit_to_backend(MetricsRecord("incr", key="bar", value=1, tags=[]))
+
+        conn, _ = tcp_server.accept()
+        assert recv_lines(conn, 2) == b"foo:1|c\nbar:1|c\n"
+        conn.close()
+    finally:
+        ddm.client.close()
+
+
+def test_tcp_connect_backoff():
+    ddm = statsd.StatsdMetrics(
+        options={
+            "statsd_host": "127.0.0.1",
+            "statsd_port": unused_port(),
+            "statsd_protocol": "tcp",
+            "statsd_tcp_flush_interval": 60,
+            "statsd_tcp_max_buffer_size": 20,
+            "statsd_tcp_reconnect_backoff": 10,
+            "statsd_tcp_max_reconnect_backoff": 15,
+        }
+    )
+    client = ddm.client
+    try:
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        client.flush()
+
+        # Connecting failed, so the stat is still buffered and the client is
+        # backing off
+        assert client._sock is None
+        assert client._buffer_count == 1
+        assert client._backoff == 15
+        next_connect = client._next_connect
+
+        # While backing off, the client doesn't try to connect
+        client.flush()
+        assert client._next_connect == next_connect
+
+        # The buffer fills up, so new stats are dropped
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=2, tags=[]))
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=3, tags=[]))
+        assert client._buffer == ["foo:1|c", "foo:2|c"]
+        assert client.dropped == 1
+    finally:
+        client.close()
+
+    # Closing tries once more, then drops what's left
+    assert client.dropped == 3
+    assert client.sent == 0
+
+
+class BrokenSocket:
+    def sendall(self, data):
+        raise ConnectionResetError()
+
+    def close(self):
+        pass
+
+
+def test_tcp_send_failure_reconnects(tcp_server):
+    ddm = statsd.StatsdMetrics(
+        options={
+            "statsd_host": "127.0.0.1",
+            "statsd_port": tcp_server.getsockname()[1],
+            "statsd_protocol": "tcp",
+            "statsd_tcp_flush_interval": 60,
+            "statsd_tcp_reconnect_backoff": 0,
+        }
+    )
+    client = ddm.client
+    try:
+        client._sock = BrokenSocket()
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        client.flush()
+        assert client.dropped == 1
+        assert client._sock is None
+
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=2, tags=[]))
+        client.flush()
+        conn, _ = tcp_server.accept()
+        assert recv_lines(conn, 1) == b"foo:2|c\n"
+        assert client.sent == 1
+        conn.close()
+    finally:
+        client.close()
+
+
+def test_tcp_markus_flush(tcp_server, configure_backends):
+    ddm = statsd.StatsdMetrics(
+        options={
+            "statsd_host": "127.0.0.1",
+            "statsd_port": tcp_server.getsockname()[1],
+            "statsd_protocol": "tcp",
+            "statsd_tcp_flush_interval": 60,
+        }
+    )
+    try:
+        configure_backends([ddm])
+        ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+        markus.flush()
+
+        conn, _ = tcp_server.accept()
+        assert recv_lines(conn, 1) == b"foo:1|c\n"
+        conn.close()
+    finally:
+        ddm.client.close()
+
+
+def test_after_fork_child(make_backend, udp_server):
+    ddm = make_backend()
+    client = ddm.client
+
+    # The child gets its own client
+    ddm.after_fork_child()
+    assert ddm.client is not client
+    ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    assert udp_server.recv(65535) == b"foo:1|c"
+
+
+def test_tcp_after_fork_child():
+    ddm = statsd.StatsdMetrics(
+        options={
+            "statsd_host": "127.0.0.1",
+            "statsd_port": unused_port(),
+            "statsd_protocol": "tcp",
+            "statsd_tcp_flush_interval": 60,
+        }
+    )
+    client = ddm.client
+    ddm.emit_to_backend(MetricsRecord("incr", key="foo", value=1, tags=[]))
+    assert client._buffer_count == 1
+
+    # The child drops the parent's buffer without sending it and gets its own
+    # client
+    ddm.after_fork_child()
+    try:
+        assert client._buffer == []
+        assert client.dropped == 0
+        assert ddm.client is not client
+        assert ddm.client._thread.is_alive()
+    finally:
+        ddm.client.close()
@@ -227,6 +227,25 @@ class TestMetricsMock:
             with pytest.raises(AssertionError):
                 mm.assert_not_histogram(stat="test.key1")
 
+    def test_distribution_helpers(self):
+        with MetricsMock() as mm:
+            markus.configure([{"class": "markus.backends.logging.LoggingMetrics"}])
+            mymetrics = markus.get_metrics("test")
+            mymetrics.distribution("key1", value=1)
+            mymetrics.distribution("keymultiple", value=1)
+            mymetrics.distribution("keymultiple", value=1)
+
+            mm.assert_distribution(stat="test.key1")
+
+            mm.assert_distribution_once(stat="test.key1")
+            with pytest.raises(AssertionError):
+                mm.assert_distribution_once(stat="test.keymultiple")
+
+            mm.assert_not_distribution(stat="test.keynot")
+            mm.assert_not_distribution(stat="test.key1", value=5)
+            with pytest.raises(AssertionError):
+                mm.assert_not_distribution(stat="test.key1")
+
     def test_print_on_failure(self, capsys):
         with MetricsMock() as mm:
             markus.configure([{"class": "markus.backends.logging.LoggingMetrics"}])